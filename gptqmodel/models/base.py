@@ -2,31 +2,48 @@ from __future__ import annotations
 
 import json
 import os
+import re
 import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional, Union, Tuple
 
 import torch
 import torch.nn as nn
+import transformers
 from packaging import version
 from transformers import AutoModelForCausalLM, PreTrainedModel, PreTrainedTokenizerBase, modeling_utils
 
 from ..nn_modules.hooked_linear import replace_linear_with_hooked_linear
-from ..quantization import GPTQ, QuantizeConfig
-from ..quantization.config import FORMAT, QUANTIZE_BLACK_LIST, AutoRoundQuantizeConfig
+from ..nn_modules.qlinear import BaseQuantLinear
+from ..quantization import GPTQ, HessianCollector, QuantizeConfig, load_hessians
+from ..quantization.awq import search_awq_scales
+from ..quantization.config import FORMAT, QUANTIZE_BLACK_LIST, AutoRoundQuantizeConfig, RTNQuantizeConfig
+from ..quantization.gptq import quantize_batched
+from ..quantization.moe import ExpertHessianAccumulator, expert_module_pattern
+from ..quantization.rotation import register_online_rotation, rotate_model
+from ..quantization.rtn import rtn_quantize
 from ..utils.backend import BACKEND
+from ..utils.calibration import (CALIBRATION_DEDUP_THRESHOLD, calibration_forward, calibration_input_ids,
+                                 embed_calibration_samples, select_calibration_samples)
 from ..utils.data import collate_data
 from ..utils.device import get_cpu_usage_memory, get_gpu_usage_memory
 from ..utils.importer import select_quant_linear
 from ..utils.logger import setup_logger
-from ..utils.model import (MODALITY, check_to_quantized, find_layers, get_device, get_module_by_name_prefix,
-                           get_moe_layer_modules, move_to, nested_move_to, normalize_tokenizer, pack_model)
+from ..utils.model import (MODALITY, check_to_quantized, checkpoint_tensor_files, convert_qzeros_v1_to_v2,
+                           dequantize_packed_weight, find_layers, get_device, get_module_by_name_prefix,
+                           get_moe_layer_modules, load_checkpoint_tensors, module_fingerprint, move_to,
+                           nested_move_to, normalize_tokenizer, pack_model, recurse_setattr)
+from ..utils.planner import QuantizationPlan, plan_quantization
 from ..utils.progress import ProgressBar
 from ..utils.torch import torch_empty_cache
+from ..utils.trace import trace_span
+from ..utils.transfer import LayerInputTransfer, to_host
 from ._const import CPU, DEVICE
 from .loader import ModelLoader
-from .writer import (QUANT_LOG_DAMP, QUANT_LOG_FWD_TIME, QUANT_LOG_LAYER,
-                     QUANT_LOG_LOSS, QUANT_LOG_MODULE, QUANT_LOG_TIME, ModelWriter)
+from .writer import (QUANT_FINGERPRINT_FILENAME, QUANT_FINGERPRINT_VERSION, QUANT_LOG_DAMP, QUANT_LOG_DAMP_TIME,
+                     QUANT_LOG_FACTORIZATIONS, QUANT_LOG_FWD_TIME, QUANT_LOG_LAYER, QUANT_LOG_LOSS, QUANT_LOG_MODULE,
+                     QUANT_LOG_OUT_COS, QUANT_LOG_OUT_MSE, QUANT_LOG_TIME, QUANT_LOG_TOKENS, ModelWriter)
 
 
 def check_support_param_buffer_assignment(*args, **kwargs):
@@ -78,6 +95,21 @@ class BaseGPTQModel(nn.Module):
 
     supports_desc_act = [True, False]
 
+    # residual stream rotation (QuantizeConfig.rotation) of llama style models with rms norms, see quantization/rotation.py
+    # norm -> modules reading its output, None if the model does not support rotation
+    rotation_norms: Optional[Dict[str, List[str]]] = None
+    # modules writing to the residual stream
+    rotation_outputs: List[str] = []
+    # modules whose inputs get an online hadamard transform
+    rotation_online: List[str] = []
+    # norm before the lm_head
+    rotation_final_norm: Optional[str] = None
+
+    # awq scales (QuantizeConfig.awq): module -> norm or linear producing its inputs, the scales are folded into the
+    # producer's output channels. Modules of a subset sharing a producer share scales. None if the model does not
+    # support awq
+    awq_scale_targets: Optional[Dict[str, str]] = None
+
     modality: List[MODALITY] = [MODALITY.TEXT]
 
     quant_override_files: Dict[str, Union[str | Dict[str, Any]]] = {}
@@ -108,6 +140,10 @@ class BaseGPTQModel(nn.Module):
         self.model_local_path = model_local_path
         # stores all per-layer quant stats such as avg loss and processing time
         self.quant_log = []
+        # sha256 of the source weights of every quantized module, saved next to the checkpoint
+        self.quant_source_fingerprints = {}
+        # source checkpoint of `requantize()`, layers are dequantized from it right before they are quantized
+        self._requantize_source = None
 
         # apply patching of broken trust_remote_code models here
         if self.require_monkeypatch:
@@ -192,14 +228,85 @@ class BaseGPTQModel(nn.Module):
 
         return new_calibration_dataset_batched
 
-    def quantize(
+    def get_layer_modules(self) -> List[List[str]]:
+        """Module names of each quantization subset, in the order `quantize()` processes them."""
+        layer_modules = self.layer_modules
+
+        if not self.quantize_config.true_sequential:
+            layer_modules = [sum(layer_modules, [])]
+
+        # dynamic expert layer index for model defs
+        if self.dynamic_expert_index is not None:
+            num_experts = getattr(self.model.config, self.dynamic_expert_index)
+            layer_modules = get_moe_layer_modules(layer_modules=self.layer_modules,
+                                                  num_experts=num_experts)
+
+        return layer_modules
+
+    def plan_quantization(
         self,
         calibration_dataset: Union[List[Dict[str, Union[List[int], torch.LongTensor]]], List[str], List[int]],
         batch_size: int = 1,
         calibration_enable_gpu_cache: bool = True,
         tokenizer: Optional[PreTrainedTokenizerBase] = None,
+        probe: bool = True,
+    ) -> QuantizationPlan:
+        """Dry run of `quantize()`: estimated per phase time, peak memory, checkpoint size and recommended settings."""
+        if self.quantized:
+            raise EnvironmentError("plan_quantization() is called a model that is already quantized")
+
+        if len(calibration_dataset) == 0:
+            raise ValueError("Calibration dataset must not be empty.")
+
+        if tokenizer is not None:
+            self.tokenizer = normalize_tokenizer(self.config, tokenizer)
+
+        plan = plan_quantization(
+            self,
+            calibration_dataset,
+            batch_size=batch_size,
+            calibration_enable_gpu_cache=calibration_enable_gpu_cache,
+            probe=probe,
+        )
+        logger.info(f"Quantization plan:\n{plan}")
+        return plan
+
+    def select_calibration_dataset(
+        self,
+        calibration_dataset: Union[List[Dict[str, Union[List[int], torch.LongTensor]]], List[str], List[int]],
+        max_samples: Optional[int] = 256,
+        max_tokens: Optional[int] = None,
+        dedup_threshold: float = CALIBRATION_DEDUP_THRESHOLD,
+        tokenizer: Optional[PreTrainedTokenizerBase] = None,
+    ) -> List:
+        """
+        Representative subset of `calibration_dataset` to pass to `quantize()`. Samples are embedded by the mean of the
+        model's input embeddings, near duplicates are removed and a diverse subset is picked by k-center coverage up
+        to `max_samples` samples and `max_tokens` tokens.
+        """
+        if calibration_dataset is None or len(calibration_dataset) == 0:
+            raise ValueError("Calibration dataset must not be empty.")
+
+        tokenizer = tokenizer or self.tokenizer
+        input_ids = [calibration_input_ids(sample, tokenizer) for sample in calibration_dataset]
+        embeddings = embed_calibration_samples(input_ids, self.model.get_input_embeddings())
+        lengths = [len(ids) for ids in input_ids]
+        indices = select_calibration_samples(embeddings, lengths, max_samples, max_tokens, dedup_threshold)
+
+        logger.info(f"Calibration selection: {len(indices)} of {len(calibration_dataset)} samples, "
+                    f"{sum(lengths[i] for i in indices)} of {sum(lengths)} tokens")
+        return [calibration_dataset[i] for i in indices]
+
+    def quantize(
+        self,
+        calibration_dataset: Optional[Union[List[Dict[str, Union[List[int], torch.LongTensor]]], List[str], List[int]]],
+        batch_size: int = 1,
+        calibration_enable_gpu_cache: bool = True,
+        tokenizer: Optional[PreTrainedTokenizerBase] = None,
         logger_board: Optional[str] = None,
         backend: Optional[BACKEND] = BACKEND.AUTO,
+        hessians: Optional[Union[str, Dict, HessianCollector]] = None,
+        previous_quantized: Optional[str] = None,
     ) -> List[Dict[str, str]]:
         if self.quantized:
             raise EnvironmentError("quantize() is called a model that is already quantized")
@@ -220,7 +327,43 @@ class BaseGPTQModel(nn.Module):
         if self.quantize_config.lm_head and not isinstance(self.quantize_config, AutoRoundQuantizeConfig):
             raise ValueError("`lm_head=True` quantization is only available with AutoRound quantizer. Please use `AutoRoundQuantizeConfig` instead of `QuantizeConfig` and set `lm_head=True` or set `lm_head=False`.")
 
-        if len(calibration_dataset) == 0:
+        if hessians is not None and isinstance(self.quantize_config, AutoRoundQuantizeConfig):
+            raise ValueError("`hessians` can not be used with AutoRound quantizer.")
+
+        if self.quantize_config.outlier_ratio > 0 and isinstance(self.quantize_config, AutoRoundQuantizeConfig):
+            raise ValueError("`outlier_ratio` can not be used with AutoRound quantizer.")
+
+        if self.quantize_config.adapter_rank > 0 and isinstance(self.quantize_config, AutoRoundQuantizeConfig):
+            raise ValueError("`adapter_rank` can not be used with AutoRound quantizer.")
+
+        calibration_free = isinstance(self.quantize_config, RTNQuantizeConfig)
+        if hessians is not None and calibration_free:
+            raise ValueError("`hessians` can not be used with calibration free RTN quantization.")
+
+        if previous_quantized is not None:
+            if isinstance(self.quantize_config, (AutoRoundQuantizeConfig, RTNQuantizeConfig)) or hessians is not None:
+                raise ValueError("`previous_quantized` can only be used with GPTQ calibration quantization.")
+            if self.quantize_config.format not in [FORMAT.GPTQ, FORMAT.GPTQ_V2]:
+                raise ValueError(f"`previous_quantized` requires FORMAT.GPTQ or FORMAT.GPTQ_V2, actual = `{self.quantize_config.format}`.")
+            if self.quantize_config.outlier_ratio > 0 or self.quantize_config.adapter_rank > 0:
+                raise ValueError("`previous_quantized` can not be used with outlier_ratio or adapter_rank.")
+
+        if self.quantize_config.rotation is not None:
+            if self.rotation_norms is None:
+                raise NotImplementedError(f"{self.__class__.__name__} does not support QuantizeConfig.rotation.")
+            if isinstance(self.quantize_config, AutoRoundQuantizeConfig) or hessians is not None or previous_quantized is not None:
+                raise ValueError("`rotation` can not be used with AutoRound, `hessians` or `previous_quantized`.")
+
+        if self.quantize_config.awq:
+            if self.awq_scale_targets is None:
+                raise NotImplementedError(f"{self.__class__.__name__} does not support QuantizeConfig.awq.")
+            if isinstance(self.quantize_config, AutoRoundQuantizeConfig) or hessians is not None or previous_quantized is not None:
+                raise ValueError("`awq` can not be used with AutoRound, `hessians` or `previous_quantized`.")
+
+        if self.quantize_config.format == FORMAT.GPTQ_SPARSE and (self.quantize_config.prune_n, self.quantize_config.prune_m) != (2, 4):
+            raise ValueError("FORMAT.GPTQ_SPARSE requires 2:4 pruning: set prune_n=2, prune_m=4.")
+
+        if hessians is None and not calibration_free and (calibration_dataset is None or len(calibration_dataset) == 0):
             raise ValueError("Calibration dataset must not be empty.")
 
         if logger_board== "clearml":
@@ -249,6 +392,7 @@ class BaseGPTQModel(nn.Module):
             device=DEVICE(self.quantize_config.device),
             pack=True,
             format=self.quantize_config.format,
+            outliers=self.quantize_config.outlier_ratio > 0,
         )
 
         # Use the provided tokenizer if one is passed to quantize()
@@ -257,6 +401,29 @@ class BaseGPTQModel(nn.Module):
             # after tokenizer is reset, need to normalize it again
             self.tokenizer = normalize_tokenizer(self.config, self.tokenizer)
 
+        if self.quantize_config.format == FORMAT.BITBLAS:
+            from ..nn_modules.qlinear.bitblas import BITBLAS_AVAILABLE, BITBLAS_INSTALL_HINT
+            if BITBLAS_AVAILABLE is False:
+                raise ValueError(BITBLAS_INSTALL_HINT)
+
+        if self.quantize_config.rotation is not None and self._requantize_source is None:
+            # rotated in place, the modules quantized below see the rotated weights and activations
+            # requantize() sources are rotated checkpoints already
+            with trace_span("rotate"):
+                rotate_model(self.model, self, self.quantize_config.rotation, self.quantize_config.rotation_seed)
+
+        if hessians is not None:
+            # hessians captured from inference traffic replace the calibration forward passes
+            return self._quantize_with_hessians(hessians, backend)
+
+        if calibration_free:
+            return self._quantize_calibration_free(backend)
+
+        previous = self._load_previous_quantized(previous_quantized) if previous_quantized is not None else None
+        # packed tensors of modules reused from `previous_quantized`
+        packed = {}
+        self.quant_source_fingerprints = {}
+
         min_calibration_dataset_size = 256
         min_calibration_dataset_input_ids_avg_length = 256
 
@@ -264,12 +431,8 @@ class BaseGPTQModel(nn.Module):
             logger.warning(f"Calibration dataset size should be more than {min_calibration_dataset_size}. "
                            f"Current: {len(calibration_dataset)}.")
 
-        if self.quantize_config.format == FORMAT.BITBLAS:
-            from ..nn_modules.qlinear.bitblas import BITBLAS_AVAILABLE, BITBLAS_INSTALL_HINT
-            if BITBLAS_AVAILABLE is False:
-                raise ValueError(BITBLAS_INSTALL_HINT)
-
-        calibration_dataset = self.prepare_dataset(calibration_dataset, batch_size,)
+        with trace_span("prepare_dataset"):
+            calibration_dataset = self.prepare_dataset(calibration_dataset, batch_size,)
 
         # Calculate the average length of the average input_ids
         total_input_ids_length = 0
@@ -453,10 +616,11 @@ class BaseGPTQModel(nn.Module):
                         v = v.unsqueeze(0)
                     example[k] = move_to(v, cur_layer_device)
             try:
-                if is_ovis:
-                    self.generate(inputs=example.pop("input_ids"), max_new_tokens=1024, **example)
-                else:
-                    self.model(**example)
+                with trace_span("capture_inputs"):
+                    if is_ovis:
+                        self.generate(inputs=example.pop("input_ids"), max_new_tokens=1024, **example)
+                    else:
+                        self.model(**example)
             except ValueError:
                 pass
         handle.remove()
@@ -469,20 +633,29 @@ class BaseGPTQModel(nn.Module):
 
         torch_empty_cache()
 
-        layer_modules = self.layer_modules
-
-        if not self.quantize_config.true_sequential:
-            layer_modules = [sum(layer_modules, [])]
+        layer_modules = self.get_layer_modules()
+        # expert modules of MoE layers accumulate their hessians batched across experts
+        expert_pattern = expert_module_pattern(self.layer_modules)
 
-        # dynamic expert layer index for model defs
-        if self.dynamic_expert_index is not None:
-            num_experts = getattr(self.model.config, self.dynamic_expert_index)
-            layer_modules = get_moe_layer_modules(layer_modules=self.layer_modules,
-                                                  num_experts=num_experts)
+        # autocast of the layer forwards, add_batch() disables it again so hessians stay in fp32
+        calibration_forward_dtype = self.quantize_config.calibration_forward_dtype
 
         quantizers = {}
 
         layer_count = len(layers)
+        hessian_block_size = self.quantize_config.hessian_block_size
+        if hessian_block_size is None:
+            hessian_block_size = self.quantize_config.group_size if self.quantize_config.group_size > 0 else 128
+
+        # held out batches of the layer error check, see below
+        layer_error_batches = self._layer_error_batches(num_batches)
+        layer_error_thresholds = (self.quantize_config.layer_error_max_mse is not None
+                                  or self.quantize_config.layer_error_min_cosine is not None)
+        layer_error_retries = self.quantize_config.layer_error_retries if layer_error_thresholds and layer_error_batches > 0 else 0
+        if layer_error_thresholds and layer_error_batches == 0:
+            logger.warning("Layer error thresholds are set but no calibration batch is held out to measure the layer "
+                           "error (layer_error_batches = 0 or a single calibration batch). Thresholds are not checked.")
+
         layer_pb = ProgressBar(range(layer_count))
         gpu_memorys = []
         cpu_memorys = []
@@ -493,6 +666,7 @@ class BaseGPTQModel(nn.Module):
 
         # replace linear with hooked linear
         replace_linear_with_hooked_linear(self.model)
+        self._register_online_rotation()
 
         for i in layer_pb:
             layer_pb.set_description(f"Quantizing layer {i} of {layer_count - 1}")
@@ -500,6 +674,8 @@ class BaseGPTQModel(nn.Module):
             if layer.__class__.__name__.lower() == "MllamaCrossAttentionDecoderLayer".lower():
                 # TODO FIXME: currently we not support quantizing cross attention layer (pixel_values)
                 continue
+            if self._requantize_source is not None:
+                self._dequantize_source_layer(layer, i)
             if task is not None:
                 gpu_memory = get_gpu_usage_memory()
                 cpu_memory = get_cpu_usage_memory()
@@ -524,205 +700,760 @@ class BaseGPTQModel(nn.Module):
 
             cur_layer_device = get_device(layer)
             full = find_layers(layer)
-            for index, names in enumerate(layer_modules):
-                subset = {n: full[n] for n in names if n in full}
-                skipped_modules = []
-                gptq = {}
-                for name in subset:
-                    bits = self.quantize_config.bits
-                    sym = self.quantize_config.sym
-                    mse = self.quantize_config.mse
-                    if self.quantize_config.dynamic is not None:
+            # fingerprints of the source weights, taken before any module of this layer is quantized
+            layer_fingerprints = {n: module_fingerprint(full[n]) for n in sum(layer_modules, []) if n in full}
+
+            # host->device copies of this layer's inputs for all subset passes and the output pass
+            layer_transfer = LayerInputTransfer(layer_inputs, attention_masks, position_ids, layer_input_kwargs,
+                                                cur_layer_device)
+
+            # the first n batches are held out of the hessians, their fp outputs are captured before any module of
+            # this layer is quantized and compared against the quantized outputs of this layer. at least one batch
+            # is left for the hessians
+            layer_ref_outputs = []
+            for j, layer_input, additional_layer_inputs in layer_transfer.batches(stop=layer_error_batches):
+                with torch.no_grad():
+                    if hasattr(layer, "reuse_kv") and layer.reuse_kv:
+                        additional_layer_inputs["kv_last_layer"] = shared_kv_cache_dict.get(i - 1)
+
+                    with trace_span("layer_ref_forward", layer=i, batch=j):
+                        layer_output = calibration_forward(layer, layer_input, additional_layer_inputs,
+                                                           calibration_forward_dtype)
+                    if hasattr(layer, "reuse_kv") and shared_kv_cache_dict.get(i) is None:
+                        shared_kv_cache_dict[i] = layer_output[-1]
+                    layer_ref_outputs.append(move_to(layer_output[0], data_device))
+
+                del layer_input
+                del additional_layer_inputs
+                del layer_output
+
+            # original weights are only kept when a retry may need to restore them
+            layer_weights_backup = {n: m.weight.data.to(CPU, copy=True) for n, m in full.items()} if layer_error_retries > 0 else None
+            # awq scales are folded into norms and biases as well
+            layer_awq_backup = {}
+            if layer_error_retries > 0 and self.quantize_config.awq:
+                layer_awq_backup = {n: {k: v.to(CPU, copy=True) for k, v in layer.get_submodule(n).state_dict().items()}
+                                    for n in set(self.awq_scale_targets.values())}
+            retry = 0
+
+            while True:
+                layer_log_start = len(self.quant_log)
+                layer_damp_percent = self.quantize_config.damp_percent + retry * self.quantize_config.layer_error_retry_damp
+
+                for index, names in enumerate(layer_modules):
+                    subset = {n: full[n] for n in names if n in full}
+                    skipped_modules = []
+                    reused_modules = []
+                    gptq = {}
+                    for name in subset:
+                        bits = self.quantize_config.bits
+                        sym = self.quantize_config.sym
+                        mse = self.quantize_config.mse
                         layer_name = f"{self.layers_node}.{i}.{name}"
+                        if self.quantize_config.dynamic is not None:
+                            if self.quantize_config.dynamic_get(layer_name=layer_name) == False: # noqa: E712
+                                logger.info(f"skip module: {layer_name}")
 
-                        if self.quantize_config.dynamic_get(layer_name=layer_name) == False: # noqa: E712
-                            logger.info(f"skip module: {layer_name}")
+                                skipped_modules.append(name)
+                                continue
+
+                            bits = self.quantize_config.dynamic_get(layer_name, "bits", bits)
+                            sym = self.quantize_config.dynamic_get(layer_name, "sym", sym)
 
-                            skipped_modules.append(name)
+                        fingerprint = {"sha256": layer_fingerprints[name], **self._module_quant_meta(layer_name)}
+                        self.quant_source_fingerprints[layer_name] = fingerprint
+                        if previous is not None and previous["modules"].get(layer_name) == fingerprint:
+                            reused_modules.append(name)
                             continue
 
-                        bits = self.quantize_config.dynamic_get(layer_name, "bits", bits)
-                        sym = self.quantize_config.dynamic_get(layer_name, "sym", sym)
-                    gptq[name] = GPTQ(subset[name])
-                    gptq[name].quantizer.configure(
-                        bits,
-                        perchannel=True,
-                        sym=sym,
-                        mse=mse,
-                    )
+                        gptq[name] = GPTQ(
+                            subset[name],
+                            hessian_accumulation=self.quantize_config.hessian_accumulation,
+                            hessian_mode=self.quantize_config.hessian_mode,
+                            hessian_block_size=hessian_block_size,
+                            hessian_rank=self.quantize_config.hessian_rank,
+                        )
+                        gptq[name].quantizer.configure(
+                            bits,
+                            perchannel=True,
+                            sym=sym,
+                            mse=mse,
+                            mse_search_step=self.quantize_config.mse_search_step,
+                        )
 
-                for name in skipped_modules:
-                    subset.pop(name)
+                    for name in skipped_modules:
+                        subset.pop(name)
 
-                if len(gptq) == 0:
+                    for name in reused_modules:
+                        layer_name = f"{self.layers_node}.{i}.{name}"
+                        packed[layer_name] = self._load_previous_module(previous, layer_name)
+                        logger.info(f"reuse unchanged module: {layer_name}")
+                        # the dequantized weight is applied once this subset is quantized, so forwards of this subset
+                        # still see the fp weights like a full quantization run
+                        subset.pop(name)
+
+                    if len(gptq) == 0:
+                        self._apply_previous_weights(full, reused_modules, packed, i)
+                        continue
+
+                    experts = ExpertHessianAccumulator({n: g for n, g in gptq.items() if expert_pattern.match(n)})
+
+                    def add_batch(name):
+                        def tmp(_, inp: Tuple[torch.Tensor, ...], out: torch.Tensor):
+                            if name in experts:  # noqa: F821
+                                experts.add(name, inp[0].data)  # noqa: F821
+                                return
+                            # gptq is mutable.
+                            gptq[name].add_batch(inp[0].data, out.data)  # noqa: F821
+
+                        return tmp
+
+                    handle = []
+                    for name in subset:
+                        if hasattr(subset[name], 'forward_hook'):
+                            subset[name].forward_hook = add_batch(name)
+                        else:
+                            handle.append(subset[name].register_forward_hook(add_batch(name)))
+
+                    fwd_start = time.time()
+                    for j, layer_input, additional_layer_inputs in layer_transfer.batches(start=layer_error_batches):
+                        with torch.no_grad():
+                            # reuse_kv is a flag to reuse the kv cache, only for the hamba model
+                            if hasattr(layer, "reuse_kv"):
+                                if layer.reuse_kv:
+                                    additional_layer_inputs["kv_last_layer"] = shared_kv_cache_dict.get(i - 1)
+
+                                with trace_span("layer_forward", layer=i, batch=j):
+                                    layer_output = calibration_forward(layer, layer_input, additional_layer_inputs,
+                                                                       calibration_forward_dtype)
+                                if shared_kv_cache_dict.get(i) is None:
+                                    shared_kv_cache_dict[i] = layer_output[-1]
+                            else:
+                                with trace_span("layer_forward", layer=i, batch=j):
+                                    layer_output = calibration_forward(layer, layer_input, additional_layer_inputs,
+                                                                       calibration_forward_dtype)
+
+                            experts.flush()
+
+                        del layer_input
+                        del additional_layer_inputs
+                        del layer_output
+
+                    fwd_end = time.time()
+                    fwd_time = fwd_end - fwd_start
+
+                    for h in handle:
+                        h.remove()
+
+                    for name in subset:
+                        if hasattr(subset[name], 'forward_hook'):
+                            subset[name].forward_hook = None
+
+                    if index == len(layer_modules) - 1:
+                        torch_empty_cache()
+
+                    for name in experts.starved():
+                        logger.warning(f"layer {i} expert module {name} received only {experts.tokens[name]} calibration "
+                                       f"tokens for {experts.gptq[name].columns} input features, its hessian is rank deficient. "
+                                       f"Consider more or longer calibration samples.")
+
+                    solve_kwargs = {}
+                    for name in subset:
+                        group_size = self.quantize_config.group_size
+                        desc_act = self.quantize_config.desc_act
+                        if self.quantize_config.dynamic is not None:
+                            layer_name = f"{self.layers_node}.{i}.{name}"
+                            group_size = self.quantize_config.dynamic_get(layer_name, "group_size", group_size)
+                            desc_act = self.quantize_config.dynamic_get(layer_name, "desc_act", desc_act)
+
+                        solve_kwargs[name] = {
+                            "blocksize": self.quantize_config.solver_blocksize,
+                            "percdamp": layer_damp_percent,
+                            "group_size": group_size,
+                            "actorder": desc_act,
+                            "static_groups": self.quantize_config.static_groups,
+                            "sparsity": self.quantize_config.sparsity,
+                            "prune_n": self.quantize_config.prune_n,
+                            "prune_m": self.quantize_config.prune_m,
+                            "outlier_ratio": self.quantize_config.outlier_ratio,
+                            "adapter_rank": self.quantize_config.adapter_rank,
+                        }
+
+                    if self.quantize_config.awq:
+                        self._awq_scale_subset(layer, full, names, gptq, solve_kwargs, quantizers, i)
+
+                    layer_pb.set_description(f"Quantizing {len(subset)} modules in layer {i} of {layer_count - 1}")
+                    # same-shape modules (i.e. moe experts) are solved batched when solver_batch_size > 1
+                    results = quantize_batched({n: gptq[n] for n in subset}, solve_kwargs, self.quantize_config.solver_batch_size)
+
+                    for name_index, name in enumerate(subset):
+                        layer_name = f"{self.layers_node}.{i}.{name}"
+                        scale, zero, g_idx, duration, avg_loss, damp_percent = results[name]
+                        if task is not None:
+                            task.get_logger().report_scalar(
+                                title='Quantization Loss',
+                                series=f'layer_{i}_loss',
+                                value=avg_loss,
+                                iteration=name_index,
+                            )
+
+                            task.get_logger().report_scalar(
+                                title='Quantization Time',
+                                series=f'layer_{i}_time',
+                                value=duration,
+                                iteration=name_index,
+                            )
+                        durations.append(duration)
+                        avg_losses.append(avg_loss)
+                        module_names.append(f"layer-{i}-{name}")
+
+                        stat = {QUANT_LOG_LAYER: i, QUANT_LOG_MODULE: name, QUANT_LOG_LOSS: f"{avg_loss:.5f}",
+                                QUANT_LOG_DAMP: f"{damp_percent:.5f}", QUANT_LOG_TIME: f"{duration:.3f}", QUANT_LOG_FWD_TIME: f"{fwd_time:.3f}",
+                                QUANT_LOG_FACTORIZATIONS: gptq[name].factorizations, QUANT_LOG_DAMP_TIME: f"{gptq[name].damp_time:.3f}"}
+                        if name in experts:
+                            stat[QUANT_LOG_TOKENS] = experts.tokens[name]
+                        if self.quantize_config.dynamic is not None:
+                            stat["dynamic"] = self.quantize_config.dynamic_get(layer_name=layer_name)
+
+                        self.quant_log.append(stat)
+                        logger.info(stat)
+
+                        quantizers[f"{self.layers_node}.{i}.{name}"] = (
+                            gptq[name].quantizer.to(CPU),
+                            move_to(scale, CPU),
+                            move_to(zero, CPU),
+                            move_to(g_idx, CPU),
+                            gptq[name].outliers,
+                            gptq[name].adapter,
+                        )
+                        gptq[name].free()
+
+                    self._apply_previous_weights(full, reused_modules, packed, i)
+
+                out_err_sum = 0.0
+                out_ref_sum = 0.0
+                out_cos_sum = 0.0
+                out_cos_count = 0
+                for j, layer_input, additional_layer_inputs in layer_transfer.batches():
+                    if hasattr(layer, "reuse_kv"):
+                        if layer.reuse_kv:
+                            additional_layer_inputs["kv_last_layer"] = shared_kv_cache_dict.get(i - 1)
+
+                    with torch.no_grad(), trace_span("layer_output_forward", layer=i, batch=j):
+                        layer_output = calibration_forward(layer, layer_input, additional_layer_inputs,
+                                                           calibration_forward_dtype)[0]
+                        # host side outputs go to pinned memory so the next layer can copy them back non-blocking
+                        layer_output = move_to(layer_output, cur_layer_device) if calibration_enable_gpu_cache else to_host(layer_output)
+                        layer_outputs.append([layer_output])
+
+                        if j < len(layer_ref_outputs):
+                            ref = move_to(layer_ref_outputs[j], layer_output.device).float()
+                            out = layer_output.float()
+                            out_err_sum += torch.sum((out - ref) ** 2).item()
+                            out_ref_sum += torch.sum(ref ** 2).item()
+                            cos = torch.nn.functional.cosine_similarity(out, ref, dim=-1)
+                            out_cos_sum += torch.sum(cos).item()
+                            out_cos_count += cos.numel()
+                            del ref, out, cos
+
+                    del layer_input
+                    del additional_layer_inputs
+                    if num_batches > 1 and j == num_batches - 1:
+                        torch_empty_cache()
+
+                if out_cos_count == 0:
+                    break
+
+                out_mse = out_err_sum / max(out_ref_sum, 1e-12)
+                out_cos = out_cos_sum / out_cos_count
+                for stat in self.quant_log[layer_log_start:]:
+                    stat[QUANT_LOG_OUT_MSE] = f"{out_mse:.5f}"
+                    stat[QUANT_LOG_OUT_COS] = f"{out_cos:.5f}"
+                logger.info(f"layer {i} output error: relative mse = {out_mse:.5f}, cosine = {out_cos:.5f}")
+
+                max_mse = self.quantize_config.layer_error_max_mse
+                min_cos = self.quantize_config.layer_error_min_cosine
+                violated = (max_mse is not None and out_mse > max_mse) or (min_cos is not None and out_cos < min_cos)
+                if not violated:
+                    break
+
+                error_msg = (f"layer {i} output error exceeds threshold: relative mse = {out_mse:.5f} (max = {max_mse}), "
+                             f"cosine = {out_cos:.5f} (min = {min_cos})")
+                if retry < layer_error_retries:
+                    retry += 1
+                    logger.warning(f"{error_msg}. Retry {retry} of {layer_error_retries}.")
+
+                    # restore fp weights and drop this layer's quant results before quantizing it again
+                    for n, m in full.items():
+                        m.weight.data = layer_weights_backup[n].to(m.weight.device)
+                    for n, state in layer_awq_backup.items():
+                        layer.get_submodule(n).load_state_dict(state)
+                    for key in [key for key in quantizers if key.startswith(f"{self.layers_node}.{i}.")]:
+                        del quantizers[key]
+                    for key in [key for key in packed if key.startswith(f"{self.layers_node}.{i}.")]:
+                        del packed[key]
+                    del self.quant_log[layer_log_start:]
+                    layer_outputs = []
+
+                    if self.quantize_config.layer_error_retry_bits is not None:
+                        self._override_layer_bits(i, self.quantize_config.layer_error_retry_bits)
                     continue
 
-                def add_batch(name):
-                    def tmp(_, inp: Tuple[torch.Tensor, ...], out: torch.Tensor):
-                        # gptq is mutable.
-                        gptq[name].add_batch(inp[0].data, out.data)  # noqa: F821
+                if self.quantize_config.layer_error_abort:
+                    raise RuntimeError(f"{error_msg}. Quantization aborted.")
 
-                    return tmp
+                logger.warning(error_msg)
+                break
 
-                handle = []
-                for name in subset:
-                    if hasattr(subset[name], 'forward_hook'):
-                        subset[name].forward_hook = add_batch(name)
-                    else:
-                        handle.append(subset[name].register_forward_hook(add_batch(name)))
+            del layer_ref_outputs
+            del layer_weights_backup
+            del layer_awq_backup
+            layer_transfer.release()
+            del layer_transfer
 
-                fwd_start = time.time()
-                for j in range(num_batches):
-                    layer_input = []
-                    for k, layer_inp in enumerate(layer_inputs[j]):
-                        layer_input.append(move_to(layer_inp, cur_layer_device))
+            layers[i] = move_to(layer, CPU)
+            del layer
+            del gptq
+            del layer_inputs
+            layer_inputs, layer_outputs = (
+                layer_outputs,
+                [],
+            )  # TODO: is it really OK to cache only the first positional argument?
+            torch_empty_cache()
 
-                    mask = attention_masks[j]
-                    layer_attention_mask = mask if mask is None else move_to(mask, cur_layer_device)
+        logger.info(f"Quantization summary:\n{self.quant_log}")
+        for module_log in self.quant_log:
+            logger.info(module_log)
+        if task is not None:
+            x = list(range(layer_count))
+            gpu_fig = create_plotly(x=x, y=gpu_memorys, xaxis_title="layer", yaxis_title="GPU usage (GB)")
+            cpu_fig = create_plotly(x=x, y=cpu_memorys, xaxis_title="layer", yaxis_title="CPU usage (GB)")
+            loss_fig = create_plotly(x=module_names, y=avg_losses, xaxis_title="layer", yaxis_title="loss")
+            time_fig = create_plotly(x=module_names, y=durations, xaxis_title="layer", yaxis_title="time")
+            task.get_logger().report_plotly('GPU Memory', 'GPU Memory', gpu_fig)
+            task.get_logger().report_plotly('CPU Memory', 'CPU Memory', cpu_fig)
+            task.get_logger().report_plotly('avg_loss', 'avg_loss', loss_fig)
+            task.get_logger().report_plotly('quant_time', 'quant_time', time_fig)
 
-                    additional_layer_inputs = {"attention_mask": layer_attention_mask}
-                    layer_position_ids = (
-                        None if not position_ids else move_to(position_ids[j], cur_layer_device)
-                    )
-                    if layer_position_ids is not None:
-                        additional_layer_inputs["position_ids"] = layer_position_ids
-                    for k, v in layer_input_kwargs[j].items():
-                        additional_layer_inputs[k] = nested_move_to(v, cur_layer_device)
-
-                    with torch.no_grad():
-                        # reuse_kv is a flag to reuse the kv cache, only for the hamba model
-                        if hasattr(layer, "reuse_kv"):
-                            if layer.reuse_kv:
-                                additional_layer_inputs["kv_last_layer"] = shared_kv_cache_dict.get(i - 1)
-
-                            layer_output = layer(*layer_input, **additional_layer_inputs)
-                            if shared_kv_cache_dict.get(i) is None:
-                                shared_kv_cache_dict[i] = layer_output[-1]
-                        else:
-                            layer(*layer_input, **additional_layer_inputs)
+        self.qlinear_kernel = pack_model(
+            model=self.model,
+            quantizers=quantizers,
+            bits=self.quantize_config.bits,
+            group_size=self.quantize_config.group_size,
+            backend=backend,
+            desc_act=self.quantize_config.desc_act,
+            format=self.quantize_config.format,
+            dynamic=self.quantize_config.dynamic,
+            parallel_packing=self.quantize_config.parallel_packing,
+            outlier_ratio=self.quantize_config.outlier_ratio,
+            adapter_rank=self.quantize_config.adapter_rank,
+            packed=packed,
+        )
+        self._register_online_rotation()
 
-                    del layer_input
-                    del additional_layer_inputs
+        self.model.config.use_cache = forward_pass_use_cache
+
+        self.quantized = True
+        torch_empty_cache()
+
+        return self.quant_log
+
+    def requantize(
+        self,
+        quantize_config: QuantizeConfig,
+        calibration_dataset: Union[List[Dict[str, Union[List[int], torch.LongTensor]]], List[str], List[int]],
+        batch_size: int = 1,
+        calibration_enable_gpu_cache: bool = True,
+        tokenizer: Optional[PreTrainedTokenizerBase] = None,
+        backend: Optional[BACKEND] = BACKEND.AUTO,
+    ) -> List[Dict[str, str]]:
+        """
+        Quantize a model loaded with `from_quantized()` again with a new `quantize_config`, i.e. 4bit -> 3bit or a
+        different `group_size`, without the original fp16 weights. Each layer is dequantized from the source
+        checkpoint right before it is calibrated, so the full model is never held in fp16.
+        """
+        if not self.quantized or not self.load_quantized_model or self.qlinear_kernel is None:
+            raise EnvironmentError("requantize() requires a quantized model loaded by `from_quantized()`.")
+
+        source_config = self.quantize_config
+        if source_config.format not in [FORMAT.GPTQ, FORMAT.GPTQ_V2]:
+            raise ValueError(f"requantize() requires a FORMAT.GPTQ or FORMAT.GPTQ_V2 checkpoint, actual = `{source_config.format}`.")
+        if source_config.lm_head:
+            raise ValueError("requantize() does not support checkpoints with a quantized lm_head.")
+        if isinstance(quantize_config, AutoRoundQuantizeConfig):
+            raise ValueError("requantize() only supports GPTQ quantization.")
+        if quantize_config.rotation is not None and (quantize_config.rotation, quantize_config.rotation_seed) != (
+                source_config.rotation, source_config.rotation_seed):
+            # the source weights are already rotated (or not), they can not be rotated again
+            raise ValueError(f"requantize(): `rotation` = {quantize_config.rotation} (seed {quantize_config.rotation_seed}) "
+                             f"does not match the source checkpoint, actual = {source_config.rotation} (seed {source_config.rotation_seed}).")
+        quantize_config.rotation = source_config.rotation
+        quantize_config.rotation_seed = source_config.rotation_seed
+
+        self._requantize_source = {"config": source_config, "weight_map": checkpoint_tensor_files(self.model_local_path)}
+        self.quantize_config = quantize_config
+        self.quantized = False
+        try:
+            return self.quantize(
+                calibration_dataset,
+                batch_size=batch_size,
+                calibration_enable_gpu_cache=calibration_enable_gpu_cache,
+                tokenizer=tokenizer,
+                backend=backend,
+            )
+        finally:
+            self._requantize_source = None
+
+    def _dequantize_source_layer(self, layer: nn.Module, i: int):
+        # replace the quant linear modules of a layer with nn.Linear holding the dequantized source weights
+        source = self._requantize_source
+        for name, qmodule in find_layers(layer, [BaseQuantLinear]).items():
+            layer_name = f"{self.layers_node}.{i}.{name}"
+            tensors = load_checkpoint_tensors(source["weight_map"], layer_name)
+            if source["config"].format == FORMAT.GPTQ:
+                convert_qzeros_v1_to_v2(tensors["qzeros"], source["config"].bits)
+            meta = self._module_quant_meta(layer_name, source["config"])
+            weight = dequantize_packed_weight(tensors, meta["bits"], meta["group_size"], meta["sym"], meta["desc_act"])
+
+            device = qmodule.qweight.device
+            linear = nn.Linear(qmodule.infeatures, qmodule.outfeatures, bias="bias" in tensors, device="meta")
+            linear.weight = nn.Parameter(weight.to(device), requires_grad=False)
+            if "bias" in tensors:
+                linear.bias = nn.Parameter(tensors["bias"].to(device=device, dtype=weight.dtype), requires_grad=False)
+            recurse_setattr(layer, name, linear)
+        self._register_online_rotation()
+
+    def _module_quant_meta(self, layer_name: str, cfg: Optional[QuantizeConfig] = None) -> Dict[str, Any]:
+        cfg = cfg or self.quantize_config
+        meta = {"bits": cfg.bits, "group_size": cfg.group_size, "sym": cfg.sym, "desc_act": cfg.desc_act}
+        if cfg.dynamic is not None:
+            meta = {k: cfg.dynamic_get(layer_name, k, v) for k, v in meta.items()}
+        return meta
+
+    def _load_previous_quantized(self, path: str) -> Dict[str, Any]:
+        fingerprint_file = os.path.join(path, QUANT_FINGERPRINT_FILENAME)
+        if not os.path.isfile(fingerprint_file):
+            raise ValueError(f"`previous_quantized`: {fingerprint_file} not found, the checkpoint was not saved by a version that records source fingerprints.")
+
+        with open(fingerprint_file, encoding="utf-8") as f:
+            fingerprints = json.load(f)
+        if fingerprints.get("version", QUANT_FINGERPRINT_VERSION) > QUANT_FINGERPRINT_VERSION:
+            raise ValueError(f"`previous_quantized`: unsupported fingerprint version: {fingerprints['version']}")
+
+        previous_config = QuantizeConfig.from_pretrained(path)
+        if previous_config.format not in [FORMAT.GPTQ, FORMAT.GPTQ_V2]:
+            raise ValueError(f"`previous_quantized` must be saved in FORMAT.GPTQ or FORMAT.GPTQ_V2, actual = `{previous_config.format}`.")
+        if previous_config.outlier_ratio != self.quantize_config.outlier_ratio:
+            # reused modules would lose their outlier weights, the new quant linears have no outlier buffers
+            raise ValueError(f"`previous_quantized` was saved with outlier_ratio = {previous_config.outlier_ratio}, "
+                             f"actual = {self.quantize_config.outlier_ratio}.")
+        if previous_config.adapter_rank != self.quantize_config.adapter_rank:
+            # same for the `adapter_a·adapter_b` correction
+            raise ValueError(f"`previous_quantized` was saved with adapter_rank = {previous_config.adapter_rank}, "
+                             f"actual = {self.quantize_config.adapter_rank}.")
+
+        logger.info(f"Reusing unchanged modules of {path}")
+        return {
+            "modules": fingerprints["modules"],
+            "config": previous_config,
+            "weight_map": checkpoint_tensor_files(path),
+        }
+
+    def _load_previous_module(self, previous: Dict[str, Any], layer_name: str) -> Dict[str, torch.Tensor]:
+        tensors = load_checkpoint_tensors(previous["weight_map"], layer_name)
+        if "qweight" not in tensors:
+            raise ValueError(f"`previous_quantized`: no quantized tensors found for `{layer_name}`.")
+        if previous["config"].format == FORMAT.GPTQ:
+            # v1 checkpoints are written with the global bits, mirror `convert_gptq_v2_to_v1_format`
+            convert_qzeros_v1_to_v2(tensors["qzeros"], previous["config"].bits)
+        return tensors
+
+    def _apply_previous_weights(self, full: Dict[str, nn.Module], names: List[str], packed: Dict, i: int):
+        # reused modules get their dequantized weight so the inputs of later subsets and layers match
+        for name in names:
+            layer_name = f"{self.layers_node}.{i}.{name}"
+            module = full[name]
+            meta = self._module_quant_meta(layer_name)
+            weight = dequantize_packed_weight(packed[layer_name], meta["bits"], meta["group_size"], meta["sym"], meta["desc_act"])
+            if isinstance(module, transformers.pytorch_utils.Conv1D):
+                weight = weight.t()
+            module.weight.data = weight.reshape(module.weight.shape).to(device=module.weight.device, dtype=module.weight.dtype)
+
+    def _quantize_calibration_free_layer(self, i: int, layer: nn.Module, layer_modules: List[List[str]]):
+        if self._requantize_source is not None:
+            self._dequantize_source_layer(layer, i)
+        if get_device(layer) == CPU and self.quantize_config.device != CPU:
+            move_to(layer, self.quantize_config.device)
+        full = find_layers(layer)
+
+        quantizers = {}
+        stats = []
+        for names in layer_modules:
+            for name in names:
+                if name not in full:
+                    continue
+
+                layer_name = f"{self.layers_node}.{i}.{name}"
+                bits = self.quantize_config.bits
+                sym = self.quantize_config.sym
+                group_size = self.quantize_config.group_size
+                if self.quantize_config.dynamic is not None:
+                    if self.quantize_config.dynamic_get(layer_name=layer_name) == False: # noqa: E712
+                        logger.info(f"skip module: {layer_name}")
+                        continue
+
+                    bits = self.quantize_config.dynamic_get(layer_name, "bits", bits)
+                    sym = self.quantize_config.dynamic_get(layer_name, "sym", sym)
+                    group_size = self.quantize_config.dynamic_get(layer_name, "group_size", group_size)
+
+                start = time.time()
+                module = full[name]
+                W = module.weight.data
+                if isinstance(module, transformers.pytorch_utils.Conv1D):
+                    W = W.t()
+                W = W.flatten(1)
+                Q, scale, zero, g_idx = rtn_quantize(W, bits, group_size, sym, mse=self.quantize_config.mse,
+                                                     method=self.quantize_config.method,
+                                                     hqq_iters=self.quantize_config.hqq_iters)
+                loss = torch.mean((Q - W.float()) ** 2).item()
+                if isinstance(module, transformers.pytorch_utils.Conv1D):
+                    Q = Q.t()
+                # packing rounds the module weight again, it has to be on the quantization grid
+                module.weight.data = Q.reshape(module.weight.shape).to(module.weight.dtype)
+
+                stat = {QUANT_LOG_LAYER: i, QUANT_LOG_MODULE: name, QUANT_LOG_LOSS: f"{loss:.8f}",
+                        QUANT_LOG_DAMP: "0.00000", QUANT_LOG_TIME: f"{time.time() - start:.3f}", QUANT_LOG_FWD_TIME: "0.000"}
+                if self.quantize_config.dynamic is not None:
+                    stat["dynamic"] = self.quantize_config.dynamic_get(layer_name=layer_name)
+                stats.append(stat)
+                quantizers[layer_name] = (None, move_to(scale, CPU), move_to(zero, CPU), move_to(g_idx, CPU))
+
+        move_to(layer, CPU)
+        return quantizers, stats
+
+    def _quantize_calibration_free(self, backend: BACKEND) -> List[Dict[str, str]]:
+        # weights only, layers are independent and quantized on a thread pool
+        layers = get_module_by_name_prefix(self.model, self.layers_node)
+        layer_modules = self.get_layer_modules()
+        quantizers = {}
+
+        layer_pb = ProgressBar(range(len(layers)))
+        with ThreadPoolExecutor(max_workers=self.quantize_config.workers) as executor:
+            results = executor.map(lambda i: self._quantize_calibration_free_layer(i, layers[i], layer_modules),
+                                   range(len(layers)))
+            for i, (layer_quantizers, stats) in zip(layer_pb, results):
+                layer_pb.set_description(f"Quantizing layer {i} of {len(layers) - 1}")
+                quantizers.update(layer_quantizers)
+                for stat in stats:
+                    self.quant_log.append(stat)
+                    logger.info(stat)
+        torch_empty_cache()
+
+        self.qlinear_kernel = pack_model(
+            model=self.model,
+            quantizers=quantizers,
+            bits=self.quantize_config.bits,
+            group_size=self.quantize_config.group_size,
+            backend=backend,
+            desc_act=self.quantize_config.desc_act,
+            format=self.quantize_config.format,
+            dynamic=self.quantize_config.dynamic,
+            parallel_packing=self.quantize_config.parallel_packing,
+        )
+        self._register_online_rotation()
+
+        self.quantized = True
+        torch_empty_cache()
+
+        return self.quant_log
+
+    def _layer_error_batches(self, num_batches: int) -> int:
+        # number of leading calibration batches held out of the hessians for the layer error check
+        return max(min(self.quantize_config.layer_error_batches, num_batches - 1), 0)
+
+    def _override_layer_bits(self, i: int, bits: int):
+        """
+        Quantizes layer `i` with `bits` through `dynamic`, so packing and the saved config pick them up. Only `bits`
+        is overridden: every positive rule gets a copy restricted to layer `i` right before it, which keeps the other
+        keys of the rule (i.e. `group_size`), and modules of the layer matching no rule get a layer wide rule last.
+        Negative (skip) rules keep their order.
+        """
+        layer_prefix = rf"{re.escape(self.layers_node)}\.{i}\."
+        layer_only = f"(?={layer_prefix})"
+        layer_wide = f"^{layer_prefix}"
+
+        dynamic = {}
+        for pattern, rule in (self.quantize_config.dynamic or {}).items():
+            if pattern.startswith("-:"):
+                dynamic[pattern] = rule
+            elif pattern.startswith(layer_only):
+                # copy of a previous retry
+                dynamic[pattern] = {**rule, "bits": bits}
+            elif pattern != layer_wide:
+                dynamic[layer_only + pattern.removeprefix("+:")] = {**rule, "bits": bits}
+                dynamic[pattern] = rule
+        dynamic[layer_wide] = {"bits": bits}
+        self.quantize_config.dynamic = dynamic
+
+    @torch.no_grad()
+    def _awq_scale_subset(self, layer: nn.Module, full: Dict[str, nn.Module], names: List[str], gptq: Dict[str, GPTQ],
+                          solve_kwargs: Dict[str, Dict[str, Any]], quantizers: Dict[str, Tuple], i: int):
+        # searches awq scales of a subset's inputs on its hessians and folds them into the modules producing the inputs.
+        # a subset (i.e. all modules of a layer with true_sequential=False) may read the outputs of several producers,
+        # every producer gets its own scales
+        groups = {}
+        for name in names:
+            if name in self.awq_scale_targets:
+                groups.setdefault(self.awq_scale_targets[name], []).append(name)
+
+        for target_name, consumers in groups.items():
+            self._awq_scale_group(layer, full, target_name, consumers, gptq, solve_kwargs, quantizers, i)
+
+    def _awq_scale_group(self, layer: nn.Module, full: Dict[str, nn.Module], target_name: str, names: List[str],
+                         gptq: Dict[str, GPTQ], solve_kwargs: Dict[str, Dict[str, Any]], quantizers: Dict[str, Tuple],
+                         i: int):
+        # modules in `names` read the outputs of `target_name`
+        solved = [n for n in names if n in gptq]
+        if len(solved) == 0:
+            return
+        if self.quantize_config.rotation is not None and any(n in self.rotation_online for n in names):
+            # inputs are hadamard transformed online, channels of the producer no longer match them
+            return
+        target = layer.get_submodule(target_name)
+        if target.weight.shape[0] != gptq[solved[0]].columns:
+            # i.e. grouped query attention: v_proj has fewer output channels than o_proj inputs
+            return
 
-                fwd_end = time.time()
-                fwd_time = fwd_end - fwd_start
+        s, alpha = search_awq_scales([gptq[n] for n in solved], [solve_kwargs[n]["group_size"] for n in solved],
+                                     self.quantize_config.awq_grid)
+        logger.info(f"layer {i} awq scales of {solved}: alpha = {alpha:.2f}")
+        if alpha == 0:
+            return
+
+        for name in names:
+            if name in gptq:
+                gptq[name].scale_inputs(s)
+            elif name in full:
+                weight = full[name].weight.data
+                full[name].weight.data = (weight.float() * s.to(weight.device)).to(weight.dtype)
+
+        weight = target.weight.data
+        rows = s.to(weight.device).reshape(-1, *([1] * (weight.dim() - 1)))
+        target.weight.data = (weight.float() / rows).to(weight.dtype)
+        if getattr(target, "bias", None) is not None:
+            target.bias.data = (target.bias.data.float() / s.to(target.bias.device)).to(target.bias.dtype)
+
+        target_layer_name = f"{self.layers_node}.{i}.{target_name}"
+        if target_layer_name in quantizers:
+            # the producer is already quantized, its per row scales absorb s exactly
+            quantizer, scale, zero, g_idx, outliers, adapter = quantizers[target_layer_name]
+            s = s.to(CPU)
+            if outliers is not None:
+                outlier_rows = torch.repeat_interleave(torch.arange(outliers.shape[0]), outliers.crow_indices().diff())
+                values = outliers.values()
+                outliers = torch.sparse_csr_tensor(outliers.crow_indices(), outliers.col_indices(),
+                                                   (values.float() / s[outlier_rows]).to(values.dtype), size=outliers.shape)
+            if adapter is not None:
+                adapter = (adapter[0] / s.unsqueeze(1), adapter[1])
+            quantizers[target_layer_name] = (quantizer, scale / s.unsqueeze(1), zero, g_idx, outliers, adapter)
+
+    def _register_online_rotation(self):
+        # modules replaced by hooked or quant linears lose the online hadamard transform of rotated models
+        if self.quantize_config.rotation is not None:
+            register_online_rotation(self.model, self, self.quantize_config.rotation_seed)
+
+    def _quantize_with_hessians(self, hessians: Union[str, Dict, HessianCollector], backend: BACKEND) -> List[Dict[str, str]]:
+        hessians = load_hessians(hessians)
 
-                for h in handle:
-                    h.remove()
+        layers = get_module_by_name_prefix(self.model, self.layers_node)
+        layer_modules = self.get_layer_modules()
+        quantizers = {}
 
-                for name in subset:
-                    if hasattr(subset[name], 'forward_hook'):
-                        subset[name].forward_hook = None
+        hessian_block_size = self.quantize_config.hessian_block_size
+        if hessian_block_size is None:
+            hessian_block_size = self.quantize_config.group_size if self.quantize_config.group_size > 0 else 128
 
-                if index == len(layer_modules) - 1:
-                    torch_empty_cache()
+        layer_pb = ProgressBar(range(len(layers)))
+        for i in layer_pb:
+            layer = layers[i]
+            if get_device(layer) == CPU and self.quantize_config.device != CPU:
+                move_to(layer, self.quantize_config.device)
+            full = find_layers(layer)
 
-                for name_index, name in enumerate(subset):
-                    layer_pb.set_description(f"Quantizing {name} in layer {i} of {layer_count - 1}")
+            for names in layer_modules:
+                for name in names:
+                    if name not in full:
+                        continue
 
+                    layer_name = f"{self.layers_node}.{i}.{name}"
+                    bits = self.quantize_config.bits
+                    sym = self.quantize_config.sym
                     group_size = self.quantize_config.group_size
                     desc_act = self.quantize_config.desc_act
                     if self.quantize_config.dynamic is not None:
-                        layer_name = f"{self.layers_node}.{i}.{name}"
+                        if self.quantize_config.dynamic_get(layer_name=layer_name) == False: # noqa: E712
+                            logger.info(f"skip module: {layer_name}")
+                            continue
+
+                        bits = self.quantize_config.dynamic_get(layer_name, "bits", bits)
+                        sym = self.quantize_config.dynamic_get(layer_name, "sym", sym)
                         group_size = self.quantize_config.dynamic_get(layer_name, "group_size", group_size)
                         desc_act = self.quantize_config.dynamic_get(layer_name, "desc_act", desc_act)
 
-                    scale, zero, g_idx, duration, avg_loss, damp_percent = gptq[name].quantize(
+                    if layer_name not in hessians["hessians"]:
+                        raise ValueError(f"No hessian was captured for module `{layer_name}`.")
+
+                    nsamples = hessians["nsamples"][layer_name]
+                    if nsamples == 0:
+                        logger.warning(f"Module `{layer_name}` received no tokens during hessian capture.")
+
+                    layer_pb.set_description(f"Quantizing {name} in layer {i} of {len(layers) - 1}")
+                    gptq = GPTQ(
+                        full[name],
+                        hessian_accumulation=self.quantize_config.hessian_accumulation,
+                        hessian_mode=self.quantize_config.hessian_mode,
+                        hessian_block_size=hessian_block_size,
+                        hessian_rank=self.quantize_config.hessian_rank,
+                    )
+                    gptq.quantizer.configure(bits, perchannel=True, sym=sym, mse=self.quantize_config.mse,
+                                             mse_search_step=self.quantize_config.mse_search_step)
+                    # collector stores the raw sum of xᵀx, add_hessian() projects it into the configured hessian mode
+                    gptq.add_hessian(hessians["hessians"][layer_name].to(gptq.device), max(nsamples, 1))
+
+                    scale, zero, g_idx, duration, avg_loss, damp_percent = gptq.quantize(
+                        blocksize=self.quantize_config.solver_blocksize,
                         percdamp=self.quantize_config.damp_percent,
                         group_size=group_size,
                         actorder=desc_act,
                         static_groups=self.quantize_config.static_groups,
+                        sparsity=self.quantize_config.sparsity,
+                        prune_n=self.quantize_config.prune_n,
+                        prune_m=self.quantize_config.prune_m,
+                        outlier_ratio=self.quantize_config.outlier_ratio,
+                        adapter_rank=self.quantize_config.adapter_rank,
                     )
-                    if task is not None:
-                        task.get_logger().report_scalar(
-                            title='Quantization Loss',
-                            series=f'layer_{i}_loss',
-                            value=avg_loss,
-                            iteration=name_index,
-                        )
-
-                        task.get_logger().report_scalar(
-                            title='Quantization Time',
-                            series=f'layer_{i}_time',
-                            value=duration,
-                            iteration=name_index,
-                        )
-                    durations.append(duration)
-                    avg_losses.append(avg_loss)
-                    module_names.append(f"layer-{i}-{name}")
 
                     stat = {QUANT_LOG_LAYER: i, QUANT_LOG_MODULE: name, QUANT_LOG_LOSS: f"{avg_loss:.5f}",
-                            QUANT_LOG_DAMP: f"{damp_percent:.5f}", QUANT_LOG_TIME: f"{duration:.3f}", QUANT_LOG_FWD_TIME: f"{fwd_time:.3f}"}
+                            QUANT_LOG_DAMP: f"{damp_percent:.5f}", QUANT_LOG_TIME: f"{duration:.3f}", QUANT_LOG_FWD_TIME: "0.000",
+                            QUANT_LOG_FACTORIZATIONS: gptq.factorizations, QUANT_LOG_DAMP_TIME: f"{gptq.damp_time:.3f}"}
                     if self.quantize_config.dynamic is not None:
                         stat["dynamic"] = self.quantize_config.dynamic_get(layer_name=layer_name)
-
                     self.quant_log.append(stat)
                     logger.info(stat)
 
-                    quantizers[f"{self.layers_node}.{i}.{name}"] = (
-                        gptq[name].quantizer.to(CPU),
+                    quantizers[layer_name] = (
+                        gptq.quantizer.to(CPU),
                         move_to(scale, CPU),
                         move_to(zero, CPU),
                         move_to(g_idx, CPU),
+                        gptq.outliers,
+                        gptq.adapter,
                     )
-                    gptq[name].free()
-
-            for j in range(num_batches):
-                layer_input = []
-                for k, layer_inp in enumerate(layer_inputs[j]):
-                    layer_input.append(move_to(layer_inp, cur_layer_device))
-
-                mask = attention_masks[j]
-                layer_attention_mask = mask if mask is None else move_to(mask, cur_layer_device)
-
-                additional_layer_inputs = {"attention_mask": layer_attention_mask}
-                layer_position_ids = None if not position_ids else move_to(position_ids[j], cur_layer_device)
-                if layer_position_ids is not None:
-                    additional_layer_inputs["position_ids"] = layer_position_ids
-                for k, v in layer_input_kwargs[j].items():
-                    additional_layer_inputs[k] = nested_move_to(v, cur_layer_device)
-
-                if hasattr(layer, "reuse_kv"):
-                    if layer.reuse_kv:
-                        additional_layer_inputs["kv_last_layer"] = shared_kv_cache_dict.get(i - 1)
-
-                with torch.no_grad():
-                    layer_output = move_to(
-                        layer(*layer_input, **additional_layer_inputs)[0],
-                        cur_layer_device if calibration_enable_gpu_cache else CPU,
-                    )
-                    layer_outputs.append([layer_output])
-
-                del layer_input
-                del additional_layer_inputs
-                if num_batches > 1 and j == num_batches - 1:
-                    torch_empty_cache()
-
+                    gptq.free()
 
             layers[i] = move_to(layer, CPU)
-            del layer
-            del gptq
-            del layer_inputs
-            layer_inputs, layer_outputs = (
-                layer_outputs,
-                [],
-            )  # TODO: is it really OK to cache only the first positional argument?
             torch_empty_cache()
 
-        logger.info(f"Quantization summary:\n{self.quant_log}")
-        for module_log in self.quant_log:
-            logger.info(module_log)
-        if task is not None:
-            x = list(range(layer_count))
-            gpu_fig = create_plotly(x=x, y=gpu_memorys, xaxis_title="layer", yaxis_title="GPU usage (GB)")
-            cpu_fig = create_plotly(x=x, y=cpu_memorys, xaxis_title="layer", yaxis_title="CPU usage (GB)")
-            loss_fig = create_plotly(x=module_names, y=avg_losses, xaxis_title="layer", yaxis_title="loss")
-            time_fig = create_plotly(x=module_names, y=durations, xaxis_title="layer", yaxis_title="time")
-            task.get_logger().report_plotly('GPU Memory', 'GPU Memory', gpu_fig)
-            task.get_logger().report_plotly('CPU Memory', 'CPU Memory', cpu_fig)
-            task.get_logger().report_plotly('avg_loss', 'avg_loss', loss_fig)
-            task.get_logger().report_plotly('quant_time', 'quant_time', time_fig)
-
         self.qlinear_kernel = pack_model(
             model=self.model,
             quantizers=quantizers,
@@ -733,10 +1464,10 @@ class BaseGPTQModel(nn.Module):
             format=self.quantize_config.format,
             dynamic=self.quantize_config.dynamic,
             parallel_packing=self.quantize_config.parallel_packing,
+            outlier_ratio=self.quantize_config.outlier_ratio,
+            adapter_rank=self.quantize_config.adapter_rank,
         )
 
-        self.model.config.use_cache = forward_pass_use_cache
-
         self.quantized = True
         torch_empty_cache()
 
@@ -20,3 +20,21 @@ class LlamaGPTQ(BaseGPTQModel):
         ["mlp.up_proj", "mlp.gate_proj"],
         ["mlp.down_proj"],
     ]
+
+    rotation_norms = {
+        "input_layernorm": ["self_attn.q_proj", "self_attn.k_proj", "self_attn.v_proj"],
+        "post_attention_layernorm": ["mlp.up_proj", "mlp.gate_proj"],
+    }
+    rotation_outputs = ["self_attn.o_proj", "mlp.down_proj"]
+    rotation_online = ["mlp.down_proj"]
+    rotation_final_norm = "model.norm"
+
+    awq_scale_targets = {
+        "self_attn.k_proj": "input_layernorm",
+        "self_attn.v_proj": "input_layernorm",
+        "self_attn.q_proj": "input_layernorm",
+        "self_attn.o_proj": "self_attn.v_proj",
+        "mlp.up_proj": "post_attention_layernorm",
+        "mlp.gate_proj": "post_attention_layernorm",
+        "mlp.down_proj": "mlp.up_proj",
+    }
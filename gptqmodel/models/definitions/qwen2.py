@@ -1,4 +1,5 @@
 from ..base import BaseGPTQModel
+from .llama import LlamaGPTQ
 
 
 class Qwen2GPTQ(BaseGPTQModel):
@@ -12,3 +13,11 @@ class Qwen2GPTQ(BaseGPTQModel):
         ["mlp.up_proj", "mlp.gate_proj"],
         ["mlp.down_proj"],
     ]
+
+    # same decoder layer as llama
+    rotation_norms = LlamaGPTQ.rotation_norms
+    rotation_outputs = LlamaGPTQ.rotation_outputs
+    rotation_online = LlamaGPTQ.rotation_online
+    rotation_final_norm = LlamaGPTQ.rotation_final_norm
+
+    awq_scale_targets = LlamaGPTQ.awq_scale_targets
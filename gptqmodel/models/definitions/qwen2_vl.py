@@ -6,10 +6,13 @@ from PIL import Image
 from transformers import AutoModelForVision2Seq, AutoProcessor, AutoTokenizer
 
 from ...utils.calibration import batched
-from ...utils.image import extract_vision_info, fetch_image
+from ...utils.image import ProcessedBatchCache, extract_vision_info, fetch_images, image_fingerprint, process_batches
+from ...utils.logger import setup_logger
 from ...utils.model import MODALITY
 from ..base import BaseGPTQModel
 
+logger = setup_logger()
+
 
 class Qwen2VLGPTQ(BaseGPTQModel):
     loader = AutoModelForVision2Seq
@@ -60,18 +63,24 @@ class Qwen2VLGPTQ(BaseGPTQModel):
         }
     }
 
+    @staticmethod
+    def image_infos(conversations: list[dict] | list[list[dict]]) -> list[dict]:
+        # vision entries of the conversations, all of them must be images (i.e. no videos)
+        vision_infos = extract_vision_info(conversations)
+        for vision_info in vision_infos:
+            if "image" not in vision_info and "image_url" not in vision_info:
+                raise ValueError("image, image_url should in content.")
+        return vision_infos
+
     @staticmethod
     def process_vision_info(
             conversations: list[dict] | list[list[dict]],
+            vision_infos: Optional[list[dict]] = None,
     ) -> Optional[list[Image.Image]]:
-        vision_infos = extract_vision_info(conversations)
+        if vision_infos is None:
+            vision_infos = Qwen2VLGPTQ.image_infos(conversations)
         # Read images
-        image_inputs = []
-        for vision_info in vision_infos:
-            if "image" in vision_info or "image_url" in vision_info:
-                image_inputs.append(fetch_image(vision_info))
-            else:
-                raise ValueError("image, image_url should in content.")
+        image_inputs = fetch_images(vision_infos)
         if len(image_inputs) == 0:
             image_inputs = None
         return image_inputs
@@ -98,12 +107,26 @@ class Qwen2VLGPTQ(BaseGPTQModel):
             with open(os.path.join(tmp_dir, "preprocessor_config.json"), "w") as f:
                 f.write(json.dumps(self.quant_override_files["preprocessor_config.json"]))
             processor = AutoProcessor.from_pretrained(tmp_dir)
-        calib_data = []
-        for batch in batched(calibration_dataset, batch_size, process_func=self.preprocess_dataset):
+
+        cache = None
+        if self.quantize_config.calibration_cache_dir is not None:
+            cache = ProcessedBatchCache(self.quantize_config.calibration_cache_dir, namespace=self.__class__.__name__)
+            processor_config = json.dumps(self.quant_override_files["preprocessor_config.json"], sort_keys=True)
+
+        def process(batch):
             text = processor.apply_chat_template(
                 batch, tokenize=False, add_generation_prompt=True
             )
-            image_inputs = self.process_vision_info(batch)
+            # validated before fingerprinting, unsupported entries raise the same error with and without a cache
+            vision_infos = self.image_infos(batch)
+            if cache is not None:
+                key = cache.key(processor_config, tokenizer.name_or_path, len(tokenizer), text,
+                                [image_fingerprint(v) for v in vision_infos])
+                inputs = cache.get(key)
+                if inputs is not None:
+                    return inputs
+
+            image_inputs = self.process_vision_info(batch, vision_infos)
             inputs = processor(
                 text=text,
                 images=image_inputs,
@@ -111,6 +134,13 @@ class Qwen2VLGPTQ(BaseGPTQModel):
                 padding=True,
                 return_tensors="pt",
             )
-            calib_data.append(inputs)
+            if cache is not None:
+                cache.put(key, inputs)
+            return inputs
+
+        # batches are decoded and processed on a thread pool, image decode overlaps with tokenization
+        calib_data = process_batches(batched(calibration_dataset, batch_size, process_func=self.preprocess_dataset), process)
+        if cache is not None:
+            logger.info(f"Calibration cache {cache.cache_dir}: {cache.hits} hits, {cache.misses} misses")
         del processor
         return calib_data
@@ -17,6 +17,7 @@ from ..nn_modules.qlinear.exllamav2 import ExllamaV2QuantLinear
 from ..nn_modules.qlinear.ipex import IPEXQuantLinear
 from ..quantization import QuantizeConfig
 from ..quantization.config import FORMAT, FORMAT_FIELD_JSON, MIN_VERSION_WITH_V2
+from ..quantization.rotation import register_online_rotation
 from ..utils.backend import BACKEND
 from ..utils.importer import auto_select_device, normalize_device_device_map, select_quant_linear
 from ..utils.logger import setup_logger
@@ -267,6 +268,10 @@ def ModelLoader(cls):
         if backend == BACKEND.VLLM or backend == BACKEND.SGLANG:
             if quantize_config.format != FORMAT.GPTQ:
                 raise ValueError(f"{backend} backend only supports FORMAT.GPTQ: actual = {quantize_config.format}")
+            if quantize_config.rotation is not None:
+                raise ValueError(f"{backend} backend does not apply the online hadamard transforms of rotated models.")
+            if quantize_config.adapter_rank > 0:
+                raise ValueError(f"{backend} backend does not apply the low rank adapters of `adapter_rank` models.")
             if backend == BACKEND.VLLM:
                 from ..utils.vllm import load_model_by_vllm, vllm_generate
 
@@ -409,6 +414,8 @@ def ModelLoader(cls):
                 desc_act=quantize_config.desc_act,
                 dynamic=quantize_config.dynamic,
                 device=device,
+                outlier_ratio=quantize_config.outlier_ratio,
+                adapter_rank=quantize_config.adapter_rank,
             )
             if preload_qlinear_kernel == IPEXQuantLinear:
                 quantize_config.runtime_format = FORMAT.IPEX
@@ -515,6 +522,7 @@ def ModelLoader(cls):
             backend=backend,
             format=quantize_config.format,
             device=device,
+            outliers=quantize_config.outlier_ratio > 0,
         )
 
         # == step4: set seqlen == #
@@ -532,6 +540,11 @@ def ModelLoader(cls):
         # Any post-initialization that require device information, for example buffers initialization on device.
         model = gptqmodel_post_init(model, use_act_order=quantize_config.desc_act, quantize_config=quantize_config)
 
+        if quantize_config.rotation is not None:
+            if cls.rotation_norms is None:
+                raise NotImplementedError(f"{cls.__name__} does not support QuantizeConfig.rotation.")
+            register_online_rotation(model, cls, quantize_config.rotation_seed)
+
         model.eval()
 
         tokenizer = get_tokenizer(model_id_or_path, config=config, trust_remote_code=trust_remote_code)
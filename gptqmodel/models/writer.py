@@ -19,13 +19,15 @@ from transformers.modeling_utils import no_init_weights
 from transformers.utils.generic import ContextManagers
 
 from ..quantization.config import (FORMAT, META_FIELD_DAMP_AUTO_INCREMENT, META_FIELD_DAMP_PERCENT, META_FIELD_MSE,
-                                   META_FIELD_QUANTIZER, META_FIELD_STATIC_GROUPS, META_FIELD_TRUE_SEQUENTIAL,
-                                   META_FIELD_URI, META_QUANTIZER_GPTQMODEL, META_VALUE_URI, MIN_VERSION_WITH_V2)
+                                   META_FIELD_QUANTIZER, META_FIELD_SPARSITY, META_FIELD_SPARSITY_PATTERN,
+                                   META_FIELD_STATIC_GROUPS, META_FIELD_TRUE_SEQUENTIAL, META_FIELD_URI,
+                                   META_QUANTIZER_GPTQMODEL, META_VALUE_URI, MIN_VERSION_WITH_V2)
 from ..utils.backend import BACKEND
 from ..utils.logger import setup_logger
 from ..utils.model import (convert_gptq_v2_to_v1_format, copy_py_files, find_layers,
                            get_model_files_size, get_moe_layer_modules, make_quant)
 from ..utils.torch import torch_empty_cache
+from ..utils.trace import trace_span
 from ..version import __version__
 from ._const import CPU
 
@@ -37,6 +39,15 @@ QUANT_LOG_LOSS = "loss"
 QUANT_LOG_DAMP = "damp"
 QUANT_LOG_TIME = "time"
 QUANT_LOG_FWD_TIME = "fwd_time"
+QUANT_LOG_OUT_MSE = "out_mse"
+QUANT_LOG_OUT_COS = "out_cos"
+QUANT_LOG_TOKENS = "tokens"
+QUANT_LOG_FACTORIZATIONS = "factorizations"
+QUANT_LOG_DAMP_TIME = "damp_time"
+
+# source weight fingerprints of quantized modules, used by `quantize(previous_quantized=...)`
+QUANT_FINGERPRINT_FILENAME = "quant_fingerprints.json"
+QUANT_FINGERPRINT_VERSION = 1
 
 def ModelWriter(cls):
 
@@ -63,9 +74,14 @@ def ModelWriter(cls):
         if self.quant_log:
             with open(os.path.join(save_dir, "quant_log.csv"), mode='w', newline='') as file:
                 w = csv.writer(file)
-                w.writerow([QUANT_LOG_LAYER, QUANT_LOG_MODULE, QUANT_LOG_LOSS, QUANT_LOG_DAMP, QUANT_LOG_TIME])
+                w.writerow([QUANT_LOG_LAYER, QUANT_LOG_MODULE, QUANT_LOG_LOSS, QUANT_LOG_DAMP, QUANT_LOG_TIME,
+                            QUANT_LOG_OUT_MSE, QUANT_LOG_OUT_COS, QUANT_LOG_TOKENS, QUANT_LOG_FACTORIZATIONS,
+                            QUANT_LOG_DAMP_TIME])
                 w.writerows([[entry.get(QUANT_LOG_LAYER), entry.get(QUANT_LOG_MODULE), entry.get(QUANT_LOG_LOSS),
-                              entry.get(QUANT_LOG_DAMP), entry.get(QUANT_LOG_TIME)] for entry in self.quant_log])
+                              entry.get(QUANT_LOG_DAMP), entry.get(QUANT_LOG_TIME), entry.get(QUANT_LOG_OUT_MSE),
+                              entry.get(QUANT_LOG_OUT_COS), entry.get(QUANT_LOG_TOKENS),
+                              entry.get(QUANT_LOG_FACTORIZATIONS), entry.get(QUANT_LOG_DAMP_TIME)]
+                             for entry in self.quant_log])
 
         pre_quantized_size_mb = get_model_files_size(self.model_local_path)
         pre_quantized_size_gb = pre_quantized_size_mb / 1024
@@ -113,6 +129,25 @@ def ModelWriter(cls):
             value=self.quantize_config.mse
         )
 
+        if self.quantize_config.prune_n:
+            self.quantize_config.meta_set(
+                key=META_FIELD_SPARSITY,
+                value=self.quantize_config.prune_n / self.quantize_config.prune_m
+            )
+            self.quantize_config.meta_set(
+                key=META_FIELD_SPARSITY_PATTERN,
+                value=f"{self.quantize_config.prune_n}:{self.quantize_config.prune_m}"
+            )
+        elif self.quantize_config.sparsity > 0:
+            self.quantize_config.meta_set(
+                key=META_FIELD_SPARSITY,
+                value=self.quantize_config.sparsity
+            )
+            self.quantize_config.meta_set(
+                key=META_FIELD_SPARSITY_PATTERN,
+                value="unstructured"
+            )
+
 
         # The config, quantize_config and model may be edited in place in save_quantized.
         config = copy.deepcopy(self.model.config)
@@ -202,7 +237,8 @@ def ModelWriter(cls):
             # Format is required to enable Accelerate to load the metadata
             # otherwise it raises an OSError
             safetensors_metadata["format"] = "pt"
-            safe_save(state_dict, join(save_dir, model_save_name), safetensors_metadata)
+            with trace_span("write_shard", category="save", file=model_save_name):
+                safe_save(state_dict, join(save_dir, model_save_name), safetensors_metadata)
             total_size_mb = os.path.getsize(join(save_dir, model_save_name)) / (1024 * 1024)
         else:
             file_name_pattern = SAFETENSORS_WEIGHTS_FILE_PATTERN
@@ -260,7 +296,8 @@ def ModelWriter(cls):
                 # otherwise it raises an OSError
                 safetensors_metadata["format"] = "pt"
 
-                safe_save(shard, join(save_dir, filename), safetensors_metadata)
+                with trace_span("write_shard", category="save", file=filename):
+                    safe_save(shard, join(save_dir, filename), safetensors_metadata)
                 shard_size_mb = os.path.getsize(join(save_dir, filename)) / (1024 * 1024)
                 total_size_mb += shard_size_mb
 
@@ -292,6 +329,10 @@ def ModelWriter(cls):
 
         quantize_config.save_pretrained(save_dir)
 
+        if self.quant_source_fingerprints:
+            with open(join(save_dir, QUANT_FINGERPRINT_FILENAME), "w", encoding="utf-8") as f:
+                json.dump({"version": QUANT_FINGERPRINT_VERSION, "modules": self.quant_source_fingerprints}, f, indent=2)
+
         # need to copy .py files for model/tokenizers not yet merged to HF transformers
         if self.trust_remote_code:
             copy_py_files(save_dir, model_id_or_path=self.model_local_path)
@@ -348,6 +389,8 @@ def ModelWriter(cls):
                 format=quantize_config.format,
                 desc_act=quantize_config.desc_act,
                 pack=True,
+                outlier_ratio=quantize_config.outlier_ratio,
+                adapter_rank=quantize_config.adapter_rank,
             )
             model.tie_weights()
 
@@ -1,6 +1,7 @@
 import sys
 from typing import List, Optional, Tuple, Union
 
+import torch
 import torch.nn as nn
 
 from ...models._const import DEVICE, PLATFORM
@@ -16,10 +17,17 @@ class BaseQuantLinear(nn.Module):
     SUPPORTS_AUTO_PADDING: bool = None
     SUPPORTS_IN_FEATURES_DIVISIBLE_BY: List[int] = None
     SUPPORTS_OUT_FEATURES_DIVISIBLE_BY: List[int] = None
+    # fp16 outlier side matrix of `outlier_ratio` quantization, see register_outliers()
+    SUPPORTS_OUTLIERS: bool = None
 
     SUPPORTS_DEVICES: List[DEVICE] = None
     SUPPORTS_PLATFORM: List[PLATFORM] = None
 
+    # number of outlier weights kept next to the quantized weight, set by register_outliers()
+    outlier_count: int = 0
+    # rank of the low rank quantization error adapter, set by register_adapter()
+    adapter_rank: int = 0
+
     def __init__(self, bits: int, group_size: int, desc_act: bool, sym: bool, infeatures: int, outfeatures: int, *args,
                  **kwargs):
         super().__init__()
@@ -30,11 +38,11 @@ class BaseQuantLinear(nn.Module):
     @classmethod
     # custom quant linear class can override this and add custom checks
     def validate(cls, bits: int, group_size: int, desc_act: bool, sym: bool, infeatures:int=None,
-                  outfeatures:int=None, dynamic:Optional[dict]=None, device:Optional[DEVICE]=None, trainable:Optional[bool]=None) -> Tuple[
-        bool, Optional[Exception]]:
+                  outfeatures:int=None, dynamic:Optional[dict]=None, device:Optional[DEVICE]=None, trainable:Optional[bool]=None,
+                  outliers:Optional[bool]=None) -> Tuple[bool, Optional[Exception]]:
         validate, err = cls._validate(bits=bits, group_size=group_size, desc_act=desc_act, sym=sym,
                                       infeatures=infeatures, outfeatures=outfeatures, dynamic=dynamic,
-                                      device=device, trainable=trainable)
+                                      device=device, trainable=trainable, outliers=outliers)
         return validate, err
 
     @classmethod
@@ -72,7 +80,8 @@ class BaseQuantLinear(nn.Module):
 
     @classmethod
     def _validate(cls, bits: int, group_size: int, desc_act: bool, sym: bool, dynamic:Optional[dict]=None, infeatures:int=None,
-                  outfeatures:int=None, device:Optional[DEVICE]=None, trainable:Optional[bool]=None) -> Tuple[bool, Optional[Exception]]:
+                  outfeatures:int=None, device:Optional[DEVICE]=None, trainable:Optional[bool]=None,
+                  outliers:Optional[bool]=None) -> Tuple[bool, Optional[Exception]]:
         cls.verify_supports_params()
 
         if PLATFORM.ALL not in cls.SUPPORTS_PLATFORM and sys.platform not in cls.SUPPORTS_PLATFORM:
@@ -90,6 +99,10 @@ class BaseQuantLinear(nn.Module):
             err = f"{cls} does not support training."
             return False, NotImplementedError(err)
 
+        if outliers and not cls.SUPPORTS_OUTLIERS:
+            err = f"{cls} does not support outlier weights."
+            return False, NotImplementedError(err)
+
         if bits not in cls.SUPPORTS_BITS:
             err = f"{cls} only supports `{cls.SUPPORTS_BITS}` bits: actual bits = `{bits}`"
             return False, NotImplementedError(err)
@@ -166,3 +179,63 @@ class BaseQuantLinear(nn.Module):
     # override me
     def post_init(self):
         pass
+
+    def register_outliers(self, outlier_ratio: float, dtype: torch.dtype):
+        # csr `[outfeatures, infeatures]` side matrix of the outlier weights, the nnz is fixed by the module shape
+        self.outlier_count = int(self.outfeatures * self.infeatures * outlier_ratio)
+        if self.outlier_count == 0:
+            return
+
+        self.register_buffer("outlier_crow_indices", torch.zeros(self.outfeatures + 1, dtype=torch.int32))
+        self.register_buffer("outlier_col_indices", torch.zeros(self.outlier_count, dtype=torch.int32))
+        self.register_buffer("outlier_values", torch.zeros(self.outlier_count, dtype=dtype))
+
+    def pack_outliers(self, outliers: torch.Tensor):
+        # `outliers` is the csr tensor of GPTQ.quantize(outlier_ratio=...), pack() gets the weight without them
+        if outliers._nnz() != self.outlier_count:
+            raise ValueError(f"{self.__class__.__name__}: expected {self.outlier_count} outliers, got {outliers._nnz()}.")
+        self.outlier_crow_indices = outliers.crow_indices().to(torch.int32)
+        self.outlier_col_indices = outliers.col_indices().to(torch.int32)
+        self.outlier_values = outliers.values().to(self.outlier_values.dtype)
+
+    def add_outlier_weight(self, weight: torch.Tensor) -> torch.Tensor:
+        # add the outliers to a dequantized `[infeatures, outfeatures]` weight
+        rows = torch.repeat_interleave(
+            torch.arange(self.outfeatures, device=weight.device), torch.diff(self.outlier_crow_indices.long())
+        )
+        return weight.index_put((self.outlier_col_indices.long(), rows), self.outlier_values.to(weight.dtype), accumulate=True)
+
+    def add_outlier_output(self, x: torch.Tensor, out: torch.Tensor) -> torch.Tensor:
+        # add the sparse outlier matmul of input `x` to the output of the quantized weight
+        outliers = torch.sparse_csr_tensor(self.outlier_crow_indices, self.outlier_col_indices,
+                                           self.outlier_values.float(), (self.outfeatures, self.infeatures))
+        sparse_out = torch.sparse.mm(outliers, x.reshape(-1, self.infeatures).t().float()).t()
+        return out + sparse_out.reshape(out.shape).to(out.dtype)
+
+    def register_adapter(self, adapter_rank: int, dtype: torch.dtype):
+        # `adapter_a·adapter_b` low rank correction of the quantization error, added to the output of any kernel by a
+        # forward hook as a lora like side path
+        self.adapter_rank = adapter_rank
+        if adapter_rank == 0:
+            return
+
+        # unpadded module shape, kernels like exllama pad in/outfeatures
+        infeatures = getattr(self, "original_infeatures", self.infeatures)
+        outfeatures = getattr(self, "original_outfeatures", self.outfeatures)
+        self.register_buffer("adapter_a", torch.zeros((outfeatures, adapter_rank), dtype=dtype))
+        self.register_buffer("adapter_b", torch.zeros((adapter_rank, infeatures), dtype=dtype))
+        self.register_forward_hook(BaseQuantLinear._add_adapter_output)
+
+    def pack_adapter(self, A: torch.Tensor, B: torch.Tensor):
+        # `(A, B)` of GPTQ.quantize(adapter_rank=...), pack() gets the weight without the correction
+        if A.shape != self.adapter_a.shape or B.shape != self.adapter_b.shape:
+            raise ValueError(f"{self.__class__.__name__}: expected adapter shapes {tuple(self.adapter_a.shape)} and "
+                             f"{tuple(self.adapter_b.shape)}, got {tuple(A.shape)} and {tuple(B.shape)}.")
+        self.adapter_a = A.to(self.adapter_a.dtype)
+        self.adapter_b = B.to(self.adapter_b.dtype)
+
+    @staticmethod
+    def _add_adapter_output(module: "BaseQuantLinear", args: Tuple[torch.Tensor, ...], out: torch.Tensor) -> torch.Tensor:
+        x = args[0].reshape(-1, module.adapter_b.shape[1]).to(module.adapter_b.dtype)
+        side = (x @ module.adapter_b.t()) @ module.adapter_a.t()
+        return out + side.reshape(out.shape).to(out.dtype)
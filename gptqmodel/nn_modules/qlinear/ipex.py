@@ -62,6 +62,7 @@ class IPEXQuantLinear(BaseQuantLinear):
     SUPPORTS_AUTO_PADDING = False
     SUPPORTS_IN_FEATURES_DIVISIBLE_BY = [1]
     SUPPORTS_OUT_FEATURES_DIVISIBLE_BY = [1]
+    SUPPORTS_OUTLIERS = True
 
     SUPPORTS_DEVICES = [DEVICE.CPU, DEVICE.XPU]
     SUPPORTS_PLATFORM = [PLATFORM.LINUX]
@@ -81,6 +82,7 @@ class IPEXQuantLinear(BaseQuantLinear):
         kernel_switch_threshold=128,
         training=False,
         weight_dtype=None,
+        outlier_ratio: float = 0.0,
         **kwargs,
     ):
         super().__init__(bits=bits, group_size=group_size, sym=sym, desc_act=desc_act, infeatures=infeatures, outfeatures=outfeatures, **kwargs)
@@ -126,6 +128,8 @@ class IPEXQuantLinear(BaseQuantLinear):
         else:
             self.bias = None
 
+        self.register_outliers(outlier_ratio, weight_dtype)
+
         self.kernel_switch_threshold = kernel_switch_threshold
 
         self.training = training
@@ -207,6 +211,8 @@ class IPEXQuantLinear(BaseQuantLinear):
         if hasattr(self, "ipex_linear"):
             with torch.no_grad():
                 outputs = self.ipex_linear(x)
+            if self.outlier_count:
+                outputs = self.add_outlier_output(x, outputs)
             return outputs
 
         if self.wf.device != x.device:
@@ -244,6 +250,8 @@ class IPEXQuantLinear(BaseQuantLinear):
                 weights.append(scale_i[g_idx_i.long()] * (weight_i - zeros_i[g_idx_i.long()]))
             weights = torch.cat(weights, dim=1)
         out = torch.matmul(x, weights)
+        if self.outlier_count:
+            out = self.add_outlier_output(x, out)
         out = out.to(x_dtype)
         out = out.reshape(out_shape)
         out = out + self.bias if self.bias is not None else out
@@ -24,6 +24,7 @@ class TorchQuantLinear(BaseQuantLinear):
     SUPPORTS_AUTO_PADDING = True
     SUPPORTS_IN_FEATURES_DIVISIBLE_BY = [1]
     SUPPORTS_OUT_FEATURES_DIVISIBLE_BY = [1]
+    SUPPORTS_OUTLIERS = True
 
     SUPPORTS_DEVICES = [DEVICE.ALL]
     SUPPORTS_PLATFORM = [PLATFORM.ALL]
@@ -41,6 +42,7 @@ class TorchQuantLinear(BaseQuantLinear):
         outfeatures: int,
         bias: bool,
         weight_dtype=torch.float16,
+        outlier_ratio: float = 0.0,
         **kwargs,
     ):
         super().__init__(bits=bits, group_size=group_size, sym=sym, desc_act=desc_act, infeatures=infeatures, outfeatures=outfeatures, **kwargs)
@@ -84,6 +86,8 @@ class TorchQuantLinear(BaseQuantLinear):
         else:
             self.bias = None
 
+        self.register_outliers(outlier_ratio, weight_dtype)
+
         # is performed by unpacking the weights and using torch.matmul
         if self.bits in [2, 4, 8]:
             self.wf = torch.tensor(list(range(0, 32, self.bits)), dtype=torch.int32).unsqueeze(0)
@@ -212,6 +216,16 @@ class TorchQuantLinear(BaseQuantLinear):
         return out
 
     def _forward(self, x, x_dtype, out_shape):
+        num_itr = self.g_idx.shape[0] // x.shape[-1]
+        weights = self.dequantize_weight(num_itr=num_itr)
+        out = torch.matmul(x, weights)
+        out = out.to(x_dtype)
+        out = out.reshape(out_shape)
+        out = out + self.bias if self.bias is not None else out
+        return out
+
+    def dequantize_weight(self, num_itr: int = 1):
+        # unpacked weight in [infeatures, outfeatures] layout, dtype of scales
         if self.wf.device != self.qzeros.device:
             self.wf = self.wf.to(self.qzeros.device)
         if self.bits in [2, 4, 8]:
@@ -250,7 +264,6 @@ class TorchQuantLinear(BaseQuantLinear):
             weight = weight & 0x7
             weight = torch.cat([weight[:, 0, :11], weight[:, 1, 1:12], weight[:, 2, 1:11]], dim=1)
         weight = weight.reshape(weight.shape[0] * weight.shape[1], weight.shape[2])
-        num_itr = self.g_idx.shape[0] // x.shape[-1]
         if num_itr == 1:
             weights = self.scales[self.g_idx.long()] * (weight - zeros[self.g_idx.long()])
         else:
@@ -263,11 +276,9 @@ class TorchQuantLinear(BaseQuantLinear):
                 g_idx_i = self.g_idx[i * num_dim: (i + 1) * num_dim]
                 weights.append(scale_i[g_idx_i.long()] * (weight_i - zeros_i[g_idx_i.long()]))
             weights = torch.cat(weights, dim=1)
-        out = torch.matmul(x, weights)
-        out = out.to(x_dtype)
-        out = out.reshape(out_shape)
-        out = out + self.bias if self.bias is not None else out
-        return out
+        if self.outlier_count:
+            weights = self.add_outlier_weight(weights)
+        return weights
 
 
 __all__ = ["TorchQuantLinear"]
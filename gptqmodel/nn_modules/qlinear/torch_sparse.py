@@ -0,0 +1,166 @@
+# License: GPTQModel/licenses/LICENSE.apache
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import transformers
+from gptqmodel.nn_modules.qlinear.torch import TorchQuantLinear
+from gptqmodel.utils.logger import setup_logger
+
+from ...models._const import DEVICE, PLATFORM
+
+logger = setup_logger()
+
+try:
+    from torch.sparse import to_sparse_semi_structured
+except ImportError:
+    to_sparse_semi_structured = None
+
+
+class TorchSparseQuantLinear(TorchQuantLinear):
+    """
+    Reference kernel of FORMAT.GPTQ_SPARSE, 2:4 sparse weights of a `prune_n=2, prune_m=4` quantization.
+
+    `qweight` packs only the 2 kept values of every 4 input features (`[infeatures // 2 // 32 * bits, outfeatures]`),
+    `sparse_meta` holds their two 2 bit positions, 8 input feature groups of 4 bits per int32
+    (`[infeatures // 32, outfeatures]`). Zero points are stored like gptq_v2. On cuda with fp16/bf16 scales the
+    dequantized weight is converted to a torch semi-structured sparse tensor once and used by the sparse matmul.
+    """
+    SUPPORTS_BITS = [2, 4, 8]
+    SUPPORTS_GROUP_SIZE = [-1, 16, 32, 64, 128]
+    SUPPORTS_DESC_ACT = [True, False]
+    SUPPORTS_SYM = [True, False]
+    SUPPORTS_SHARDS = True
+    SUPPORTS_TRAINING = False
+    SUPPORTS_AUTO_PADDING = False
+    SUPPORTS_IN_FEATURES_DIVISIBLE_BY = [64]
+    SUPPORTS_OUT_FEATURES_DIVISIBLE_BY = [32]
+    SUPPORTS_OUTLIERS = False
+
+    SUPPORTS_DEVICES = [DEVICE.ALL]
+    SUPPORTS_PLATFORM = [PLATFORM.ALL]
+
+    # for transformers/optimum tests compat
+    QUANT_TYPE = "torch_sparse"
+
+    def __init__(
+        self,
+        bits: int,
+        group_size: int,
+        sym: bool,
+        desc_act: bool,
+        infeatures: int,
+        outfeatures: int,
+        bias: bool,
+        weight_dtype=torch.float16,
+        **kwargs,
+    ):
+        super().__init__(bits=bits, group_size=group_size, sym=sym, desc_act=desc_act, infeatures=infeatures,
+                         outfeatures=outfeatures, bias=bias, weight_dtype=weight_dtype, **kwargs)
+
+        self.padded_infeatures = infeatures
+
+        self.register_buffer(
+            "qweight",
+            torch.zeros((infeatures // 2 // 32 * self.bits, outfeatures), dtype=torch.int32),
+        )
+        self.register_buffer(
+            "sparse_meta",
+            torch.zeros((infeatures // 32, outfeatures), dtype=torch.int32),
+        )
+
+        # `[outfeatures, infeatures]` semi-structured weight, created by post_init()
+        self.sparse_weight = None
+
+    def post_init(self):
+        self.sparse_weight = None
+        if (to_sparse_semi_structured is None or self.qweight.device.type != "cuda"
+                or self.scales.dtype not in [torch.float16, torch.bfloat16]):
+            return
+
+        try:
+            self.sparse_weight = to_sparse_semi_structured(self.dequantize_weight().t().contiguous())
+        except (RuntimeError, ValueError) as e:
+            logger.info(f"TorchSparseQuantLinear: semi-structured sparse matmul is unavailable, using dense matmul: {e}")
+
+    def pack(self, linear, scales, zeros, g_idx=None):
+        W = linear.weight.data.clone()
+        if isinstance(linear, nn.Conv2d):
+            W = W.flatten(1)
+        if isinstance(linear, transformers.pytorch_utils.Conv1D):
+            W = W.t()
+
+        self.g_idx = g_idx.clone() if g_idx is not None else self.g_idx
+
+        scales = scales.t().contiguous()
+        zeros = zeros.t().contiguous()
+        scale_zeros = zeros * scales
+        self.scales = scales.clone().to(dtype=linear.weight.dtype)
+        if linear.bias is not None:
+            self.bias = linear.bias.clone().to(dtype=linear.weight.dtype)
+
+        g_idx = self.g_idx.long()
+        W = W.t()
+        intweight = torch.round((W + scale_zeros[g_idx]) / self.scales[g_idx]).to(torch.int64)
+
+        # pruned weights are exact zeros, every 4 input features keep at most 2 values
+        nonzero = (W != 0).reshape(self.infeatures // 4, 4, self.outfeatures)
+        if (nonzero.sum(dim=1) > 2).any():
+            raise ValueError(f"{self.__class__.__name__}: weight is not 2:4 sparse, quantize with prune_n=2, prune_m=4.")
+        # positions of the kept values: nonzero ones first, then the lowest zero positions, in ascending order
+        key = nonzero.to(torch.int64) * 4 + torch.arange(3, -1, -1).reshape(1, 4, 1)
+        index = torch.topk(key, 2, dim=1).indices.sort(dim=1).values
+
+        values = torch.gather(intweight.reshape(self.infeatures // 4, 4, self.outfeatures), 1, index)
+        values = values.reshape(-1, 32 // self.bits, self.outfeatures)
+        shifts = torch.arange(0, 32, self.bits, dtype=torch.int64).reshape(1, -1, 1)
+        qweight = (values << shifts).sum(dim=1)
+        self.qweight = torch.from_numpy(qweight.numpy().astype(np.uint32).astype(np.int32))
+
+        meta = (index[:, 0] | (index[:, 1] << 2)).reshape(-1, 8, self.outfeatures)
+        meta = (meta << torch.arange(0, 32, 4, dtype=torch.int64).reshape(1, -1, 1)).sum(dim=1)
+        self.sparse_meta = torch.from_numpy(meta.numpy().astype(np.uint32).astype(np.int32))
+
+        zeros = zeros.to(torch.int64).reshape(zeros.shape[0], -1, 32 // self.bits)
+        qzeros = (zeros << shifts.reshape(1, 1, -1)).sum(dim=2)
+        self.qzeros = torch.from_numpy(qzeros.numpy().astype(np.uint32).astype(np.int32))
+
+    def forward(self, x: torch.Tensor):
+        if self.sparse_weight is None:
+            return super().forward(x)
+
+        out_shape = x.shape[:-1] + (self.outfeatures,)
+        x_dtype = x.dtype
+        out = F.linear(x.reshape(-1, x.shape[-1]).to(self.scales.dtype), self.sparse_weight, self.bias)
+        return out.to(x_dtype).reshape(out_shape)
+
+    def dequantize_weight(self, num_itr: int = 1):
+        # unpacked weight in [infeatures, outfeatures] layout, dtype of scales, pruned weights are 0
+        device = self.qweight.device
+        shifts = torch.arange(0, 32, self.bits, dtype=torch.int32, device=device)
+
+        values = torch.bitwise_and(
+            torch.bitwise_right_shift(self.qweight.unsqueeze(1), shifts.reshape(1, -1, 1)), self.maxq
+        ).reshape(self.infeatures // 4, 2, self.outfeatures)
+
+        meta = torch.bitwise_and(
+            torch.bitwise_right_shift(
+                self.sparse_meta.unsqueeze(1), torch.arange(0, 32, 4, dtype=torch.int32, device=device).reshape(1, -1, 1)
+            ),
+            0xF,
+        ).reshape(self.infeatures // 4, self.outfeatures)
+        index = torch.stack([meta & 0x3, meta >> 2], dim=1).long()
+
+        zeros = torch.bitwise_and(
+            torch.bitwise_right_shift(self.qzeros.unsqueeze(2), shifts.reshape(1, 1, -1)), self.maxq
+        ).reshape(self.scales.shape)
+
+        g_idx = self.g_idx.long()
+        column_zeros = zeros[g_idx]
+        # dropped positions hold the zero point and dequantize to exactly 0
+        weight = column_zeros.reshape(self.infeatures // 4, 4, self.outfeatures).scatter(1, index, values)
+        return self.scales[g_idx] * (weight.reshape(self.infeatures, self.outfeatures) - column_zeros)
+
+
+__all__ = ["TorchSparseQuantLinear"]
@@ -1,4 +1,6 @@
-from .config import (FORMAT, FORMAT_FIELD_CODE, FORMAT_FIELD_COMPAT_MARLIN, FORMAT_FIELD_JSON,
-                     QUANT_CONFIG_FILENAME, QUANT_METHOD, QUANT_METHOD_FIELD, BaseQuantizeConfig, QuantizeConfig)
+from .config import (FORMAT, FORMAT_FIELD_CODE, FORMAT_FIELD_COMPAT_MARLIN, FORMAT_FIELD_JSON, HESSIAN_ACCUMULATION,
+                     HESSIAN_MODE, QUANT_CONFIG_FILENAME, QUANT_METHOD, QUANT_METHOD_FIELD, ROTATION,
+                     RTN_METHOD, BaseQuantizeConfig, QuantizeConfig, RTNQuantizeConfig)
 from .gptq import GPTQ
+from .hessian import HessianCollector, load_hessians
 from .quantizer import Quantizer, quantize
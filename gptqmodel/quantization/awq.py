@@ -0,0 +1,53 @@
+import copy
+from typing import List, Tuple
+
+import torch
+
+from .gptq import GPTQ, find_group_params
+from .quantizer import quantize
+
+
+def _rtn_error(gptq: GPTQ, s: torch.Tensor, H: torch.Tensor, group_size: int) -> float:
+    # output error `tr(ΔW·H·ΔWᵀ)` of round to nearest quantizing the scaled weight `W·s`, read back as `Q / s`
+    W = gptq._clone_layer()
+    columns = W.shape[1]
+    width = group_size if group_size != -1 else columns
+
+    quantizer = copy.deepcopy(gptq.quantizer)
+    # plain min/max params, the mse clipping search is left to the gptq solve
+    quantizer.mse = 0.0
+    scaled = W * s
+    params = find_group_params(quantizer, scaled, list(range(0, columns, width)), width)
+    g_idx = torch.arange(columns, device=W.device) // width
+    scale = torch.cat([p[0] for p in params], dim=1)[:, g_idx]
+    zero = torch.cat([p[1] for p in params], dim=1)[:, g_idx]
+
+    delta = quantize(scaled, scale, zero, quantizer.maxq) / s - W
+    return ((delta @ H) * delta).sum().item()
+
+
+@torch.inference_mode()
+def search_awq_scales(gptqs: List[GPTQ], group_sizes: List[int], grid: int = 20) -> Tuple[torch.Tensor, float]:
+    """
+    Activation aware (awq) per input channel scales of modules reading the same inputs. Candidates are
+    `s = act^alpha` for `alpha` in `[0, 1)` with the input rms `act` from the hessian diagonal, normalized like awq.
+    Instead of another forward pass, each candidate is scored by the output error of round to nearest quantization
+    on the hessians the modules already accumulated. Returns `(s, alpha)`, `alpha == 0` means unscaled (`s == 1`).
+    """
+    H = gptqs[0].hessian().float()
+    act = torch.diagonal(H).clamp(min=0).sqrt()
+
+    best_s = torch.ones_like(act)
+    best_alpha = 0.0
+    best_err = None
+    for n in range(grid):
+        alpha = n / grid
+        s = act.pow(alpha).clamp(min=1e-4)
+        s = s / (s.max() * s.min()).sqrt()
+        err = sum(_rtn_error(g, s.to(g.device), H.to(g.device), group_size) for g, group_size in zip(gptqs, group_sizes))
+        if best_err is None or err < best_err:
+            best_s, best_alpha, best_err = s, alpha, err
+    return best_s, best_alpha
+
+
+__all__ = ["search_awq_scales"]
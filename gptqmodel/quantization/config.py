@@ -41,6 +41,9 @@ META_FIELD_TRUE_SEQUENTIAL = "true_sequential"
 
 META_FIELD_MSE = "mse"
 
+META_FIELD_SPARSITY = "sparsity"
+META_FIELD_SPARSITY_PATTERN = "sparsity_pattern"
+
 # pkg names
 PKG_AUTO_ROUND = "auto-round"
 
@@ -52,12 +55,49 @@ class FORMAT:
     MARLIN = "marlin"
     BITBLAS = "bitblas"
     IPEX = "ipex"
+    # 2:4 sparse gptq: only the 2 kept values of every 4 input features are packed, plus their 2 bit indices
+    GPTQ_SPARSE = "gptq_sparse"
+
+
+# hessian accumulation precision
+class HESSIAN_ACCUMULATION:
+    FP32 = "fp32"
+    FP64 = "fp64"
+    # fp32 hessian plus a kahan compensation term
+    COMPENSATED = "compensated"
+
+
+# hessian storage of the gptq solver
+class HESSIAN_MODE:
+    FULL = "full"
+    # independent `[block, block]` blocks on the diagonal, correlations across blocks are dropped
+    BLOCK_DIAGONAL = "block_diagonal"
+    # nyström approximation from a random sketch plus the exact diagonal, full hessian only while solving
+    LOW_RANK = "low_rank"
 
 
 # quant methods
 class QUANT_METHOD:
     GPTQ = "gptq"
     AUTO_ROUND = "auto_round"
+    # calibration free, saved as gptq
+    RTN = "rtn"
+
+
+# weight only methods of RTNQuantizeConfig
+class RTN_METHOD:
+    # round to nearest with find_params (min/max or the `mse` clipping search) per group
+    RTN = "rtn"
+    # half-quadratic optimization of the zero points, asymmetric only
+    HQQ = "hqq"
+
+
+# orthogonal rotations of the residual stream applied before quantization, see quantization/rotation.py
+class ROTATION:
+    # randomized hadamard: random sign flips followed by a (kronecker factored) hadamard matrix
+    HADAMARD = "hadamard"
+    # random orthogonal matrix from a qr decomposition
+    RANDOM = "random"
 
 
 QUANT_METHOD_FORMAT_MAPPING = {
@@ -67,18 +107,34 @@ QUANT_METHOD_FORMAT_MAPPING = {
         FORMAT.MARLIN,
         FORMAT.BITBLAS,
         FORMAT.IPEX,
+        FORMAT.GPTQ_SPARSE,
     },
     QUANT_METHOD.AUTO_ROUND: {
         FORMAT.GPTQ,
         FORMAT.GPTQ_V2,
         FORMAT.MARLIN,
         FORMAT.BITBLAS,
-    }
+    },
+    QUANT_METHOD.RTN: {
+        FORMAT.GPTQ,
+        FORMAT.GPTQ_V2,
+        FORMAT.MARLIN,
+        FORMAT.BITBLAS,
+        FORMAT.IPEX,
+    },
 }
 
 # inference only methods should go here
 QUANTIZE_BLACK_LIST = {}
 
+# accepted string values of QuantizeConfig.calibration_forward_dtype
+CALIBRATION_FORWARD_DTYPES = {
+    "bf16": torch.bfloat16,
+    "bfloat16": torch.bfloat16,
+    "fp16": torch.float16,
+    "float16": torch.float16,
+}
+
 # compat
 QUANT_CONFIG_ARG_SYNONYMS = {
     "w_bit": "bits",
@@ -136,6 +192,76 @@ class QuantizeConfig():
     format: FORMAT = field(default=FORMAT.GPTQ)
 
     mse: float = field(default=0.0)
+    # >1: mse clipping search evaluates every n-th shrink factor first, then refines around the best one per row
+    mse_search_step: int = field(default=1)
+
+    # fp32, fp64 or compensated (kahan) hessian accumulation, the last two for very large calibration sample counts
+    hessian_accumulation: str = field(default=HESSIAN_ACCUMULATION.FP32)
+
+    # full, block_diagonal (`columns · hessian_block_size` floats per module) or low_rank (`columns · hessian_rank`
+    # floats per module while collecting) hessian, the last two trade accuracy for memory on very wide/moe layers
+    hessian_mode: str = field(default=HESSIAN_MODE.FULL)
+    # block size of block_diagonal hessians, a multiple of group_size. defaults to group_size (128 without groups)
+    hessian_block_size: Optional[int] = field(default=None)
+    # sketch rank of low_rank hessians
+    hessian_rank: int = field(default=256)
+
+    # sparsegpt pruning in the same column sweep as the quantization: unstructured ratio of pruned weights per
+    # solver block, or n of every m consecutive input features (prune_n=2, prune_m=4 for 2:4, see FORMAT.GPTQ_SPARSE)
+    sparsity: float = field(default=0.0)
+    prune_n: int = field(default=0)
+    prune_m: int = field(default=0)
+
+    # fraction of the weights of each module with the highest hessian weighted quantization error, kept in fp16 in a
+    # sparse csr side matrix next to the quantized weight (i.e. 0.005 for 3 bit models). 0 disables it
+    outlier_ratio: float = field(default=0.0)
+
+    # rank of a hessian weighted low rank correction `A·B` of each module's quantization error, stored next to the
+    # packed weight in the weight dtype and added by every kernel as a lora like side path. 0 disables it
+    adapter_rank: int = field(default=0)
+
+    # rotate the residual stream of llama style models before quantization (QuaRot/SpinQuant style) to spread weight
+    # and activation outliers over all channels, i.e. for 2/3 bit models. the inputs of the mlp down projections get
+    # an online hadamard transform that loaders reapply. None disables it
+    rotation: Optional[str] = field(default=None)
+    # seed of the random signs and orthogonal factors, saved with the checkpoint
+    rotation_seed: int = field(default=0)
+
+    # activation aware (awq style) per input channel scales, searched on the hessians captured for each subset before
+    # its gptq solve and folded into the preceding norm or linear. the checkpoint stays a standard gptq checkpoint
+    awq: bool = field(default=False)
+    # number of `alpha` candidates of the awq scale search
+    awq_grid: int = field(default=20)
+
+    # compare each quantized layer's output against its fp output on the first n calibration batches
+    # and log relative mse + cosine similarity per layer. these batches are held out of the hessians, at least
+    # one batch is always left for them. 0 (default) disables the check, every batch feeds the hessians.
+    layer_error_batches: int = field(default=0)
+    # abort (or retry) when a quantized layer's relative output mse is above / cosine is below threshold
+    layer_error_max_mse: Optional[float] = field(default=None)
+    layer_error_min_cosine: Optional[float] = field(default=None)
+    # number of retries for a layer that violates the thresholds before aborting
+    layer_error_retries: int = field(default=0)
+    # each retry adds this value to damp_percent
+    layer_error_retry_damp: float = field(default=0.05)
+    # if set, retried layers are quantized with these bits. they are merged into `dynamic` as per layer rules that
+    # keep the other keys of matching user rules, so the saved config's `dynamic` changes as well
+    layer_error_retry_bits: Optional[int] = field(default=None)
+    # if False, only warn when thresholds are still violated after all retries
+    layer_error_abort: bool = field(default=True)
+
+    # autocast dtype (torch.bfloat16 / torch.float16 or "bf16" / "fp16") for calibration layer forwards, i.e. bf16 on
+    # cpus with amx/avx512-bf16. hessian accumulation and gptq solves always stay in fp32 or higher.
+    calibration_forward_dtype: Optional[Union[str, torch.dtype]] = field(default=None)
+
+    # directory caching preprocessed calibration batches (i.e. vlm pixel values) across quantization runs
+    calibration_cache_dir: Optional[str] = field(default=None)
+
+    # column block width of the gptq solve, None autotunes it per device and module shape
+    solver_blocksize: Optional[int] = field(default=128)
+
+    # solve up to n same-shape modules of a subset (i.e. moe experts) with one batched gptq solve, 1 disables
+    solver_batch_size: int = field(default=1)
 
     # parallel packing will make ~40% speedup for many models, but may cause OOM in some large models
     # if OOM, can set to False
@@ -186,6 +312,89 @@ class QuantizeConfig():
         if self.damp_auto_increment < 0:
             raise ValueError("damp_auto_increment must greater than 0.")
 
+        if self.layer_error_batches < 0:
+            raise ValueError("layer_error_batches must be greater than or equal to 0.")
+
+        if self.layer_error_retries < 0:
+            raise ValueError("layer_error_retries must be greater than or equal to 0.")
+
+        if self.layer_error_retry_bits is not None and self.layer_error_retry_bits not in fields_info[0].metadata["choices"]:
+            raise ValueError(f"layer_error_retry_bits: only support quantize to {fields_info[0].metadata['choices']} bits.")
+
+        if self.solver_blocksize is not None and self.solver_blocksize < 1:
+            raise ValueError("solver_blocksize must be greater than or equal to 1.")
+
+        if self.solver_batch_size < 1:
+            raise ValueError("solver_batch_size must be greater than or equal to 1.")
+
+        if self.mse_search_step < 1:
+            raise ValueError("mse_search_step must be greater than or equal to 1.")
+
+        accumulations = [HESSIAN_ACCUMULATION.FP32, HESSIAN_ACCUMULATION.FP64, HESSIAN_ACCUMULATION.COMPENSATED]
+        if self.hessian_accumulation not in accumulations:
+            raise ValueError(f"hessian_accumulation must be one of {accumulations}, got {self.hessian_accumulation}.")
+
+        modes = [HESSIAN_MODE.FULL, HESSIAN_MODE.BLOCK_DIAGONAL, HESSIAN_MODE.LOW_RANK]
+        if self.hessian_mode not in modes:
+            raise ValueError(f"hessian_mode must be one of {modes}, got {self.hessian_mode}.")
+
+        if self.hessian_mode != HESSIAN_MODE.FULL and self.hessian_accumulation == HESSIAN_ACCUMULATION.COMPENSATED:
+            raise ValueError("compensated hessian_accumulation requires hessian_mode `full`.")
+
+        if self.hessian_block_size is not None:
+            if self.hessian_block_size < 1:
+                raise ValueError("hessian_block_size must be greater than or equal to 1.")
+            if self.group_size != -1 and self.hessian_block_size % self.group_size != 0:
+                raise ValueError(f"hessian_block_size must be a multiple of group_size ({self.group_size}).")
+
+        if self.hessian_rank < 1:
+            raise ValueError("hessian_rank must be greater than or equal to 1.")
+
+        if not (0 <= self.sparsity < 1):
+            raise ValueError("sparsity must be greater than or equal to 0 and less than 1.")
+
+        if self.prune_n or self.prune_m:
+            if not (0 < self.prune_n < self.prune_m):
+                raise ValueError(f"prune_n:prune_m must satisfy 0 < prune_n < prune_m, got {self.prune_n}:{self.prune_m}.")
+            if self.sparsity > 0:
+                raise ValueError("sparsity and prune_n:prune_m can not be used together.")
+            if self.desc_act:
+                raise ValueError("prune_n:prune_m masks follow the input feature order and require desc_act=False.")
+            if self.solver_blocksize is not None and self.solver_blocksize % self.prune_m != 0:
+                raise ValueError(f"solver_blocksize must be a multiple of prune_m ({self.prune_m}).")
+            if self.hessian_block_size is not None and self.hessian_block_size % self.prune_m != 0:
+                raise ValueError(f"hessian_block_size must be a multiple of prune_m ({self.prune_m}).")
+
+        if not (0 <= self.outlier_ratio < 1):
+            raise ValueError("outlier_ratio must be greater than or equal to 0 and less than 1.")
+
+        if self.outlier_ratio > 0 and (self.sparsity > 0 or self.prune_n or self.format == FORMAT.GPTQ_SPARSE):
+            raise ValueError("outlier_ratio can not be used together with pruning.")
+
+        if self.awq and self.hessian_mode != HESSIAN_MODE.FULL:
+            raise ValueError("awq requires hessian_mode `full`.")
+
+        if self.awq_grid < 1:
+            raise ValueError("awq_grid must be greater than or equal to 1.")
+
+        if self.adapter_rank < 0:
+            raise ValueError("adapter_rank must be greater than or equal to 0.")
+
+        rotations = [None, ROTATION.HADAMARD, ROTATION.RANDOM]
+        if self.rotation not in rotations:
+            raise ValueError(f"rotation must be one of {rotations}, got {self.rotation}.")
+
+        if self.format == FORMAT.GPTQ_SPARSE and (self.sparsity > 0 or self.prune_n) and (self.prune_n, self.prune_m) != (2, 4):
+            raise ValueError("FORMAT.GPTQ_SPARSE packs 2:4 sparse weights and requires prune_n=2, prune_m=4.")
+
+        if isinstance(self.calibration_forward_dtype, str):
+            dtype = CALIBRATION_FORWARD_DTYPES.get(self.calibration_forward_dtype.lower().replace("torch.", ""))
+            if dtype is None:
+                raise ValueError(f"calibration_forward_dtype: only support {list(CALIBRATION_FORWARD_DTYPES.keys())}, actual = `{self.calibration_forward_dtype}`.")
+            self.calibration_forward_dtype = dtype
+        elif self.calibration_forward_dtype not in [None, torch.bfloat16, torch.float16]:
+            raise ValueError(f"calibration_forward_dtype: only support torch.bfloat16 or torch.float16, actual = `{self.calibration_forward_dtype}`.")
+
         # validate meta
         if self.meta is not None:
             if not isinstance(self.meta, dict):
@@ -241,7 +450,7 @@ class QuantizeConfig():
     @classmethod
     # normalize quant config for compat and also performs validation
     def from_quant_config(cls, quantize_cfg, format: str = None):
-        valid_formats = {FORMAT.GPTQ, FORMAT.GPTQ_V2, FORMAT.MARLIN, FORMAT.BITBLAS, FORMAT.IPEX}
+        valid_formats = {FORMAT.GPTQ, FORMAT.GPTQ_V2, FORMAT.MARLIN, FORMAT.BITBLAS, FORMAT.IPEX, FORMAT.GPTQ_SPARSE}
         format_auto_inferred = False
         # compat: format can be passed in via from_quantized() if field missing from json
         if format:
@@ -270,7 +479,7 @@ class QuantizeConfig():
             if key == FORMAT_FIELD_JSON:
                 val = val.lower()
 
-                if val in {FORMAT.GPTQ, FORMAT.GPTQ_V2, FORMAT.MARLIN, FORMAT.BITBLAS}:
+                if val in {FORMAT.GPTQ, FORMAT.GPTQ_V2, FORMAT.MARLIN, FORMAT.BITBLAS, FORMAT.GPTQ_SPARSE}:
                     normalized[key] = val
                 else:
                     raise ValueError(f"Unknown quantization format: {val}.")
@@ -345,6 +554,15 @@ class QuantizeConfig():
             FORMAT_FIELD_JSON: self.format,
             META_FIELD: self.meta,
         }
+        # outliers change the tensors of every quantized module, kernels must know about them
+        if self.outlier_ratio > 0:
+            out["outlier_ratio"] = self.outlier_ratio
+        if self.adapter_rank > 0:
+            out["adapter_rank"] = self.adapter_rank
+        # loaders reapply the online hadamard transforms of rotated models
+        if self.rotation is not None:
+            out["rotation"] = self.rotation
+            out["rotation_seed"] = self.rotation_seed
         dict_scale_dtype_to_str(out)
         return out
 
@@ -407,6 +625,48 @@ class AutoRoundQuantizeConfig(QuantizeConfig):
         r[QUANT_METHOD_FIELD] = QUANT_METHOD.GPTQ
         return r
 
+@dataclass
+class RTNQuantizeConfig(QuantizeConfig):
+    """
+    Calibration free quantization: per group params come straight from the weights, no calibration dataset is used.
+    For smoke tests and quick capacity planning, the checkpoint is a regular gptq checkpoint.
+    """
+    method: str = RTN_METHOD.RTN
+    # half-quadratic zero point iterations of RTN_METHOD.HQQ
+    hqq_iters: int = 20
+    # layers quantized concurrently
+    workers: int = 4
+    quant_method: str = QUANT_METHOD.RTN
+
+    def __post_init__(self):
+        super().__post_init__()
+
+        if self.method not in [RTN_METHOD.RTN, RTN_METHOD.HQQ]:
+            raise ValueError(f"method must be one of {[RTN_METHOD.RTN, RTN_METHOD.HQQ]}, got {self.method}.")
+
+        if self.method == RTN_METHOD.HQQ and self.sym:
+            raise ValueError("RTN_METHOD.HQQ optimizes zero points and requires sym=False.")
+
+        if self.sparsity > 0 or self.prune_n or self.outlier_ratio > 0 or self.awq or self.adapter_rank > 0:
+            raise ValueError("sparsity, prune_n:prune_m, outlier_ratio, awq and adapter_rank require calibration (hessian) "
+                             "based quantization.")
+
+        if self.hqq_iters < 1:
+            raise ValueError("hqq_iters must be greater than or equal to 1.")
+
+        if self.workers < 1:
+            raise ValueError("workers must be greater than or equal to 1.")
+
+    def to_dict(self):
+        self.meta_set("rtn_method", self.method)
+
+        r = super().to_dict()
+
+        # the packed tensors are plain gptq, loadable by every gptq backend
+        r[QUANT_METHOD_FIELD] = QUANT_METHOD.GPTQ
+        return r
+
+
 # deprecated: will be removed in future update
 @dataclass
 class BaseQuantizeConfig(QuantizeConfig):
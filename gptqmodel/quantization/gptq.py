@@ -1,36 +1,86 @@
 # License: GPTQModel/licenses/LICENSE.apache
 # adapted from @qwopqwop200 's [GPTQ-for-LLaMa](https://github.com/qwopqwop200/GPTQ-for-LLaMa/tree/cuda), which itself is based on [gptq](https://github.com/IST-DASLab/gptq)
 
+import copy
 import math
 import os
 import sys
 import time
+from typing import Any, Dict, List, Optional, Tuple
 
 import torch
 import torch.nn as nn
 import transformers
 
 from ..utils.logger import setup_logger
-from ..utils.torch import torch_empty_cache, torch_sync
-from .quantizer import Quantizer
+from ..utils.torch import torch_autocast_disabled, torch_empty_cache, torch_sync
+from ..utils.trace import trace_span
+from .config import HESSIAN_ACCUMULATION, HESSIAN_MODE
+from .quantizer import Quantizer, quantize
 
 logger = setup_logger()
 
+# max bytes of the converted activation chunk multiplied into the hessian at once by add_batch()
+HESSIAN_CHUNK_BYTES = 256 * 1024 * 1024
+
+# power iterations of the smallest hessian eigenvalue estimate picking the damp of a failed factorization
+DAMP_EIG_ITERATIONS = 64
+
 # TODO do we really need max precision?
 torch.backends.cuda.matmul.allow_tf32 = False
 torch.backends.cudnn.allow_tf32 = False
 
 
 class GPTQ:
-    def __init__(self, layer):
+    def __init__(
+        self,
+        layer,
+        hessian_accumulation: str = HESSIAN_ACCUMULATION.FP32,
+        hessian_mode: str = HESSIAN_MODE.FULL,
+        hessian_block_size: int = 128,
+        hessian_rank: int = 256,
+    ):
         self.layer = layer
         self.device = self.layer.weight.device
-        self.layer_copy = self._clone_layer()
+        # fp32 working copy of the weight is only created when the solve of this module starts
+        self.layer_copy = None
 
-        self.rows, self.columns = self.layer_copy.shape[0], self.layer_copy.shape[1]
-        self.H = torch.zeros((self.columns, self.columns), device=self.device)
+        shape = self.layer.weight.shape
+        if isinstance(self.layer, transformers.pytorch_utils.Conv1D):
+            self.rows, self.columns = shape[1], shape[0]
+        else:
+            self.rows, self.columns = shape[0], math.prod(shape[1:])
+        dtype = torch.float64 if hessian_accumulation == HESSIAN_ACCUMULATION.FP64 else torch.float32
+        self.hessian_mode = hessian_mode
+        self.hessian_block_size = hessian_block_size
+        # low rank hessians keep the sketch `H·Ω` in H plus the exact diagonal
+        self.H_sketch = None
+        self.H_diag = None
+        if hessian_mode == HESSIAN_MODE.BLOCK_DIAGONAL:
+            # `[n_blocks, block, block]`, the last block is zero padded
+            n_blocks = -(-self.columns // hessian_block_size)
+            self.H = torch.zeros((n_blocks, hessian_block_size, hessian_block_size), dtype=dtype, device=self.device)
+        elif hessian_mode == HESSIAN_MODE.LOW_RANK:
+            generator = torch.Generator().manual_seed(0)
+            rank = min(hessian_rank, self.columns)
+            self.H_sketch = torch.randn((self.columns, rank), generator=generator).to(device=self.device, dtype=dtype)
+            self.H = torch.zeros((self.columns, rank), dtype=dtype, device=self.device)
+            self.H_diag = torch.zeros(self.columns, dtype=dtype, device=self.device)
+        else:
+            self.H = torch.zeros((self.columns, self.columns), dtype=dtype, device=self.device)
+        # compensated accumulation keeps the raw Σ xᵀx in H with its kahan compensation term, hessian() scales it
+        self.H_compensation = None
+        if hessian_accumulation == HESSIAN_ACCUMULATION.COMPENSATED:
+            self.H_compensation = torch.zeros_like(self.H)
         self.nsamples = 0
         self.quantizer = Quantizer()
+        # cholesky factorizations and seconds spent finding a working damp by the last solve
+        self.factorizations = 0
+        self.damp_time = 0.0
+        # csr `[rows, columns]` fp outlier weights of the last solve with outlier_ratio, None without
+        self.outliers = None
+        # `(A [rows, rank], B [rank, columns])` fp32 low rank correction of the last solve with adapter_rank, None without
+        self.adapter = None
 
     def _clone_layer(self):
         clone = self.layer.weight.data.clone()
@@ -68,12 +118,110 @@ class GPTQ:
             inp = inp.permute([1, 0, 2])
             inp = inp.flatten(1)
 
-        self.H *= self.nsamples / (self.nsamples + tmp)
-        self.nsamples += tmp
-        # inp = inp.float()
-        inp = math.sqrt(2 / self.nsamples) * inp.float()
-        # self.H += 2 / self.nsamples * inp.matmul(inp.t())
-        self.H += inp.matmul(inp.t())
+        # hooks of autocast calibration forwards (QuantizeConfig.calibration_forward_dtype) accumulate in fp32 as well
+        with trace_span("add_batch", category="gptq", columns=self.columns), torch_autocast_disabled(self.H.device):
+            # H = n/(n+tmp)·H + 2/(n+tmp)·inp·inpᵀ, chunked over tokens so the converted copy of inp stays bounded
+            beta, alpha = self._rescale(tmp)
+            chunk = max(1, HESSIAN_CHUNK_BYTES // (self.columns * self.H.element_size()))
+            for start in range(0, inp.shape[1], chunk):
+                x = inp[:, start:start + chunk].to(self.H.dtype)
+                if self.hessian_mode == HESSIAN_MODE.BLOCK_DIAGONAL:
+                    x = self._pad_columns(x).reshape(self.H.shape[0], self.hessian_block_size, -1)
+                    self.H.baddbmm_(x, x.transpose(1, 2), beta=beta, alpha=alpha)
+                elif self.hessian_mode == HESSIAN_MODE.LOW_RANK:
+                    self.H.addmm_(x, x.t() @ self.H_sketch, beta=beta, alpha=alpha)
+                    self.H_diag.mul_(beta).add_(x.square().sum(1), alpha=alpha)
+                else:
+                    self._add_hessian(beta, alpha, x, x.t())
+                beta = 1.0
+            if beta != 1.0 and self.H_compensation is None:
+                self.H.mul_(beta)
+                if self.H_diag is not None:
+                    self.H_diag.mul_(beta)
+
+    def add_hessian(self, xtx: torch.Tensor, samples: int):
+        """Add a precomputed `Σ xᵀx` of `samples` samples, same as `add_batch()` of their inputs."""
+        beta, alpha = self._rescale(samples)
+        xtx = xtx.to(self.H.dtype)
+        if self.hessian_mode == HESSIAN_MODE.BLOCK_DIAGONAL:
+            n_blocks, block = self.H.shape[0], self.hessian_block_size
+            xtx = self._pad_columns(self._pad_columns(xtx).t()).reshape(n_blocks, block, n_blocks, block)
+            self.H.mul_(beta).add_(torch.diagonal(xtx, dim1=0, dim2=2).permute(2, 0, 1), alpha=alpha)
+        elif self.hessian_mode == HESSIAN_MODE.LOW_RANK:
+            self.H.addmm_(xtx, self.H_sketch, beta=beta, alpha=alpha)
+            self.H_diag.mul_(beta).add_(torch.diagonal(xtx), alpha=alpha)
+        else:
+            self._add_hessian(beta, alpha, xtx)
+
+    def _pad_columns(self, x: torch.Tensor) -> torch.Tensor:
+        # zero pad dim 0 of x to the block diagonal hessian size
+        pad = self.H.shape[0] * self.hessian_block_size - x.shape[0]
+        return nn.functional.pad(x, (0, 0, 0, pad)) if pad else x
+
+    def _rescale(self, samples: int) -> Tuple[float, float]:
+        nsamples = self.nsamples + samples
+        beta, alpha = self.nsamples / nsamples, 2 / nsamples
+        self.nsamples = nsamples
+        return beta, alpha
+
+    def _add_hessian(self, beta: float, alpha: float, a: torch.Tensor, b: Optional[torch.Tensor] = None):
+        # H = beta·H + alpha·a·b (or alpha·a without b)
+        if self.H_compensation is None:
+            if b is None:
+                self.H.mul_(beta).add_(a, alpha=alpha)
+            else:
+                self.H.addmm_(a, b, beta=beta, alpha=alpha)
+            return
+
+        # kahan summation of the raw sum, no per batch rescale rounding
+        y = a - self.H_compensation if b is None else torch.addmm(self.H_compensation, a, b, beta=-1)
+        t = self.H + y
+        torch.sub(t, self.H, out=self.H_compensation).sub_(y)
+        self.H = t
+
+    @torch.inference_mode()
+    def scale_inputs(self, s: torch.Tensor):
+        """
+        The module reads `x / s` from now on (i.e. awq scales folded into the module producing `x`): weight columns are
+        multiplied by `s` and the accumulated full hessian becomes `diag(1/s)·H·diag(1/s)`.
+        """
+        if self.hessian_mode != HESSIAN_MODE.FULL:
+            raise NotImplementedError("scale_inputs() requires hessian_mode `full`.")
+        if not isinstance(self.layer, nn.Linear):
+            raise NotImplementedError(f"scale_inputs() does not support {self.layer.__class__.__name__} modules.")
+
+        weight = self.layer.weight.data
+        self.layer.weight.data = (weight.float() * s.to(weight.device)).to(weight.dtype)
+        inv = 1 / s.to(device=self.H.device, dtype=self.H.dtype)
+        outer = inv.unsqueeze(1) * inv.unsqueeze(0)
+        self.H.mul_(outer)
+        if self.H_compensation is not None:
+            self.H_compensation.mul_(outer)
+
+    def hessian(self) -> torch.Tensor:
+        """
+        The accumulated `2/n · Σ xᵀx` in fp32, `H` itself for plain fp32 accumulation. Block diagonal hessians are
+        returned as their `[n_blocks, block, block]` blocks, low rank hessians are expanded to the full matrix.
+        """
+        if self.H_compensation is not None:
+            return (self.H - self.H_compensation).mul_(2 / max(self.nsamples, 1))
+        if self.hessian_mode == HESSIAN_MODE.LOW_RANK:
+            return self._nystrom_hessian()
+        return self.H.float()
+
+    def _nystrom_hessian(self) -> torch.Tensor:
+        # H ≈ Y (ΩᵀY)⁻¹ Yᵀ with Y = H·Ω, the missing part of the diagonal (H - approximation is psd) added back
+        Y = self.H.double()
+        M = self.H_sketch.double().t() @ Y
+        M = (M + M.t()) / 2
+        M.diagonal().add_(1e-10 * M.diagonal().sum() + 1e-30)
+        L, _ = torch.linalg.cholesky_ex(M)
+        Z = torch.linalg.solve_triangular(L, Y.t(), upper=False).t().float()
+        del Y, M, L
+        H = Z @ Z.t()
+        residual = (self.H_diag.float() - torch.diagonal(H)).clamp_(min=0)
+        torch.diagonal(H).add_(residual)
+        return H
 
     # wrapper for backward compat with optimum
     # TODO: mark for deprecation
@@ -109,8 +257,27 @@ class GPTQ:
         group_size=-1,
         actorder=False,
         static_groups=False,
+        sparsity=0.0,
+        prune_n=0,
+        prune_m=0,
+        outlier_ratio=0.0,
+        adapter_rank=0,
     ):
         start = time.time()
+        block_hessian = self.hessian_mode == HESSIAN_MODE.BLOCK_DIAGONAL
+        if block_hessian:
+            # every sweep block is one hessian block, solved without updates of the later blocks
+            blocksize = self.hessian_block_size
+        elif blocksize is None:
+            blocksize = autotune_blocksize(self.rows, self.columns, self.device, group_size)
+
+        if prune_n:
+            if actorder:
+                raise ValueError("prune_n:prune_m masks follow the input feature order and can not be used with actorder.")
+            if blocksize % prune_m != 0 or self.columns % prune_m != 0:
+                raise ValueError(f"blocksize ({blocksize}) and columns ({self.columns}) must be multiples of prune_m ({prune_m}).")
+        if outlier_ratio > 0 and (sparsity > 0 or prune_n):
+            raise ValueError("outlier_ratio can not be used together with pruning.")
         if self.device.type not in ["mps", "cpu"]:
             self.layer.weight.data = self.layer.weight.data.cpu()
             
@@ -127,131 +294,208 @@ class GPTQ:
         if not self.quantizer.ready():
             self.quantizer.find_params(W, weight=True)
 
-        H = self.H
+        H = self.hessian()
         del self.H
-        dead = torch.diag(H) == 0
-        H[dead, dead] = 1
+        self.H_compensation = None
+        self.H_sketch = None
+        self.H_diag = None
+        if block_hessian:
+            diag = torch.diagonal(H, dim1=1, dim2=2)
+            dead = diag.reshape(-1)[:self.columns] == 0
+            # zero padding of the last block is dead as well
+            diag[diag == 0] = 1
+        else:
+            dead = torch.diag(H) == 0
+            H[dead, dead] = 1
         W[:, dead] = 0
 
+        adapter_source = None
+        if adapter_rank:
+            # unquantized weight and undamped hessian, the adapter corrects the error of the final Q
+            adapter_source = (W.clone(), torch.block_diag(*H)[:self.columns, :self.columns] if block_hessian else H.clone())
+
         # g_idx = []
         scale = []
         zero = []
-        now_idx = 1
 
         if static_groups:
-            import copy
-
-            groups = []
-            for i in range(0, self.columns, group_size):
-                quantizer = copy.deepcopy(self.quantizer)
-                quantizer.find_params(W[:, i : (i + group_size)], weight=True)
-
-                scale.append(quantizer.scale)
-                zero.append(quantizer.zero)
-                groups.append(quantizer)
+            # params of all groups on the unpermuted W, stacked to `[n_groups, rows, 1]`
+            static_params = find_group_params(self.quantizer, W, list(range(0, self.columns, group_size)), group_size)
+            for group_scale, group_zero in static_params:
+                scale.append(group_scale)
+                zero.append(group_zero)
+            static_scale = torch.stack([p[0] for p in static_params])
+            static_zero = torch.stack([p[1] for p in static_params])
 
         if actorder:
-            perm = torch.argsort(torch.diag(H), descending=True)
+            if block_hessian:
+                # columns are only reordered inside their hessian block, padding stays at the end of the last block
+                key = torch.diagonal(H, dim1=1, dim2=2).clone()
+                key.view(-1)[self.columns:] = -math.inf
+                local = torch.argsort(key, dim=1, descending=True)
+                H = torch.gather(H, 1, local.unsqueeze(2).expand_as(H))
+                H = torch.gather(H, 2, local.unsqueeze(1).expand_as(H))
+                offsets = torch.arange(H.shape[0], device=local.device).unsqueeze(1) * blocksize
+                perm = (local + offsets).reshape(-1)[:self.columns]
+            else:
+                perm = torch.argsort(torch.diag(H), descending=True)
+                H = H[perm][:, perm]
             W = W[:, perm]
-            H = H[perm][:, perm]
             invperm = torch.argsort(perm)
 
-        Losses = torch.zeros_like(W)
-        Q = torch.zeros_like(W)
-
-        while 1 > percdamp > 0:
-            try:
-                damp = percdamp * torch.mean(torch.diag(H))
-                diag = torch.arange(self.columns, device=self.device)
-                H[diag, diag] += damp
-
-                H = torch.linalg.cholesky(H)
-                H = torch.cholesky_inverse(H)
-                H = torch.linalg.cholesky(H, upper=True)
-                Hinv = H
-                break
-            except torch._C._LinAlgError as e:
-                if damp_auto_increment != 0:
-                    logger.warning(f"Current damp={percdamp:.5f} is too low, increased by {damp_auto_increment:.5f}")
-                    percdamp += damp_auto_increment
-                else:
-                    logger.warning("Please increase damp or nsamples for calibration data to avoid the following quant error. ")
-                    raise e
-
-        if not (0 < percdamp < 1):
-            raise ValueError(f"damp_percent must between 0 and 1. current is {percdamp}")
-
-        for i1 in range(0, self.columns, blocksize):
-            i2 = min(i1 + blocksize, self.columns)
-            count = i2 - i1
-
-            W1 = W[:, i1:i2].clone()
-            Q1 = torch.zeros_like(W1)
-            Err1 = torch.zeros_like(W1)
-            Losses1 = torch.zeros_like(W1)
-            Hinv1 = Hinv[i1:i2, i1:i2]
-
-            for i in range(count):
-                w = W1[:, i]
-                d = Hinv1[i, i]
-
-                if group_size != -1:
-                    if not static_groups:
-                        if (i1 + i) % group_size == 0:
-                            self.quantizer.find_params(W[:, (i1 + i) : (i1 + i + group_size)], weight=True)
-
-                        if ((i1 + i) // group_size) - now_idx == -1:
-                            scale.append(self.quantizer.scale)
-                            zero.append(self.quantizer.zero)
-                            now_idx += 1
+        if static_groups:
+            # static group of every (permuted) column, looked up once instead of per column
+            column_groups = ((perm if actorder else torch.arange(self.columns)) // group_size).tolist()
+
+        # the quantized block Q1 of every block is written back into W (no separate Q), the loss is kept as a scalar
+        loss = torch.zeros((), device=W.device)
+
+        with trace_span("damp_cholesky", category="gptq", columns=self.columns):
+            damp_start = time.time()
+            if block_hessian:
+                Hinv, percdamp, self.factorizations = damped_block_hessian_inverse(H, percdamp, damp_auto_increment,
+                                                                                   self.columns)
+            else:
+                Hinv, percdamp, self.factorizations = damped_hessian_inverse(H, percdamp, damp_auto_increment)
+            self.damp_time = time.time() - damp_start
+            del H
+
+        outlier_mask = None
+        outlier_count = int(self.rows * self.columns * outlier_ratio)
+        if outlier_count:
+            outlier_mask = self._select_outliers(W, Hinv, outlier_count, group_size)
+            # outliers stay in fp, the group params are found again without them widening the ranges
+            inliers = W.masked_fill(outlier_mask, 0)
+            if static_groups:
+                static_params = find_group_params(self.quantizer, inliers[:, invperm] if actorder else inliers,
+                                                  list(range(0, self.columns, group_size)), group_size)
+                scale = [p[0] for p in static_params]
+                zero = [p[1] for p in static_params]
+                static_scale = torch.stack(scale)
+                static_zero = torch.stack(zero)
+            elif group_size == -1:
+                self.quantizer.find_params(inliers, weight=True)
+            del inliers
+
+        with trace_span("column_sweep", category="gptq", rows=self.rows, columns=self.columns):
+            maxq = self.quantizer.maxq
+            group_scale, group_zero = self.quantizer.scale, self.quantizer.zero
+            for i1 in range(0, self.columns, blocksize):
+                i2 = min(i1 + blocksize, self.columns)
+                count = i2 - i1
+
+                W1 = W[:, i1:i2].clone()
+                Q1 = torch.zeros_like(W1)
+                Err1 = torch.zeros_like(W1)
+                Hinv1 = Hinv[i1 // blocksize, :count, :count] if block_hessian else Hinv[i1:i2, i1:i2]
+
+                # sparsegpt: weights with the smallest w² / [H⁻¹]²ᵢᵢ are pruned, the sweep compensates them like
+                # quantization errors. unstructured masks are picked once per block, n:m masks every m columns
+                mask1 = None
+                if sparsity > 0:
+                    prune_cost = W1 ** 2 / torch.diagonal(Hinv1).reshape(1, -1) ** 2
+                    pruned = int(prune_cost.numel() * sparsity)
+                    mask1 = torch.zeros_like(W1, dtype=torch.bool)
+                    if pruned > 0:
+                        mask1.view(-1)[torch.topk(prune_cost.flatten(), pruned, largest=False)[1]] = True
+                elif prune_n:
+                    mask1 = torch.zeros_like(W1, dtype=torch.bool)
+
+                outlier_mask1 = outlier_mask[:, i1:i2] if outlier_mask is not None else None
+
+                if group_size != -1 and not static_groups:
+                    # params of all groups starting in this block, found on W as of the block start
+                    starts = list(range(-(-i1 // group_size) * group_size, i2, group_size))
+                    if outlier_mask is not None and starts:
+                        end = min(starts[-1] + group_size, self.columns)
+                        window = W[:, starts[0]:end].masked_fill(outlier_mask[:, starts[0]:end], 0)
+                        block_params = find_group_params(self.quantizer, window, [s - starts[0] for s in starts], group_size)
                     else:
-                        idx = i1 + i
-                        if actorder:
-                            idx = perm[idx]
-
-                        self.quantizer = groups[idx // group_size]
-
-                q = self.quantizer.quantize(w.unsqueeze(1)).flatten()
-                Q1[:, i] = q
-                Losses1[:, i] = (w - q) ** 2 / d**2
-
-                err1 = (w - q) / d
-                W1[:, i:] -= err1.unsqueeze(1).matmul(Hinv1[i, i:].unsqueeze(0))
-                Err1[:, i] = err1
-
-            Q[:, i1:i2] = Q1
-            Losses[:, i1:i2] = Losses1 / 2
-
-            W[:, i2:] -= Err1.matmul(Hinv[i1:i2, i2:])
-
-            if os.environ.get("DEBUG"):
-                self.layer.weight.data[:, :i2] = Q[:, :i2]
-                self.layer.weight.data[:, i2:] = W[:, i2:]
-
-                logger.debug(torch.sum((self.layer(self.inp1) - self.out1) ** 2))
-                logger.debug(torch.sum(Losses))
+                        block_params = find_group_params(self.quantizer, W, starts, group_size)
+                    for group_scale, group_zero in block_params:
+                        scale.append(group_scale)
+                        zero.append(group_zero)
+
+                for i in range(count):
+                    w = W1[:, i]
+                    d = Hinv1[i, i]
+
+                    if group_size != -1:
+                        if not static_groups:
+                            if (i1 + i) % group_size == 0:
+                                group_scale, group_zero = block_params[((i1 + i) - starts[0]) // group_size]
+                        else:
+                            g = column_groups[i1 + i]
+                            group_scale, group_zero = static_scale[g], static_zero[g]
+
+                    if prune_n and i % prune_m == 0:
+                        prune_cost = W1[:, i:i + prune_m] ** 2 / torch.diagonal(Hinv1)[i:i + prune_m].reshape(1, -1) ** 2
+                        mask1.scatter_(1, i + torch.topk(prune_cost, prune_n, dim=1, largest=False)[1], True)
+
+                    q = quantize(w.unsqueeze(1), group_scale, group_zero, maxq).flatten()
+                    if mask1 is not None:
+                        q[mask1[:, i]] = 0
+                    elif outlier_mask1 is not None:
+                        # outliers keep their (updated) value, no error to compensate
+                        q = torch.where(outlier_mask1[:, i], w, q)
+                    Q1[:, i] = q
+
+                    err1 = (w - q) / d
+                    # rank-1 update of the remaining block columns, single fused kernel
+                    W1[:, i:].addr_(err1, Hinv1[i, i:], alpha=-1)
+                    Err1[:, i] = err1
+
+                # block columns of W are not read again once the block is solved
+                W[:, i1:i2] = Q1
+                # (w - q)² / d² of every column is err1²
+                loss += torch.sum(Err1 ** 2) / 2
+
+                if not block_hessian:
+                    W[:, i2:] -= Err1.matmul(Hinv[i1:i2, i2:])
+
+                if os.environ.get("DEBUG"):
+                    self.layer.weight.data[:, :] = W
+
+                    logger.debug(torch.sum((self.layer(self.inp1) - self.out1) ** 2))
+                    logger.debug(loss)
 
         torch_sync(self.device)
+        Q = W
 
-        avg_loss = torch.sum(Losses).item() / self.nsamples
+        avg_loss = loss.item() / self.nsamples
 
         if math.isnan(avg_loss):
-            print("Losses sum item:", torch.sum(Losses).item())
+            print("Losses sum item:", loss.item())
             raise ValueError("Quantization failed due to NaN loss")
 
         group_size = group_size if group_size != -1 else self.columns
 
         if static_groups and actorder:
-            g_idx = [perm[i] // group_size for i in range(self.columns)]
+            g_idx = perm // group_size
         else:
-            g_idx = [i // group_size for i in range(self.columns)]
+            g_idx = torch.arange(self.columns, device=Q.device) // group_size
 
-        g_idx = torch.tensor(g_idx, dtype=torch.int32, device=Q.device)
+        g_idx = g_idx.to(dtype=torch.int32, device=Q.device)
 
         if actorder:
             Q = Q[:, invperm]
             g_idx = g_idx[invperm]
 
+        self.outliers = None
+        if outlier_mask is not None:
+            rows, cols = (outlier_mask[:, invperm] if actorder else outlier_mask).nonzero(as_tuple=True)
+            crow = torch.zeros(self.rows + 1, dtype=torch.int64, device=Q.device)
+            crow[1:] = torch.cumsum(torch.bincount(rows, minlength=self.rows), dim=0)
+            self.outliers = torch.sparse_csr_tensor(crow, cols, Q[rows, cols], (self.rows, self.columns)).cpu()
+
+        self.adapter = None
+        if adapter_source is not None:
+            A, B = low_rank_correction(adapter_source[0] - Q, adapter_source[1], adapter_rank)
+            del adapter_source
+            self.adapter = (A.cpu(), B.cpu())
+            # the layer forwards with the correction, packing subtracts it again
+            Q = Q + A @ B
+
         if isinstance(self.layer, transformers.Conv1D):
             Q = Q.t()
 
@@ -269,6 +513,9 @@ class GPTQ:
         if scale == []:
             scale.append(self.quantizer.scale)
             zero.append(self.quantizer.zero)
+        else:
+            # quantizer holds the params of the group of the last solved column, like a per column find_params
+            self.quantizer.scale, self.quantizer.zero = group_scale, group_zero
 
         scale = torch.cat(scale, dim=1)
         zero = torch.cat(zero, dim=1)
@@ -276,12 +523,27 @@ class GPTQ:
         duration = time.time() - start
         return scale, zero, g_idx, duration, avg_loss, percdamp
 
+    def _select_outliers(self, W: torch.Tensor, Hinv: torch.Tensor, count: int, group_size: int) -> torch.Tensor:
+        # spqr style: the `count` weights whose rounding costs the most, (w - q)² / [H⁻¹]²ᵢᵢ with the initial group params
+        width = group_size if group_size != -1 else self.columns
+        params = find_group_params(self.quantizer, W, list(range(0, self.columns, width)), width)
+        column_groups = torch.arange(self.columns, device=W.device) // width
+        scale = torch.cat([p[0] for p in params], dim=1)[:, column_groups]
+        zero = torch.cat([p[1] for p in params], dim=1)[:, column_groups]
+        d = torch.diagonal(Hinv, dim1=-2, dim2=-1).reshape(-1)[:self.columns]
+
+        cost = ((W - quantize(W, scale, zero, self.quantizer.maxq)) / d) ** 2
+        mask = torch.zeros_like(W, dtype=torch.bool)
+        mask.view(-1)[torch.topk(cost.flatten(), count)[1]] = True
+        return mask
+
     def free(self):
         if os.environ.get("DEBUG"):
             self.inp1 = None
             self.out1 = None
 
         self.H = None
+        self.H_compensation = None
         self.Losses = None
         self.Trace = None
 
@@ -291,4 +553,407 @@ class GPTQ:
         torch_empty_cache(self.device)
 
 
-__all__ = ["GPTQ"]
+def low_rank_correction(R: torch.Tensor, H: torch.Tensor, rank: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Rank `rank` correction `A·B` of the quantization error `R = W - Q` (`[rows, columns]`) that minimizes the hessian
+    weighted error `‖(R - A·B)·H^½‖`: the truncated svd of `R·H^½` mapped back by `H^-½`. Returns fp32
+    `A` (`[rows, rank]`) and `B` (`[rank, columns]`).
+    """
+    eigenvalues, V = torch.linalg.eigh(H.double())
+    # near singular directions of H carry no output error, clamped so H^-½ stays bounded
+    eigenvalues = eigenvalues.clamp(min=eigenvalues.max().item() * 1e-8 + 1e-30).sqrt()
+    U, S, Vh = torch.linalg.svd(R.double() @ ((V * eigenvalues) @ V.t()), full_matrices=False)
+    rank = min(rank, S.shape[0])
+    A = U[:, :rank] * S[:rank]
+    B = Vh[:rank] @ ((V / eigenvalues) @ V.t())
+    return A.float(), B.float()
+
+
+def _damped_inverse(H: torch.Tensor, diag: torch.Tensor, damp: float) -> Optional[torch.Tensor]:
+    # upper cholesky factor of (H + damp·I)⁻¹, None if H + damp·I is not positive definite. H is damped in place.
+    torch.diagonal(H).copy_(diag + damp)
+    L, info = torch.linalg.cholesky_ex(H)
+    if info.item() != 0:
+        return None
+    Hinv, info = torch.linalg.cholesky_ex(torch.cholesky_inverse(L), upper=True)
+    return Hinv if info.item() == 0 else None
+
+
+def _min_eigenvalue(H: torch.Tensor, iterations: int = DAMP_EIG_ITERATIONS) -> float:
+    # power iteration on sigma·I - H, sigma >= λ_max by gershgorin. rayleigh quotient minus its residual norm
+    # is a lower estimate of λ_min once the iteration converged.
+    sigma = H.abs().sum(1).max()
+    v = torch.linspace(1, 2, H.shape[0], dtype=H.dtype, device=H.device)
+    v /= v.norm()
+    for _ in range(iterations):
+        w = sigma * v - H @ v
+        v = w / w.norm()
+    Hv = H @ v
+    rq = v @ Hv
+    return (rq - (Hv - rq * v).norm()).item()
+
+
+def damped_hessian_inverse(
+    H: torch.Tensor,
+    percdamp: float,
+    damp_auto_increment: float,
+    mean: Optional[float] = None,
+) -> Tuple[torch.Tensor, float, int]:
+    """
+    Upper cholesky factor of `(H + percdamp·mean(diag(H))·I)⁻¹` as used by the column sweep. Instead of one
+    factorization per `damp_auto_increment` step, a failed fp32 factorization is retried once in fp64 (round off of
+    an almost singular hessian), then `percdamp` is raised straight to the increment step that covers the estimated
+    smallest eigenvalue of `H`. `H` is modified in place, `mean` overrides the diagonal mean the damp is relative to.
+    Returns `(Hinv, percdamp, factorizations)`.
+    """
+    if not (0 < percdamp < 1):
+        raise ValueError(f"damp_percent must between 0 and 1. current is {percdamp}")
+
+    diag = torch.diagonal(H).clone()
+    if mean is None:
+        mean = torch.mean(diag).item()
+    Hinv = _damped_inverse(H, diag, percdamp * mean)
+    if Hinv is not None:
+        return Hinv, percdamp, 1
+
+    H, diag = H.double(), diag.double()
+    Hinv = _damped_inverse(H, diag, percdamp * mean)
+    if Hinv is not None:
+        return Hinv.float(), percdamp, 2
+
+    if damp_auto_increment == 0:
+        logger.warning("Please increase damp or nsamples for calibration data to avoid the following quant error. ")
+        raise torch.linalg.LinAlgError(f"Hessian is not positive-definite with damp_percent={percdamp:.5f}.")
+
+    # smallest damp keeping the margin `percdamp` would give a positive semi-definite hessian
+    torch.diagonal(H).copy_(diag)
+    needed = -_min_eigenvalue(H) / mean
+    increments = max(1, math.ceil(needed / damp_auto_increment))
+    factorizations = 2
+    while True:
+        damp_percent = percdamp + increments * damp_auto_increment
+        if not (0 < damp_percent < 1):
+            raise ValueError(f"damp_percent must between 0 and 1. current is {damp_percent}")
+        logger.warning(f"Current damp={percdamp:.5f} is too low, increased to {damp_percent:.5f}")
+        factorizations += 1
+        Hinv = _damped_inverse(H, diag, damp_percent * mean)
+        if Hinv is not None:
+            return Hinv.float(), damp_percent, factorizations
+        # the eigenvalue estimate was too optimistic
+        increments *= 2
+
+
+def damped_block_hessian_inverse(
+    H: torch.Tensor,
+    percdamp: float,
+    damp_auto_increment: float,
+    columns: int,
+) -> Tuple[torch.Tensor, float, int]:
+    """
+    `damped_hessian_inverse()` of every `[block, block]` block of a block diagonal hessian (`[n_blocks, block, block]`
+    holding `columns` columns, the rest is padding), each damped relative to the diagonal of its own columns. All
+    blocks are factorized in one batched call, failed blocks are retried on their own.
+    Returns `(Hinv, percdamp, factorizations)` with the largest damp of all blocks.
+    """
+    if not (0 < percdamp < 1):
+        raise ValueError(f"damp_percent must between 0 and 1. current is {percdamp}")
+
+    diag = torch.diagonal(H, dim1=1, dim2=2)
+    undamped = diag.clone()
+    real = (torch.arange(diag.numel(), device=H.device) < columns).reshape(diag.shape)
+    means = (undamped * real).sum(dim=1) / real.sum(dim=1)
+    diag.add_(percdamp * means.unsqueeze(1))
+    L, info = torch.linalg.cholesky_ex(H)
+    Hinv, info_inv = torch.linalg.cholesky_ex(torch.cholesky_inverse(L), upper=True)
+    del L
+
+    factorizations = 1
+    damp_percent = percdamp
+    for k in ((info != 0) | (info_inv != 0)).nonzero().flatten().tolist():
+        diag[k] = undamped[k]
+        Hinv[k], block_damp, block_factorizations = damped_hessian_inverse(H[k], percdamp, damp_auto_increment,
+                                                                           mean=means[k].item())
+        damp_percent = max(damp_percent, block_damp)
+        factorizations += block_factorizations
+    return Hinv, damp_percent, factorizations
+
+
+def find_group_params(quantizer: Quantizer, W: torch.Tensor, starts: List[int], group_size: int) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """
+    `(scale, zero)` of the groups starting at the `starts` columns of `W` (`[..., rows, columns]`), identical to a
+    `find_params` call per group but found with one batched call per group width.
+    """
+    columns = W.shape[-1]
+    lead = W.shape[:-1]
+    params = [None] * len(starts)
+    widths = {}
+    for n, start in enumerate(starts):
+        widths.setdefault(min(group_size, columns - start), []).append(n)
+
+    for width, indices in widths.items():
+        x = torch.stack([W[..., starts[n]:starts[n] + width] for n in indices])
+        quantizer.find_params(x.reshape(-1, width), weight=True)
+        group_scale = quantizer.scale.reshape(len(indices), *lead, 1)
+        group_zero = quantizer.zero.reshape(len(indices), *lead, 1)
+        for j, n in enumerate(indices):
+            params[n] = (group_scale[j], group_zero[j])
+    return params
+
+
+# blocksize candidates and results of `autotune_blocksize()` per (device, rows, columns)
+GPTQ_BLOCKSIZES = [32, 64, 128, 256]
+_autotuned_blocksizes = {}
+
+
+@torch.inference_mode()
+def autotune_blocksize(rows: int, columns: int, device: torch.device, group_size: int = -1) -> int:
+    """
+    Fastest column sweep blocksize for a module shape on a device, timed once on a synthetic solve of a column slice.
+    The blocksize only changes the order of floating point updates, not the algorithm.
+    """
+    key = (str(device), rows, columns, group_size)
+    if key in _autotuned_blocksizes:
+        return _autotuned_blocksizes[key]
+
+    sample_columns = min(columns, 1024)
+    layer = nn.Linear(sample_columns, min(rows, 4096), bias=False, device=device)
+    x = torch.randn(sample_columns * 2, sample_columns, device=device)
+
+    timings = {}
+    for blocksize in GPTQ_BLOCKSIZES:
+        if blocksize > sample_columns:
+            continue
+        g = GPTQ(layer)
+        g.quantizer.configure(4, perchannel=True, sym=True)
+        g.add_batch(x, None)
+        layer_weight = layer.weight.data
+        torch_sync(device)
+        start = time.perf_counter()
+        g.quantize(blocksize=blocksize, group_size=group_size if group_size < sample_columns else -1)
+        torch_sync(device)
+        timings[blocksize] = time.perf_counter() - start
+        layer.weight.data = layer_weight
+
+    best = min(timings, key=timings.get) if timings else 128
+    logger.debug(f"GPTQ blocksize autotune {key}: {timings}, using {best}")
+    _autotuned_blocksizes[key] = best
+    return best
+
+
+def _batch_key(gptq: GPTQ, kwargs: Dict[str, Any]):
+    q = gptq.quantizer
+    return (
+        gptq.rows,
+        gptq.columns,
+        str(gptq.device),
+        type(gptq.layer),
+        int(q.maxq),
+        q.sym,
+        q.mse,
+        q.mse_search_step,
+        gptq.hessian_mode,
+        kwargs.get("blocksize", 128),
+        kwargs.get("percdamp", 0.01),
+        kwargs.get("group_size", -1),
+        kwargs.get("actorder", False),
+    )
+
+
+def quantize_batched(gptqs: Dict[str, GPTQ], kwargs: Dict[str, Dict[str, Any]], batch_size: int) -> Dict[str, Tuple]:
+    """
+    `GPTQ.quantize()` for many modules. Modules with the same shape, quantizer config and quantize args are stacked
+    up to `batch_size` and solved together by `quantize_stacked()`, others (and `static_groups`, pruning, outliers,
+    adapters or block diagonal hessians) are solved one by one.
+    Returns the `GPTQ.quantize()` result of every module.
+    """
+    results = {}
+    groups = {}
+    for name, gptq in gptqs.items():
+        if (batch_size <= 1 or kwargs[name].get("static_groups", False) or os.environ.get("DEBUG")
+                or kwargs[name].get("sparsity", 0.0) > 0 or kwargs[name].get("prune_n", 0)
+                or kwargs[name].get("outlier_ratio", 0.0) > 0
+                or kwargs[name].get("adapter_rank", 0) > 0
+                or gptq.hessian_mode == HESSIAN_MODE.BLOCK_DIAGONAL):
+            results[name] = gptq.quantize(**kwargs[name])
+        else:
+            groups.setdefault(_batch_key(gptq, kwargs[name]), []).append(name)
+
+    for names in groups.values():
+        for start in range(0, len(names), batch_size):
+            chunk = names[start:start + batch_size]
+            if len(chunk) == 1:
+                results[chunk[0]] = gptqs[chunk[0]].quantize(**kwargs[chunk[0]])
+                continue
+            chunk_results = quantize_stacked([gptqs[n] for n in chunk], **kwargs[chunk[0]])
+            results.update(zip(chunk, chunk_results))
+
+    return {name: results[name] for name in gptqs}
+
+
+@torch.inference_mode()
+def quantize_stacked(
+    gptqs: List[GPTQ],
+    blocksize=128,
+    percdamp=0.01,
+    damp_auto_increment=0.0015,
+    group_size=-1,
+    actorder=False,
+    static_groups=False,
+    sparsity=0.0,
+    prune_n=0,
+    prune_m=0,
+    outlier_ratio=0.0,
+    adapter_rank=0,
+) -> List[Tuple]:
+    """
+    Batched `GPTQ.quantize()` of same-shape modules sharing the quantizer config: one batched cholesky and a column
+    sweep vectorized over the module batch. The per-row quantizer params are found on the `[K * rows, columns]` view.
+    Modules whose hessian can not be factorized at `percdamp` fall back to `GPTQ.quantize()` and its damp increment.
+    """
+    if static_groups:
+        raise NotImplementedError("quantize_stacked() does not support static_groups.")
+    if sparsity > 0 or prune_n or outlier_ratio > 0 or adapter_rank > 0:
+        raise NotImplementedError("quantize_stacked() does not support pruning, outliers or adapters.")
+
+    start = time.time()
+    first = gptqs[0]
+    K, rows, columns, device = len(gptqs), first.rows, first.columns, first.device
+    if blocksize is None:
+        blocksize = autotune_blocksize(rows, columns, device, group_size)
+
+    for g in gptqs:
+        if device.type not in ["mps", "cpu"]:
+            g.layer.weight.data = g.layer.weight.data.cpu()
+
+    W = torch.stack([g.layer_copy if g.layer_copy is not None else g._clone_layer() for g in gptqs])
+    H = torch.stack([g.hessian() for g in gptqs])
+    for g in gptqs:
+        g.layer_copy = None
+
+    dead = torch.diagonal(H, dim1=1, dim2=2) == 0
+    torch.diagonal(H, dim1=1, dim2=2)[dead] = 1
+    W.masked_fill_(dead.unsqueeze(1), 0)
+
+    if actorder:
+        perm = torch.argsort(torch.diagonal(H, dim1=1, dim2=2), dim=1, descending=True)
+        W = torch.gather(W, 2, perm.unsqueeze(1).expand(-1, rows, -1))
+        H = torch.gather(H, 1, perm.unsqueeze(2).expand(-1, -1, columns))
+        H = torch.gather(H, 2, perm.unsqueeze(1).expand(-1, columns, -1))
+        invperm = torch.argsort(perm, dim=1)
+
+    with trace_span("damp_cholesky", category="gptq", columns=columns, batch=K):
+        damp_start = time.time()
+        damp = percdamp * torch.mean(torch.diagonal(H, dim1=1, dim2=2), dim=1)
+        torch.diagonal(H, dim1=1, dim2=2).add_(damp.unsqueeze(1))
+        L, info = torch.linalg.cholesky_ex(H)
+        Hinv = torch.cholesky_inverse(L)
+        del L
+        Hinv, info_inv = torch.linalg.cholesky_ex(Hinv, upper=True)
+        del H
+        ok = ((info == 0) & (info_inv == 0)).tolist()
+        damp_time = time.time() - damp_start
+
+    results: List[Optional[Tuple]] = [None] * K
+    failed = [k for k in range(K) if not ok[k]]
+    for k in failed:
+        logger.warning(f"Batched solve: damp={percdamp:.5f} is too low for module {k} of {K}, solving it separately")
+        g = gptqs[k]
+        g.layer_copy = (W[k][:, invperm[k]] if actorder else W[k]).clone()
+        results[k] = g.quantize(blocksize, percdamp, damp_auto_increment, group_size, actorder, static_groups)
+
+    keep = [k for k in range(K) if ok[k]]
+    if not keep:
+        return results
+    if failed:
+        index = torch.tensor(keep, device=W.device)
+        W, Hinv = W[index], Hinv[index]
+        if actorder:
+            invperm = invperm[index]
+    gptqs_ok = [gptqs[k] for k in keep]
+    K = len(keep)
+
+    quantizer = copy.deepcopy(first.quantizer)
+    quantizer.find_params(W.reshape(K * rows, columns), weight=True)
+
+    scale = []
+    zero = []
+    loss = torch.zeros(K, device=W.device)
+
+    with trace_span("column_sweep", category="gptq", rows=rows, columns=columns, batch=K):
+        maxq = quantizer.maxq
+        group_scale, group_zero = quantizer.scale, quantizer.zero
+        for i1 in range(0, columns, blocksize):
+            i2 = min(i1 + blocksize, columns)
+            count = i2 - i1
+
+            W1 = W[:, :, i1:i2].clone()
+            Q1 = torch.zeros_like(W1)
+            Err1 = torch.zeros_like(W1)
+            Hinv1 = Hinv[:, i1:i2, i1:i2]
+
+            if group_size != -1:
+                starts = list(range(-(-i1 // group_size) * group_size, i2, group_size))
+                block_params = find_group_params(quantizer, W, starts, group_size)
+                for block_scale, block_zero in block_params:
+                    scale.append(block_scale)
+                    zero.append(block_zero)
+
+            for i in range(count):
+                w = W1[:, :, i]
+                d = Hinv1[:, i, i].unsqueeze(1)
+
+                if group_size != -1 and (i1 + i) % group_size == 0:
+                    group_scale, group_zero = block_params[((i1 + i) - starts[0]) // group_size]
+                    group_scale, group_zero = group_scale.reshape(K * rows, 1), group_zero.reshape(K * rows, 1)
+
+                q = quantize(w.reshape(K * rows, 1), group_scale, group_zero, maxq).reshape(K, rows)
+                Q1[:, :, i] = q
+
+                err1 = (w - q) / d
+                W1[:, :, i:] -= err1.unsqueeze(2) * Hinv1[:, i, i:].unsqueeze(1)
+                Err1[:, :, i] = err1
+
+            W[:, :, i1:i2] = Q1
+            loss += torch.sum(Err1 ** 2, dim=(1, 2)) / 2
+            W[:, :, i2:] -= torch.bmm(Err1, Hinv[:, i1:i2, i2:])
+
+    torch_sync(device)
+    Q = W
+
+    if not scale:
+        scale.append(quantizer.scale.reshape(K, rows, 1))
+        zero.append(quantizer.zero.reshape(K, rows, 1))
+    else:
+        quantizer.scale, quantizer.zero = scale[-1].reshape(K * rows, 1), zero[-1].reshape(K * rows, 1)
+    scale = torch.cat(scale, dim=2)
+    zero = torch.cat(zero, dim=2)
+
+    group_size = group_size if group_size != -1 else columns
+    g_idx = torch.arange(columns, dtype=torch.int32, device=Q.device) // group_size
+    if actorder:
+        Q = torch.gather(Q, 2, invperm.unsqueeze(1).expand(-1, rows, -1))
+
+    duration = (time.time() - start) / len(gptqs)
+    for e, (k, g) in enumerate(zip(keep, gptqs_ok)):
+        avg_loss = loss[e].item() / g.nsamples
+        if math.isnan(avg_loss):
+            raise ValueError("Quantization failed due to NaN loss")
+
+        Qk = Q[e]
+        if isinstance(g.layer, transformers.Conv1D):
+            Qk = Qk.t()
+        g.layer.weight.data = Qk.cpu().reshape(g.layer.weight.shape).type_as(g.layer.weight.data).to(device=device)
+
+        g.quantizer.scale = quantizer.scale.reshape(K, rows, 1)[e]
+        g.quantizer.zero = quantizer.zero.reshape(K, rows, 1)[e]
+        g.H = None
+        g.H_compensation = None
+
+        g.factorizations = 1
+        g.damp_time = damp_time
+        results[k] = (scale[e], zero[e], g_idx[invperm[e]] if actorder else g_idx.clone(), duration, avg_loss, percdamp)
+
+    return results
+
+
+__all__ = ["GPTQ", "quantize_batched", "quantize_stacked"]
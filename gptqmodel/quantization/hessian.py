@@ -0,0 +1,230 @@
+import os
+import random
+import threading
+import time
+from typing import Dict, Optional, Union
+
+import torch
+import torch.nn as nn
+import transformers
+
+from ..utils.logger import setup_logger
+from ..utils.torch import torch_sync
+
+logger = setup_logger()
+
+HESSIAN_SNAPSHOT_VERSION = 1
+# number of sampled calls per module that are timed with a device sync to calibrate the overhead estimate
+HESSIAN_TIMED_CALLS = 8
+
+
+class HessianCollector:
+    """
+    Accumulates GPTQ hessians (`2/n · Σ xᵀx` of every linear input) from live inference traffic, so a later
+    `quantize(hessians=...)` call can skip the calibration forward passes.
+
+    Works on a loaded fp16 model or a quantized model with dequantizing kernels: forward hooks are attached to the
+    `nn.Linear`, `Conv1D` and quant linear modules that `quantize()` would quantize.
+
+    Usage:
+
+    ```py
+    collector = HessianCollector(model, sample_rate=0.1, snapshot_path="hessians.pt")
+    with collector:
+        serve(model)  # regular inference
+    model = GPTQModel.load(model_id, quantize_config)
+    model.quantize(None, hessians="hessians.pt")
+    ```
+
+    Args:
+        model (`BaseGPTQModel` or `nn.Module`):
+            Model to hook. For a gptqmodel model only the modules of `layer_modules` are hooked.
+        sample_rate (`float`, defaults to `1.0`):
+            Probability that a forward call of a module is accumulated.
+        max_tokens (`int`, *optional*):
+            Tokens of a sampled call are randomly subsampled to at most this many rows.
+        overhead_budget (`float`, defaults to `0.05`):
+            Max estimated fraction of wall time spent in accumulation, calls are skipped while above budget.
+        snapshot_path (`str`, *optional*):
+            File the hessians are periodically saved to with `torch.save`.
+        snapshot_interval (`float`, defaults to `600`):
+            Seconds between snapshots.
+        device (`str` or `torch.device`, *optional*):
+            Device holding the hessians, defaults to the device of each module.
+    """
+
+    def __init__(
+        self,
+        model,
+        sample_rate: float = 1.0,
+        max_tokens: Optional[int] = None,
+        overhead_budget: float = 0.05,
+        snapshot_path: Optional[str] = None,
+        snapshot_interval: float = 600,
+        device: Optional[Union[str, torch.device]] = None,
+    ):
+        if not (0 < sample_rate <= 1):
+            raise ValueError("sample_rate must be between 0 and 1.")
+        if max_tokens is not None and max_tokens <= 0:
+            raise ValueError("max_tokens must be greater than 0.")
+        if overhead_budget <= 0:
+            raise ValueError("overhead_budget must be greater than 0.")
+
+        self.model = model
+        self.sample_rate = sample_rate
+        self.max_tokens = max_tokens
+        self.overhead_budget = overhead_budget
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.device = torch.device(device) if device is not None else None
+
+        self.hessians: Dict[str, torch.Tensor] = {}
+        self.nsamples: Dict[str, int] = {}
+        self.tokens: Dict[str, int] = {}
+        self.skipped = 0
+
+        self._handles = []
+        self._lock = threading.Lock()
+        self._start = None
+        self._last_snapshot = None
+        # estimated accumulation cost: seconds per row·column²
+        self._seconds_per_flop = None
+        self._timed_calls = {}
+        self._spent = 0.0
+
+    def modules(self) -> Dict[str, nn.Module]:
+        from ..nn_modules.qlinear import BaseQuantLinear
+        from ..utils.model import find_layers, get_module_by_name_prefix
+
+        types = [nn.Linear, transformers.pytorch_utils.Conv1D, BaseQuantLinear]
+        if not hasattr(self.model, "layers_node"):
+            return find_layers(self.model, types)
+
+        result = {}
+        layers = get_module_by_name_prefix(self.model.model, self.model.layers_node)
+        layer_modules = sum(self.model.get_layer_modules(), [])
+        for i, layer in enumerate(layers):
+            full = find_layers(layer, types)
+            for name in layer_modules:
+                if name in full:
+                    result[f"{self.model.layers_node}.{i}.{name}"] = full[name]
+        return result
+
+    def attach(self):
+        if self._handles:
+            return self
+
+        for name, module in self.modules().items():
+            self._handles.append(module.register_forward_hook(self._hook(name)))
+
+        self._start = time.perf_counter()
+        self._last_snapshot = self._start
+        logger.info(f"HessianCollector: attached to {len(self._handles)} modules")
+        return self
+
+    def detach(self):
+        for h in self._handles:
+            h.remove()
+        self._handles = []
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.detach()
+        if self.snapshot_path is not None:
+            self.snapshot()
+
+    def _hook(self, name: str):
+        def tmp(module, inp, out):
+            if random.random() >= self.sample_rate:
+                return
+            self.add_batch(name, inp[0])
+        return tmp
+
+    @torch.no_grad()
+    def add_batch(self, name: str, inp: torch.Tensor):
+        tmp = inp.shape[0] if len(inp.shape) == 3 else 1
+        inp = inp.reshape(-1, inp.shape[-1])
+        if self.max_tokens is not None and inp.shape[0] > self.max_tokens:
+            inp = inp[torch.randperm(inp.shape[0], device=inp.device)[:self.max_tokens]]
+
+        rows, columns = inp.shape
+        flops = rows * columns * columns
+        now = time.perf_counter()
+        if self._start is None:
+            self._start = self._last_snapshot = now
+        if self._seconds_per_flop is not None and self._spent > self.overhead_budget * (now - self._start):
+            self.skipped += 1
+            return
+
+        # time the first calls of every module with a sync, later calls are charged from the estimate
+        timed = self._timed_calls.get(name, 0) < HESSIAN_TIMED_CALLS
+        if timed:
+            torch_sync(inp.device)
+            start = time.perf_counter()
+
+        with self._lock:
+            H = self.hessians.get(name)
+            if H is None:
+                H = torch.zeros((columns, columns), dtype=torch.float32, device=self.device or inp.device)
+                self.hessians[name] = H
+                self.nsamples[name] = 0
+                self.tokens[name] = 0
+            x = inp.to(device=H.device, dtype=torch.float32)
+            # hooks may run inside the caller's autocast region, accumulation stays fp32
+            with torch.autocast(device_type="cuda" if x.device.type == "cuda" else "cpu", enabled=False):
+                H.addmm_(x.t(), x)
+            self.nsamples[name] += tmp
+            self.tokens[name] += rows
+
+        if timed:
+            torch_sync(inp.device)
+            seconds = time.perf_counter() - start
+            self._timed_calls[name] = self._timed_calls.get(name, 0) + 1
+            rate = seconds / flops
+            self._seconds_per_flop = rate if self._seconds_per_flop is None else 0.5 * (self._seconds_per_flop + rate)
+            self._spent += seconds
+        else:
+            self._spent += flops * self._seconds_per_flop
+
+        if self.snapshot_path is not None and now - self._last_snapshot >= self.snapshot_interval:
+            self._last_snapshot = now
+            self.snapshot()
+
+    def state_dict(self) -> Dict:
+        with self._lock:
+            return {
+                "version": HESSIAN_SNAPSHOT_VERSION,
+                "hessians": {name: H.to("cpu", copy=True) for name, H in self.hessians.items()},
+                "nsamples": dict(self.nsamples),
+                "tokens": dict(self.tokens),
+            }
+
+    def snapshot(self, path: Optional[str] = None):
+        path = path or self.snapshot_path
+        if path is None:
+            raise ValueError("HessianCollector: snapshot path is not set.")
+
+        # write then rename so a crash never leaves a truncated snapshot behind
+        tmp_path = f"{path}.tmp"
+        torch.save(self.state_dict(), tmp_path)
+        os.replace(tmp_path, path)
+        logger.info(f"HessianCollector: saved hessians of {len(self.hessians)} modules to {path}, skipped calls: {self.skipped}")
+
+
+def load_hessians(hessians: Union[str, Dict]) -> Dict:
+    """Load a `HessianCollector` snapshot, returns the `{"hessians", "nsamples", "tokens"}` dict."""
+    if isinstance(hessians, HessianCollector):
+        hessians = hessians.state_dict()
+    elif isinstance(hessians, str):
+        hessians = torch.load(hessians, map_location="cpu", weights_only=True)
+
+    if not isinstance(hessians, dict) or "hessians" not in hessians or "nsamples" not in hessians:
+        raise ValueError("hessians must be a HessianCollector, its state_dict() or a path to a snapshot.")
+    if hessians.get("version", HESSIAN_SNAPSHOT_VERSION) > HESSIAN_SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported hessian snapshot version: {hessians['version']}")
+    return hessians
+
+
+__all__ = ["HessianCollector", "load_hessians"]
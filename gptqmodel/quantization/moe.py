@@ -0,0 +1,86 @@
+import re
+from typing import Dict, List
+
+import torch
+
+from ..models._const import EXPERT_INDEX_PLACEHOLDER
+from ..utils.logger import setup_logger
+from ..utils.trace import trace_span
+from .gptq import GPTQ
+
+logger = setup_logger()
+
+# max bytes of the stacked fp32 expert hessian updates computed by one batched matmul
+MOE_BATCH_BYTES = 512 * 1024 * 1024
+
+
+def expert_module_pattern(layer_modules: List[List[str]]) -> re.Pattern:
+    """Regex matching the expanded expert module names of `layer_modules` that use `EXPERT_INDEX_PLACEHOLDER`."""
+    templates = [n for names in layer_modules for n in names if EXPERT_INDEX_PLACEHOLDER in n]
+    patterns = [re.escape(n).replace(re.escape(EXPERT_INDEX_PLACEHOLDER), r"\d+") for n in templates]
+    # never matches when the model has no expert modules
+    return re.compile("^(" + "|".join(patterns) + ")$" if patterns else r"(?!)")
+
+
+class ExpertHessianAccumulator:
+    """
+    Batched hessian accumulation for the expert modules of a MoE layer.
+
+    The expert forward hooks fire once per expert inside the HF expert loop, each with only the tokens routed to
+    that expert. Instead of one small `add_batch` GEMM per hook, the routed tokens are buffered and `flush()`, called
+    once per calibration batch, updates the hessians of all experts with the same input width in a single batched
+    matmul. The result is identical to calling `GPTQ.add_batch` for every hook: every hook call counts as one sample.
+
+    Routed token counts per expert are kept in `tokens`, `starved()` lists experts whose hessian is rank deficient.
+    """
+
+    def __init__(self, gptq: Dict[str, GPTQ]):
+        self.gptq = gptq
+        self.pending: Dict[str, List[torch.Tensor]] = {name: [] for name in gptq}
+        self.tokens: Dict[str, int] = {name: 0 for name in gptq}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.gptq
+
+    def add(self, name: str, inp: torch.Tensor):
+        inp = inp.reshape(-1, inp.shape[-1])
+        self.pending[name].append(inp)
+        self.tokens[name] += inp.shape[0]
+
+    @torch.no_grad()
+    def flush(self):
+        groups = {}
+        for name, inps in self.pending.items():
+            if inps:
+                g = self.gptq[name]
+                groups.setdefault((g.columns, g.device), []).append(name)
+
+        for (columns, device), names in groups.items():
+            chunk = max(1, MOE_BATCH_BYTES // (columns * columns * 4))
+            for start in range(0, len(names), chunk):
+                self._update(names[start:start + chunk], columns, device)
+
+        for name in self.pending:
+            self.pending[name] = []
+
+    def _update(self, names: List[str], columns: int, device: torch.device):
+        inps = [torch.cat(self.pending[name], dim=0) for name in names]
+        rows = max(inp.shape[0] for inp in inps)
+
+        with trace_span("moe_add_batch", category="gptq", experts=len(names), columns=columns):
+            # zero padded rows do not contribute to xᵀx
+            x = torch.zeros((len(names), rows, columns), dtype=torch.float32, device=device)
+            for e, inp in enumerate(inps):
+                x[e, :inp.shape[0]] = inp.to(device=device, dtype=torch.float32)
+            with torch.autocast(device_type=device.type, enabled=False):
+                xtx = torch.bmm(x.transpose(1, 2), x)
+            del x
+
+            for e, name in enumerate(names):
+                self.gptq[name].add_hessian(xtx[e], len(self.pending[name]))
+
+    def starved(self) -> List[str]:
+        return [name for name, tokens in self.tokens.items() if tokens < self.gptq[name].columns]
+
+
+__all__ = ["ExpertHessianAccumulator", "expert_module_pattern"]
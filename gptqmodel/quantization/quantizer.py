@@ -8,6 +8,9 @@ from ..utils.logger import setup_logger
 
 logger = setup_logger()
 
+# max bytes of the quantized candidates evaluated at once by the mse clipping search
+MSE_SEARCH_CHUNK_BYTES = 256 * 1024 * 1024
+
 
 def quantize(x, scale, zero, maxq):
     if maxq < 0:
@@ -32,6 +35,7 @@ class Quantizer(nn.Module):
         grid=100,
         maxshrink=0.8,
         trits=False,
+        mse_search_step=1,
     ):
         self.maxq = torch.tensor(2**bits - 1)
         self.perchannel = perchannel
@@ -39,6 +43,8 @@ class Quantizer(nn.Module):
         self.mse = mse
         self.grid = grid
         self.maxshrink = maxshrink
+        # >1: coarse search over every n-th shrink factor, then a fine search around the best one of each row
+        self.mse_search_step = mse_search_step
         if trits:
             self.maxq = torch.tensor(-1)
 
@@ -85,23 +91,7 @@ class Quantizer(nn.Module):
                 self.zero = torch.round(-xmin / self.scale)
 
         if self.mse > 0.0:
-            best = torch.full([x.shape[0]], float("inf"), device=dev)
-            for i in range(int(self.maxshrink * self.grid)):
-                p = 1 - i / self.grid
-                xmin1 = p * xmin
-                xmax1 = p * xmax
-                scale1 = (xmax1 - xmin1) / self.maxq
-                zero1 = torch.round(-xmin1 / scale1) if not self.sym else self.zero
-                q = quantize(x, scale1.unsqueeze(1), zero1.unsqueeze(1), self.maxq)
-                q -= x
-                q.abs_()
-                q.pow_(self.mse)
-                err = torch.sum(q, 1)
-                tmp = err < best
-                if torch.any(tmp):
-                    best[tmp] = err[tmp]
-                    self.scale[tmp] = scale1[tmp]
-                    self.zero[tmp] = zero1[tmp]
+            self._mse_search(x, xmin, xmax)
         if not self.perchannel:
             if weight:
                 tmp = shape[0]
@@ -125,6 +115,48 @@ class Quantizer(nn.Module):
             self.scale = self.scale.unsqueeze(0)
             self.zero = self.zero.unsqueeze(0)
 
+    def _mse_search(self, x, xmin, xmax):
+        # clipping search over shrink factors p = 1 - i / grid, the first factor with the lowest error wins
+        steps = int(self.maxshrink * self.grid)
+        rows = x.shape[0]
+        best = torch.full([rows], float("inf"), device=x.device)
+        step = self.mse_search_step
+        if step > 1:
+            coarse = torch.arange(0, steps, step, device=x.device).unsqueeze(1).expand(-1, rows)
+            best_i = self._mse_grid(x, xmin, xmax, coarse, best)
+            offsets = torch.arange(-step + 1, step, device=x.device).unsqueeze(1)
+            self._mse_grid(x, xmin, xmax, (best_i.unsqueeze(0) + offsets).clamp(0, steps - 1), best)
+        else:
+            self._mse_grid(x, xmin, xmax, torch.arange(steps, device=x.device).unsqueeze(1).expand(-1, rows), best)
+
+    def _mse_grid(self, x, xmin, xmax, indices, best):
+        # evaluate the `[candidates, rows]` shrink factor indices in chunks, update scale/zero of improved rows
+        rows, columns = x.shape
+        best_i = torch.zeros(rows, dtype=torch.long, device=x.device)
+        arange = torch.arange(rows, device=x.device)
+        chunk = max(1, MSE_SEARCH_CHUNK_BYTES // (2 * rows * columns * x.element_size()))
+        for start in range(0, indices.shape[0], chunk):
+            idx = indices[start:start + chunk]
+            p = (1 - idx.double() / self.grid).to(x.dtype)
+            xmin1 = p * xmin
+            xmax1 = p * xmax
+            scale1 = (xmax1 - xmin1) / self.maxq
+            zero1 = torch.round(-xmin1 / scale1) if not self.sym else self.zero.expand_as(scale1)
+            q = quantize(x, scale1.unsqueeze(2), zero1.unsqueeze(2), self.maxq)
+            q -= x
+            q.abs_()
+            q.pow_(self.mse)
+            err = torch.sum(q, 2)
+            del q
+
+            chunk_err, chunk_arg = torch.min(err, 0)
+            tmp = chunk_err < best
+            best[tmp] = chunk_err[tmp]
+            self.scale[tmp] = scale1[chunk_arg, arange][tmp]
+            self.zero[tmp] = zero1[chunk_arg, arange][tmp]
+            best_i[tmp] = idx[chunk_arg, arange][tmp]
+        return best_i
+
     def quantize(self, x):
         if self.ready():
             return quantize(x, self.scale, self.zero, self.maxq)
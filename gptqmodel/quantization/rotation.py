@@ -0,0 +1,164 @@
+import math
+from typing import Dict, Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+from .config import ROTATION
+
+
+def fast_hadamard_transform(x: torch.Tensor) -> torch.Tensor:
+    # `x @ H / sqrt(n)` over the last dim, `H` is the sylvester hadamard matrix of the power of 2 size `n`
+    shape = x.shape
+    n = shape[-1]
+    if n & (n - 1) != 0:
+        raise ValueError(f"fast_hadamard_transform requires a power of 2 size, got {n}.")
+
+    x = x.reshape(-1, n)
+    h = 1
+    while h < n:
+        x = x.view(-1, n // (2 * h), 2, h)
+        x = torch.stack((x[:, :, 0] + x[:, :, 1], x[:, :, 0] - x[:, :, 1]), dim=2)
+        h *= 2
+    return x.reshape(shape) / math.sqrt(n)
+
+
+def random_orthogonal(n: int, seed: int) -> torch.Tensor:
+    # `[n, n]` fp64, deterministic for a seed on every machine
+    generator = torch.Generator().manual_seed(seed)
+    q, r = torch.linalg.qr(torch.randn((n, n), generator=generator, dtype=torch.float64))
+    return q * torch.sign(torch.diagonal(r)).unsqueeze(0)
+
+
+def hadamard_factor(n: int, seed: int) -> Optional[torch.Tensor]:
+    """
+    Sizes that are not a power of 2 are split into `k * 2^m` with odd `k`, the transform is `kron(factor, H_2^m)`
+    with a random orthogonal `[k, k]` factor (i.e. 11008 = 43 * 256 of llama 2 7b). None for powers of 2.
+    """
+    k = n // (n & -n)
+    return random_orthogonal(k, seed) if k > 1 else None
+
+
+def hadamard_transform(x: torch.Tensor, factor: Optional[torch.Tensor]) -> torch.Tensor:
+    # `x @ kron(factor, H_2^m) / sqrt(2^m)` over the last dim, orthogonal
+    if factor is None:
+        return fast_hadamard_transform(x)
+
+    shape = x.shape
+    k = factor.shape[0]
+    x = fast_hadamard_transform(x.reshape(*shape[:-1], k, shape[-1] // k))
+    return torch.matmul(factor.t().to(device=x.device, dtype=x.dtype), x).reshape(shape)
+
+
+def rotation_matrix(n: int, rotation: str, seed: int) -> torch.Tensor:
+    # `[n, n]` fp64 orthogonal rotation of the residual stream
+    if rotation == ROTATION.RANDOM:
+        return random_orthogonal(n, seed)
+    if rotation == ROTATION.HADAMARD:
+        generator = torch.Generator().manual_seed(seed)
+        signs = torch.randint(0, 2, (n,), generator=generator).to(torch.float64) * 2 - 1
+        return hadamard_transform(torch.diag(signs), hadamard_factor(n, seed + 1))
+    raise ValueError(f"Unknown rotation: {rotation}.")
+
+
+def _rotate_input(module: nn.Module, Q: torch.Tensor, norm: Optional[nn.Module] = None):
+    # `W @ Q` for modules reading the rotated stream, `norm` weights are fused first
+    W = module.weight.data
+    rotated = W.to(torch.float64)
+    if norm is not None:
+        rotated = rotated * norm.weight.data.to(device=W.device, dtype=torch.float64)
+    module.weight.data = (rotated @ Q.to(W.device)).to(W.dtype)
+
+
+def _rotate_output(module: nn.Module, Q: torch.Tensor):
+    # `Q^T @ W` for modules writing to the rotated stream
+    W = module.weight.data
+    Q = Q.to(W.device)
+    module.weight.data = (Q.t() @ W.to(torch.float64)).to(W.dtype)
+    if module.bias is not None:
+        module.bias.data = (module.bias.data.to(torch.float64) @ Q).to(module.bias.dtype)
+
+
+@torch.no_grad()
+def rotate_model(model: nn.Module, definition, rotation: str, seed: int = 0):
+    """
+    Rotates the residual stream of a llama style model in place by an orthogonal `Q`. Norm weights are fused into the
+    modules reading the normalized hidden states, modules reading the stream get `W @ Q` and modules writing to it
+    `Q^T @ W`. Rms norms are rotation invariant, so the outputs do not change while outliers are spread over all
+    channels. `definition` is the model definition (`rotation_norms`, `rotation_outputs`, `rotation_online`,
+    `rotation_final_norm`, `layers_node`, `lm_head`). The weights of the `rotation_online` modules get the hadamard
+    transform of their inputs, register_online_rotation() applies it to the activations.
+    """
+    embeddings = model.get_input_embeddings()
+    lm_head = model.get_submodule(definition.lm_head)
+    if lm_head.weight is embeddings.weight:
+        # the embeddings and lm_head get different weights
+        lm_head.weight = nn.Parameter(lm_head.weight.data.clone())
+        model.config.tie_word_embeddings = False
+
+    Q = rotation_matrix(embeddings.weight.shape[1], rotation, seed)
+
+    _rotate_input(embeddings, Q)
+    final_norm = model.get_submodule(definition.rotation_final_norm)
+    _rotate_input(lm_head, Q, final_norm)
+    final_norm.weight.data.fill_(1)
+
+    factors = {}
+    for layer in model.get_submodule(definition.layers_node):
+        for norm_name, names in definition.rotation_norms.items():
+            norm = layer.get_submodule(norm_name)
+            for name in names:
+                _rotate_input(layer.get_submodule(name), Q, norm)
+            norm.weight.data.fill_(1)
+
+        for name in definition.rotation_outputs:
+            _rotate_output(layer.get_submodule(name), Q)
+
+        for name in definition.rotation_online:
+            module = layer.get_submodule(name)
+            W = module.weight.data
+            factor = _cached_factor(factors, W.shape[1], seed)
+            module.weight.data = hadamard_transform(W.to(torch.float64), factor).to(W.dtype)
+
+
+def _cached_factor(factors: Dict[int, Optional[torch.Tensor]], n: int, seed: int) -> Optional[torch.Tensor]:
+    # online factors use their own seed, independent of the residual rotation
+    if n not in factors:
+        factors[n] = hadamard_factor(n, seed + 2)
+    return factors[n]
+
+
+class OnlineHadamard:
+    # forward pre hook, hadamard transform of the first input in fp32
+    def __init__(self, factor: Optional[torch.Tensor]):
+        self.factor = factor
+        # fp32 copies of the factor per device
+        self.factors: Dict[torch.device, torch.Tensor] = {}
+
+    def __call__(self, module: nn.Module, args: Tuple):
+        x = args[0]
+        factor = self.factor
+        if factor is not None:
+            if x.device not in self.factors:
+                self.factors[x.device] = factor.to(device=x.device, dtype=torch.float32)
+            factor = self.factors[x.device]
+        return (hadamard_transform(x.float(), factor).to(x.dtype),) + args[1:]
+
+
+def register_online_rotation(model: nn.Module, definition, seed: int = 0):
+    """
+    Registers the online hadamard transform of the `rotation_online` module inputs of a rotated model. Modules that
+    are replaced later (i.e. by quant linears) lose it and need another call, registered modules are skipped.
+    """
+    factors = {}
+    for layer in model.get_submodule(definition.layers_node):
+        for name in definition.rotation_online:
+            module = layer.get_submodule(name)
+            if getattr(module, "online_rotation", None) is not None:
+                continue
+            features = module.in_features if hasattr(module, "in_features") else module.infeatures
+            module.online_rotation = OnlineHadamard(_cached_factor(factors, features, seed))
+            module.register_forward_pre_hook(module.online_rotation)
+
+
+__all__ = ["fast_hadamard_transform", "hadamard_transform", "register_online_rotation", "rotate_model", "rotation_matrix"]
@@ -0,0 +1,89 @@
+from typing import Tuple
+
+import torch
+
+from .config import RTN_METHOD
+from .gptq import find_group_params
+from .quantizer import Quantizer, quantize
+
+
+def _group_error(W: torch.Tensor, column_scale: torch.Tensor, zero: torch.Tensor, maxq: torch.Tensor,
+                 g_idx: torch.Tensor, n_groups: int) -> torch.Tensor:
+    # `[rows, n_groups]` sum of absolute quantization errors, scales are given per column
+    err = (quantize(W, column_scale, zero[:, g_idx], maxq) - W).abs_()
+    return torch.zeros((W.shape[0], n_groups), dtype=W.dtype, device=W.device).index_add_(1, g_idx, err)
+
+
+def hqq_zero(
+    W: torch.Tensor,
+    scale: torch.Tensor,
+    zero: torch.Tensor,
+    maxq: torch.Tensor,
+    g_idx: torch.Tensor,
+    iters: int = 20,
+    lp_norm: float = 0.7,
+    beta: float = 10.0,
+    kappa: float = 1.01,
+) -> torch.Tensor:
+    """
+    Half-quadratic (hqq) optimization of the `[rows, n_groups]` zero points of `W` for fixed scales. The zero points
+    of gptq checkpoints are integers, every iterate is rounded and the best rounded zero point of each group is kept.
+    """
+    n_groups = zero.shape[1]
+    counts = torch.bincount(g_idx, minlength=n_groups).to(W.dtype)
+    s = scale[:, g_idx]
+
+    best_zero = zero.clone()
+    best_err = _group_error(W, s, best_zero, maxq, g_idx, n_groups)
+    z = zero.clone()
+    for _ in range(iters):
+        zc = z[:, g_idx]
+        Wq = torch.clamp(torch.round(W / s + zc), 0, maxq)
+        # generalized soft thresholding of the error, the lp (p < 1) proximal step
+        We = W - (Wq - zc) * s
+        We = torch.sign(We) * torch.relu(We.abs() - (1 / beta) * We.abs().clamp_min(1e-12).pow(lp_norm - 1))
+        z = torch.zeros_like(z).index_add_(1, g_idx, Wq - (W - We) / s) / counts
+        beta *= kappa
+
+        rounded = torch.clamp(torch.round(z), 0, maxq)
+        err = _group_error(W, s, rounded, maxq, g_idx, n_groups)
+        better = err < best_err
+        best_zero = torch.where(better, rounded, best_zero)
+        best_err = torch.where(better, err, best_err)
+    return best_zero
+
+
+@torch.inference_mode()
+def rtn_quantize(
+    W: torch.Tensor,
+    bits: int,
+    group_size: int,
+    sym: bool,
+    mse: float = 0.0,
+    method: str = RTN_METHOD.RTN,
+    hqq_iters: int = 20,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Calibration free quantization of a `[rows, columns]` weight, all groups at once.
+    Returns `(Q, scale, zero, g_idx)` like `GPTQ.quantize()` leaves them: `Q` is the dequantized weight, `scale` and
+    `zero` are `[rows, n_groups]`.
+    """
+    W = W.float()
+    columns = W.shape[1]
+    group_size = group_size if group_size != -1 else columns
+
+    quantizer = Quantizer()
+    quantizer.configure(bits, perchannel=True, sym=sym, mse=mse)
+    params = find_group_params(quantizer, W, list(range(0, columns, group_size)), group_size)
+    scale = torch.cat([p[0] for p in params], dim=1)
+    zero = torch.cat([p[1] for p in params], dim=1)
+
+    g_idx = torch.arange(columns, device=W.device) // group_size
+    if method == RTN_METHOD.HQQ:
+        zero = hqq_zero(W, scale, zero, quantizer.maxq, g_idx, iters=hqq_iters)
+
+    Q = quantize(W, scale[:, g_idx], zero[:, g_idx], quantizer.maxq)
+    return Q, scale, zero, g_idx.to(torch.int32)
+
+
+__all__ = ["hqq_zero", "rtn_quantize"]
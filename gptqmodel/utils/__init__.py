@@ -2,3 +2,4 @@ from .backend import BACKEND
 from .eval import EVAL
 from .perplexity import Perplexity
 from .vram import get_vram
+from .trace import Tracer
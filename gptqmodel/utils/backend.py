@@ -6,6 +6,7 @@ class BACKEND(str, Enum):
     AUTO_TRAINABLE = "auto_trainable" # choose the optimal trainable local kernel for post-quant training
     CUDA = "cuda"
     TORCH = "torch"
+    TORCH_SPARSE = "torch_sparse" # reference kernel of FORMAT.GPTQ_SPARSE
     TRITON = "triton"
     EXLLAMA_V1 = "exllama_v1"
     EXLLAMA_V2 = "exllama_v2"
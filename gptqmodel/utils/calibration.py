@@ -1,3 +1,16 @@
+from typing import Any, Dict, List, Optional
+
+import torch
+import torch.nn as nn
+
+from .logger import setup_logger
+
+logger = setup_logger()
+
+# candidates whose embedding cosine similarity to an already kept candidate is above this are duplicates
+CALIBRATION_DEDUP_THRESHOLD = 0.98
+
+
 def batched(iterable, n: int, process_func):
     # batched('ABCDEFG', 3) → ABC DEF G
     assert n >= 1, "batch size must be at least one"
@@ -10,3 +23,100 @@ def batched(iterable, n: int, process_func):
             yield batch
         else:
             yield [process_func(item) for item in batch]
+
+
+def calibration_input_ids(sample: Any, tokenizer=None) -> List[int]:
+    """Token ids of one `quantize()` calibration sample: str, List[int] or dict with `input_ids`."""
+    if isinstance(sample, str):
+        if tokenizer is None:
+            raise ValueError("tokenizer must be provided when calibration_dataset is List[str].")
+        return tokenizer(sample)["input_ids"]
+    if isinstance(sample, dict):
+        sample = sample["input_ids"]
+    if isinstance(sample, torch.Tensor):
+        return sample.reshape(-1).tolist()
+    if sample and isinstance(sample[0], list):
+        return sample[0]
+    return list(sample)
+
+
+@torch.no_grad()
+def calibration_forward(layer: nn.Module, layer_input: List[torch.Tensor], layer_kwargs: Dict[str, Any],
+                        dtype: Optional[torch.dtype] = None):
+    """
+    Calibration forward of one layer, under autocast to `dtype` on the device of its inputs if set (i.e. bf16 on cpus
+    with amx/avx512-bf16). The first output is cast back to the dtype of the first input, so the next layer reads its
+    inputs in the dtype they were captured in. GPTQ.add_batch() hooks disable autocast again.
+    """
+    if dtype is None:
+        return layer(*layer_input, **layer_kwargs)
+
+    with torch.autocast(device_type=layer_input[0].device.type, dtype=dtype):
+        output = layer(*layer_input, **layer_kwargs)
+    if isinstance(output, (tuple, list)):
+        return (output[0].to(layer_input[0].dtype), *output[1:])
+    return output.to(layer_input[0].dtype)
+
+
+def embed_calibration_samples(input_ids: List[List[int]], embed_tokens: nn.Module) -> torch.Tensor:
+    """L2 normalized mean of the input embeddings of every sample, `[num_samples, hidden_size]` in fp32."""
+    device = embed_tokens.weight.device
+    embeddings = []
+    for ids in input_ids:
+        if len(ids) == 0:
+            embeddings.append(torch.zeros(embed_tokens.weight.shape[1], device=device))
+            continue
+        embeddings.append(embed_tokens(torch.tensor(ids, dtype=torch.long, device=device)).float().mean(dim=0))
+    return torch.nn.functional.normalize(torch.stack(embeddings), dim=1)
+
+
+def select_calibration_samples(
+    embeddings: torch.Tensor,
+    lengths: List[int],
+    max_samples: Optional[int] = None,
+    max_tokens: Optional[int] = None,
+    dedup_threshold: float = CALIBRATION_DEDUP_THRESHOLD,
+) -> List[int]:
+    """
+    Indices of a diverse subset of calibration samples, in their original order.
+
+    Near duplicates (cosine similarity above `dedup_threshold`) are dropped, then samples are picked greedily by
+    k-center coverage: each pick is the sample farthest from all picked samples, starting with the one closest to
+    the mean. Picking stops at `max_samples` or when no remaining sample fits the `max_tokens` budget.
+    """
+    n = embeddings.shape[0]
+    max_samples = n if max_samples is None else min(max_samples, n)
+
+    kept = torch.zeros(n, dtype=torch.bool, device=embeddings.device)
+    for start in range(0, n, 1024):
+        end = min(start + 1024, n)
+        similarity = embeddings[start:end] @ embeddings[:end].t()
+        for j in range(start, end):
+            kept[j] = not torch.any((similarity[j - start, :j] > dedup_threshold) & kept[:j]).item()
+    keep = torch.nonzero(kept).flatten().tolist()
+    if len(keep) < n:
+        logger.info(f"Calibration selection: removed {n - len(keep)} near duplicate samples")
+
+    candidates = embeddings[keep]
+    candidate_lengths = torch.tensor([lengths[k] for k in keep], device=embeddings.device)
+    remaining_tokens = max_tokens if max_tokens is not None else int(candidate_lengths.sum().item())
+    picked = torch.zeros(len(keep), dtype=torch.bool, device=embeddings.device)
+    # cosine distance of every candidate to its nearest picked sample
+    min_dist = torch.full((len(keep),), float("inf"), device=embeddings.device)
+    # the first pick is the sample closest to the mean embedding
+    score = candidates @ torch.nn.functional.normalize(candidates.mean(dim=0), dim=0)
+
+    selected = []
+    while len(selected) < max_samples:
+        score = torch.where((candidate_lengths <= remaining_tokens) & ~picked, score, torch.full_like(score, -float("inf")))
+        pick = int(torch.argmax(score).item())
+        if score[pick] == -float("inf"):
+            break
+
+        picked[pick] = True
+        selected.append(keep[pick])
+        remaining_tokens -= lengths[keep[pick]]
+        min_dist = torch.minimum(min_dist, 1 - candidates @ candidates[pick])
+        score = min_dist.clone()
+
+    return sorted(selected)
@@ -1,8 +1,22 @@
 import base64
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+from typing import Any, Callable, Iterable, List, Optional
 
 import requests
+import torch
 from PIL import Image
+from transformers import BatchFeature
+
+from .logger import setup_logger
+
+logger = setup_logger()
+
+# threads decoding/resizing calibration images, image work is mostly I/O and C code that releases the GIL
+IMAGE_PIPELINE_WORKERS = min(8, os.cpu_count() or 1)
 
 
 def extract_vision_info(conversations: list[dict] | list[list[dict]]) -> list[dict]:
@@ -45,3 +59,95 @@ def fetch_image(ele: dict[str, str | Image.Image]) -> Image.Image:
     if image_obj is None:
         raise ValueError(f"Unrecognized image input, support local path, http url, base64 and PIL.Image, got {image}")
     return image_obj
+
+
+def load_image(ele: dict[str, str | Image.Image]) -> Image.Image:
+    """`fetch_image` that decodes the image right away, `Image.open` alone only reads the header."""
+    image = fetch_image(ele)
+    image.load()
+    return image
+
+
+def fetch_images(vision_infos: List[dict], num_workers: int = IMAGE_PIPELINE_WORKERS) -> List[Image.Image]:
+    if num_workers <= 1 or len(vision_infos) <= 1:
+        return [load_image(ele) for ele in vision_infos]
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(load_image, vision_infos))
+
+
+def image_fingerprint(ele: dict[str, str | Image.Image]) -> str:
+    """Content hash of an image input: file bytes for local paths, pixels for PIL images, the url otherwise."""
+    image = ele["image"] if "image" in ele else ele["image_url"]
+    h = hashlib.sha256()
+    if isinstance(image, Image.Image):
+        h.update(f"{image.mode}:{image.size}".encode())
+        h.update(image.tobytes())
+        return h.hexdigest()
+
+    path = image[7:] if image.startswith("file://") else image
+    if not image.startswith(("http://", "https://", "data:image")) and os.path.isfile(path):
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    h.update(image.encode())
+    return h.hexdigest()
+
+
+class ProcessedBatchCache:
+    """
+    On-disk cache of processed calibration batches (`BatchFeature` of pixel values, input ids, etc.), keyed by a
+    content hash of everything that went into the processor, so repeated quantization runs skip image decode and
+    preprocessing.
+    """
+
+    def __init__(self, cache_dir: str, namespace: str):
+        self.cache_dir = os.path.join(cache_dir, namespace)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        h = hashlib.sha256()
+        for part in parts:
+            h.update(repr(part).encode())
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def get(self, key: str) -> Optional[BatchFeature]:
+        path = self._path(key)
+        if not os.path.isfile(path):
+            self.misses += 1
+            return None
+        try:
+            data = torch.load(path, map_location="cpu", weights_only=True)
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable calibration cache entry {path}: {e}")
+            self.misses += 1
+            return None
+        self.hits += 1
+        return BatchFeature(data=data)
+
+    def put(self, key: str, inputs: BatchFeature):
+        # write then rename so concurrent or interrupted runs never read a partial entry
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        torch.save({k: v for k, v in inputs.items()}, tmp_path)
+        os.replace(tmp_path, path)
+
+
+def process_batches(
+    batches: Iterable,
+    process_func: Callable[[Any], Any],
+    num_workers: int = IMAGE_PIPELINE_WORKERS,
+) -> List:
+    """`process_func` over all batches on a thread pool, results keep the batch order."""
+    if num_workers <= 1:
+        return [process_func(batch) for batch in batches]
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(process_func, batches))
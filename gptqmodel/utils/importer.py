@@ -13,6 +13,7 @@ from ..nn_modules.qlinear.exllamav2 import ExllamaV2QuantLinear
 from ..nn_modules.qlinear.ipex import IPEXQuantLinear
 from ..nn_modules.qlinear.marlin import MarlinQuantLinear
 from ..nn_modules.qlinear.torch import TorchQuantLinear
+from ..nn_modules.qlinear.torch_sparse import TorchSparseQuantLinear
 from ..nn_modules.qlinear.tritonv2 import TRITON_AVAILABLE, TRITON_INSTALL_HINT, TritonV2QuantLinear
 from ..quantization import FORMAT
 from ..utils.logger import setup_logger
@@ -31,6 +32,7 @@ backend_dict = OrderedDict({
     BACKEND.BITBLAS: BitBLASQuantLinear,
     BACKEND.IPEX: IPEXQuantLinear,
     BACKEND.TORCH: TorchQuantLinear,
+    BACKEND.TORCH_SPARSE: TorchSparseQuantLinear,
 })
 
 format_dict = {
@@ -39,6 +41,7 @@ format_dict = {
     FORMAT.MARLIN: [BACKEND.MARLIN],
     FORMAT.BITBLAS: [BACKEND.BITBLAS],
     FORMAT.IPEX: [BACKEND.IPEX],
+    FORMAT.GPTQ_SPARSE: [BACKEND.TORCH_SPARSE],
 }
 
 def normalize_device_device_map(device: Optional[Union[str, torch.device]], device_map: Optional[Union[str, Dict]]) -> Optional[DEVICE]:
@@ -137,6 +140,7 @@ def select_quant_linear(
         pack: bool = False,
         allow_marlin: bool = True,  # TODO: remove this after marlin padding is fixed
         dynamic=None,
+        outliers: bool = False,
 ) -> Type[BaseQuantLinear]:
     backend = BACKEND.AUTO if backend is None else backend
 
@@ -158,7 +162,7 @@ def select_quant_linear(
         # Suppose all quant linears in the model should have the same backend.
         for k, v in allow_quant_linears.items():
             in_allow_backends = k in allow_backends
-            validate, err = v.validate(bits=bits, group_size=group_size, desc_act=desc_act, sym=sym, dynamic=dynamic, device=device, trainable=trainable)
+            validate, err = v.validate(bits=bits, group_size=group_size, desc_act=desc_act, sym=sym, dynamic=dynamic, device=device, trainable=trainable, outliers=outliers)
             if os.environ.get("DEBUG") and in_allow_backends and not validate:
                 logger.info(f"skip {k} for {str(err)}")
             if in_allow_backends and validate:
@@ -207,10 +211,12 @@ def select_quant_linear(
         qlinear = IPEXQuantLinear
     elif backend == BACKEND.TORCH:
         qlinear = TorchQuantLinear
+    elif backend == BACKEND.TORCH_SPARSE:
+        qlinear = TorchSparseQuantLinear
     else:
         qlinear = TorchQuantLinear
 
-    validate, err = qlinear.validate(bits=bits, group_size=group_size, desc_act=desc_act, sym=sym, dynamic=dynamic, device=device, trainable=trainable)
+    validate, err = qlinear.validate(bits=bits, group_size=group_size, desc_act=desc_act, sym=sym, dynamic=dynamic, device=device, trainable=trainable, outliers=outliers)
     if not validate:
         raise ValueError(err)
     else:
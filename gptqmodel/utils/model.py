@@ -17,6 +17,7 @@ import torch.nn as nn
 import transformers
 from huggingface_hub import HfApi, hf_hub_download
 from packaging import version
+from safetensors import safe_open
 from transformers import AutoConfig, PretrainedConfig
 from transformers.utils.hub import cached_file
 
@@ -33,6 +34,7 @@ from .importer import select_quant_linear
 from .logger import setup_logger
 from .progress import ProgressBar
 from .torch import torch_empty_cache
+from .trace import trace_span
 
 logger = setup_logger()
 
@@ -121,6 +123,8 @@ def make_quant(
     dynamic=None,
     device: DEVICE = None,
     from_quantized: bool = False,
+    outlier_ratio: float = 0.0,
+    adapter_rank: int = 0,
 ) -> BaseQuantLinear:
     QuantLinear = select_quant_linear(
         bits=bits,
@@ -132,6 +136,7 @@ def make_quant(
         pack=pack,
         dynamic=dynamic,
         device=device,
+        outliers=outlier_ratio > 0,
     )
 
     if pack:
@@ -145,17 +150,20 @@ def make_quant(
             if linear is not QuantLinear:
                 logger.info(f"Use {QuantLinear} failed, try to use {linear} instead.")
 
-            result = create_quant_layer(linear, bits, desc_act, dynamic, group_size, module, names, sym, device)
+            result = create_quant_layer(linear, bits, desc_act, dynamic, group_size, module, names, sym, device, outlier_ratio,
+                                        adapter_rank)
             return result
         except NotImplementedError as e:
             # only fallback to other quant linears when backend is auto.
-            if backend not in [BACKEND.AUTO, BACKEND.AUTO_TRAINABLE]:
+            # other quant linears can not hold the 2:4 packed weights of FORMAT.GPTQ_SPARSE
+            if backend not in [BACKEND.AUTO, BACKEND.AUTO_TRAINABLE] or format == FORMAT.GPTQ_SPARSE:
                 raise e
 
     raise ValueError("no support quant linear was found for this module.")
 
 
-def create_quant_layer(QuantLinear, bits, desc_act, dynamic, group_size, module, names, sym, device) -> BaseQuantLinear:
+def create_quant_layer(QuantLinear, bits, desc_act, dynamic, group_size, module, names, sym, device, outlier_ratio=0.0,
+                       adapter_rank=0) -> BaseQuantLinear:
     if isinstance(module, QuantLinear):
         return QuantLinear
     for name, submodule in module.named_modules():
@@ -179,7 +187,8 @@ def create_quant_layer(QuantLinear, bits, desc_act, dynamic, group_size, module,
 
             # when load a quantized model, device is target device passed in GPTQModel.load()
             # check in_features and out_features validate
-            _, err = QuantLinear.validate(bits=bits, group_size=group_size, desc_act=desc_act, sym=sym, infeatures=in_features, outfeatures=out_features, device=device)
+            _, err = QuantLinear.validate(bits=bits, group_size=group_size, desc_act=desc_act, sym=sym, infeatures=in_features,
+                                          outfeatures=out_features, device=device, outliers=outlier_ratio > 0)
             if err is not None:
                 raise err
 
@@ -200,6 +209,7 @@ def create_quant_layer(QuantLinear, bits, desc_act, dynamic, group_size, module,
                         d_group_size = pattern_dict.get("group_size", group_size)
                         d_sym = pattern_dict.get("sym", sym)
                         break
+            weight_dtype = submodule.qweight.dtype if isinstance(submodule, BaseQuantLinear) else submodule.weight.dtype
             new_layer = QuantLinear(
                 bits=d_bits,
                 group_size=d_group_size,
@@ -208,8 +218,10 @@ def create_quant_layer(QuantLinear, bits, desc_act, dynamic, group_size, module,
                 infeatures=in_features,
                 outfeatures=out_features,
                 bias=bias,
-                weight_dtype=submodule.qweight.dtype if isinstance(submodule, BaseQuantLinear) else submodule.weight.dtype,
+                weight_dtype=weight_dtype,
+                outlier_ratio=outlier_ratio,
             )
+            new_layer.register_adapter(adapter_rank, weight_dtype)
             new_layer.device = ori_layer_device
             recurse_setattr(module, name, new_layer.to(ori_layer_device))
     return QuantLinear
@@ -239,35 +251,35 @@ def convert_gptq_v1_to_v2_format(
         return model
 
     # Limit thread usage to avoid auto-parallizataion regression
-    with tctl.threadpool_limits(limits=1):
+    with tctl.threadpool_limits(limits=1), trace_span("convert_v1_to_v2", category="format"):
         for _, submodule in model.named_modules():
             # v1 checkpoint format used to do `qzeros = qzeros -= 1` before serialization, thus the
             # additions here do not overflow.
             # v1 checkpoint format with sym=False saved via convert_gptq_v2_to_v1_format() will
             # overflow ~<=13% based on testing
             if isinstance(submodule, qlinear_kernel):
-                if quantize_config.bits == 2:
-                    submodule.qzeros.data += 0b01010101010101010101010101010101
-                elif quantize_config.bits == 3:
-                    submodule.qzeros.data[:, range(0, submodule.qzeros.data.shape[1], 3)] += (
-                        0b00100100100100100100100100100100
-                    )
-                    submodule.qzeros.data[:, range(1, submodule.qzeros.data.shape[1], 3)] += (
-                        0b10010010010010010010010010010010
-                    )
-                    submodule.qzeros.data[:, range(2, submodule.qzeros.data.shape[1], 3)] += (
-                        0b01001001001001001001001001001001
-                    )
-                elif quantize_config.bits == 4:
-                    submodule.qzeros.data += 0b00010001000100010001000100010001
-                elif quantize_config.bits == 8:
-                    submodule.qzeros.data += 0b00000001000000010000000100000001
-                else:
-                    raise NotImplementedError("Only 2,3,4,8 bits are supported.")
+                convert_qzeros_v1_to_v2(submodule.qzeros.data, quantize_config.bits)
 
     return model
 
 
+def convert_qzeros_v1_to_v2(qzeros: torch.Tensor, bits: int) -> torch.Tensor:
+    # in place +1 of every packed zero point
+    if bits == 2:
+        qzeros += 0b01010101010101010101010101010101
+    elif bits == 3:
+        qzeros[:, range(0, qzeros.shape[1], 3)] += 0b00100100100100100100100100100100
+        qzeros[:, range(1, qzeros.shape[1], 3)] += 0b10010010010010010010010010010010
+        qzeros[:, range(2, qzeros.shape[1], 3)] += 0b01001001001001001001001001001001
+    elif bits == 4:
+        qzeros += 0b00010001000100010001000100010001
+    elif bits == 8:
+        qzeros += 0b00000001000000010000000100000001
+    else:
+        raise NotImplementedError("Only 2,3,4,8 bits are supported.")
+    return qzeros
+
+
 # public/stable api exposed to transformer/optimum
 def hf_convert_gptq_v2_to_v1_format(
     model: nn.Module,
@@ -295,7 +307,7 @@ def convert_gptq_v2_to_v1_format(
         return model
 
     # Limit thread usage to avoid auto-parallizataion regression
-    with tctl.threadpool_limits(limits=1):
+    with tctl.threadpool_limits(limits=1), trace_span("convert_v2_to_v1", category="format"):
         for _, submodule in model.named_modules():
             # sym=False has underflow probability of ~<=13% during testing. No underflow possible for sym=True.
             if isinstance(submodule, qlinear_kernel):
@@ -321,11 +333,103 @@ def convert_gptq_v2_to_v1_format(
     return model
 
 
+def module_fingerprint(module: nn.Module) -> str:
+    # sha256 of the source weight and bias of a module, including shape and dtype
+    h = hashlib.sha256()
+    for t in [module.weight, getattr(module, "bias", None)]:
+        if t is None:
+            continue
+        t = t.detach().to(CPU).contiguous()
+        h.update(f"{tuple(t.shape)}:{t.dtype}".encode())
+        h.update(t.flatten().view(torch.uint8).numpy())
+    return h.hexdigest()
+
+
+def checkpoint_tensor_files(model_dir: str) -> Dict[str, str]:
+    """Map of tensor name -> safetensors file for a (sharded) checkpoint directory."""
+    index_files = [f for f in os.listdir(model_dir) if f.endswith(".safetensors.index.json")]
+    if index_files:
+        with open(os.path.join(model_dir, index_files[0])) as f:
+            weight_map = json.load(f)["weight_map"]
+        return {k: os.path.join(model_dir, v) for k, v in weight_map.items()}
+
+    files = [os.path.join(model_dir, f) for f in os.listdir(model_dir) if f.endswith(".safetensors")]
+    if not files:
+        raise FileNotFoundError(f"No safetensors checkpoint found in {model_dir}.")
+
+    weight_map = {}
+    for file in files:
+        with safe_open(file, framework="pt", device="cpu") as f:
+            for key in f.keys():
+                weight_map[key] = file
+    return weight_map
+
+
+def load_checkpoint_tensors(weight_map: Dict[str, str], prefix: str) -> Dict[str, torch.Tensor]:
+    """Tensors of module `prefix`, keyed by their name inside the module (i.e. `qweight`)."""
+    names = [k for k in weight_map if k.startswith(f"{prefix}.")]
+    tensors = {}
+    for file in set(weight_map[k] for k in names):
+        with safe_open(file, framework="pt", device="cpu") as f:
+            for k in names:
+                if weight_map[k] == file:
+                    tensors[k[len(prefix) + 1:]] = f.get_tensor(k)
+    return tensors
+
+
+def dequantize_packed_weight(tensors: Dict[str, torch.Tensor], bits: int, group_size: int, sym: bool, desc_act: bool) -> torch.Tensor:
+    """
+    Dequantize gptq(v2) packed `qweight`, `qzeros`, `scales` and `g_idx` to a `[outfeatures, infeatures]` weight.
+    The csr outlier weights of modules quantized with `outlier_ratio` and the `adapter_a·adapter_b` correction of
+    modules quantized with `adapter_rank` are added back.
+    """
+    qweight = tensors["qweight"]
+    qlayer = TorchQuantLinear(
+        bits=bits,
+        group_size=group_size,
+        sym=sym,
+        desc_act=desc_act,
+        infeatures=qweight.shape[0] // bits * 32,
+        outfeatures=qweight.shape[1],
+        bias=False,
+        weight_dtype=tensors["scales"].dtype,
+    )
+    qlayer.qweight = qweight
+    qlayer.qzeros = tensors["qzeros"]
+    qlayer.scales = tensors["scales"]
+    if "g_idx" in tensors:
+        qlayer.g_idx = tensors["g_idx"]
+    if "outlier_values" in tensors:
+        # dequantize_weight() adds the outliers once `outlier_count` is set
+        qlayer.outlier_crow_indices = tensors["outlier_crow_indices"]
+        qlayer.outlier_col_indices = tensors["outlier_col_indices"]
+        qlayer.outlier_values = tensors["outlier_values"]
+        qlayer.outlier_count = tensors["outlier_values"].numel()
+    weight = qlayer.dequantize_weight().t()
+    if "adapter_a" in tensors:
+        weight = (weight.float() + tensors["adapter_a"].float() @ tensors["adapter_b"].float()).to(weight.dtype)
+    return weight.contiguous()
+
+
+def load_packed_layer(name, qlayers, packed, pbar):
+    # reuse packed tensors of an unchanged module from a previous quantization
+    pbar.set_description(f"Loading packed {name}")
+    qlayer = qlayers[name]
+    for key, value in packed[name].items():
+        if key == "scales" or key == "bias":
+            value = value.to(dtype=qlayer.scales.dtype)
+        setattr(qlayer, key, value.to(qlayer.qweight.device))
+    pbar.progress()
+
+
 def pack_layer(name, qlayers, quantizers, layers, QuantLinear, pbar):
     # Limit pack() thread usage to avoid auto-parallizataion regression
-    with tctl.threadpool_limits(limits=1):
+    with tctl.threadpool_limits(limits=1), trace_span("pack_layer", category="pack", module=name):
         pbar.set_description(f"Packing {name}")
-        quantizers[name], scale, zero, g_idx = quantizers[name]
+        # outlier and adapter quantization add the csr outliers and the `(A, B)` low rank adapter of the module
+        quantizers[name], scale, zero, g_idx, *extra = quantizers[name]
+        outliers = extra[0] if len(extra) > 0 else None
+        adapter = extra[1] if len(extra) > 1 else None
         layer_device = qlayers[name].device
         qlayers[name].to(CPU)
         layers[name], scale, zero, g_idx = (
@@ -334,6 +438,22 @@ def pack_layer(name, qlayers, quantizers, layers, QuantLinear, pbar):
             zero.to(CPU),
             g_idx.to(CPU) if g_idx is not None else None,
         )
+        if outliers is not None:
+            dense = outliers.to(CPU).to_dense()
+            if isinstance(layers[name], transformers.pytorch_utils.Conv1D):
+                dense = dense.t()
+            # the quantized weight is packed without the outliers, they dequantize to exactly 0
+            layers[name].weight.data -= dense.reshape(layers[name].weight.shape).to(layers[name].weight.dtype)
+            qlayers[name].pack_outliers(outliers.to(CPU))
+        if adapter is not None:
+            A, B = adapter[0].to(CPU), adapter[1].to(CPU)
+            correction = A @ B
+            if isinstance(layers[name], transformers.pytorch_utils.Conv1D):
+                correction = correction.t()
+            # the layer weight is Q + A·B, the quantized weight is packed without the correction
+            layers[name].weight.data = (layers[name].weight.data.float()
+                                        - correction.reshape(layers[name].weight.shape)).to(layers[name].weight.dtype)
+            qlayers[name].pack_adapter(A, B)
         qlayers[name].pack(layers[name], scale, zero, g_idx)
         qlayers[name].to(layer_device)
         pbar.progress()
@@ -350,7 +470,11 @@ def pack_model(
     sym: bool = True,
     dynamic=None,
     parallel_packing: bool = True,
+    packed: Optional[Dict[str, Dict[str, torch.Tensor]]] = None,
+    outlier_ratio: float = 0.0,
+    adapter_rank: int = 0,
 ):
+    packed = packed or {}
     QuantLinear = select_quant_linear(
         bits=bits,
         dynamic=dynamic,
@@ -360,6 +484,7 @@ def pack_model(
         backend=backend,
         format=format,
         pack=True,
+        outliers=outlier_ratio > 0,
     )
 
     model.to(CPU)
@@ -368,19 +493,22 @@ def pack_model(
 
     layers = find_layers(model)
     layers = {n: layers[n] for n in quantizers}
-    make_quant(
-        model,
-        quantizers,
-        bits,
-        group_size,
-        backend=backend,
-        format=format,
-        desc_act=desc_act,
-        pack=True,
-        dynamic=dynamic,
-    )
+    with trace_span("make_quant", category="pack"):
+        make_quant(
+            model,
+            list(quantizers) + list(packed),
+            bits,
+            group_size,
+            backend=backend,
+            format=format,
+            desc_act=desc_act,
+            pack=True,
+            dynamic=dynamic,
+            outlier_ratio=outlier_ratio,
+            adapter_rank=adapter_rank,
+        )
     qlayers = find_layers(model, [QuantLinear])
-    names = list(qlayers.keys())
+    names = [n for n in qlayers if n not in packed]
 
     if parallel_packing:
         max_workers = 2
@@ -388,7 +516,10 @@ def pack_model(
         max_workers = 1
 
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        with ProgressBar(total=len(names)) as pbar:
+        with ProgressBar(total=len(names) + len(packed)) as pbar:
+            for name in packed:
+                load_packed_layer(name, qlayers, packed, pbar)
+
             def wrapper(name):
                 pack_layer(name, qlayers, quantizers, layers, QuantLinear, pbar)
 
@@ -0,0 +1,520 @@
+from __future__ import annotations
+
+import copy
+import math
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+import transformers
+
+from ..models._const import CPU
+from ..quantization import FORMAT, GPTQ, HESSIAN_ACCUMULATION, HESSIAN_MODE
+from .backend import BACKEND
+from .importer import select_quant_linear
+from .logger import setup_logger
+from .model import find_layers, get_device, get_module_by_name_prefix, move_to, nested_move_to
+from .torch import HAS_CUDA, HAS_XPU, torch_empty_cache, torch_sync
+
+logger = setup_logger()
+
+# candidate calibration batch sizes evaluated by the planner
+PLAN_BATCH_SIZES = [1, 2, 4, 8, 16, 32, 64]
+# padded tokens of a batch size may exceed the unpadded tokens by this fraction (padding also enters the hessian)
+PLAN_MAX_PADDING = 0.1
+# fraction of free device/host memory the plan is allowed to use
+PLAN_MEMORY_HEADROOM = 0.9
+# rough sequential safetensors write speed used for the save estimate
+PLAN_SAVE_BYTES_PER_SECOND = 1024 ** 3
+
+
+@dataclass
+class QuantizationPlan:
+    num_layers: int
+    num_modules: int
+    num_samples: int
+    num_tokens: int
+    batch_size: int
+    calibration_enable_gpu_cache: bool
+    device: str
+    # estimated wall time in seconds per phase
+    time: Dict[str, float] = field(default_factory=dict)
+    # bytes
+    peak_device_memory: int = 0
+    peak_host_memory: int = 0
+    checkpoint_size: int = 0
+    device_memory_budget: Optional[int] = None
+    host_memory_budget: Optional[int] = None
+    recommended_batch_size: int = 1
+    recommended_calibration_enable_gpu_cache: bool = False
+    recommended_device: str = CPU
+    notes: List[str] = field(default_factory=list)
+
+    @property
+    def total_time(self) -> float:
+        return sum(self.time.values())
+
+    def __str__(self):
+        def gb(value):
+            return "-" if value is None else f"{value / 1024 ** 3:.2f} GB"
+
+        lines = [
+            f"layers: {self.num_layers}, modules: {self.num_modules}, samples: {self.num_samples}, tokens: {self.num_tokens}",
+            f"batch_size: {self.batch_size}, calibration_enable_gpu_cache: {self.calibration_enable_gpu_cache}, device: {self.device}",
+        ]
+        for phase, seconds in self.time.items():
+            lines.append(f"  {phase:<12} {seconds:>10.1f} s")
+        lines.append(f"  {'total':<12} {self.total_time:>10.1f} s")
+        lines.append(f"peak device memory: {gb(self.peak_device_memory)} (budget {gb(self.device_memory_budget)})")
+        lines.append(f"peak host memory: {gb(self.peak_host_memory)} (budget {gb(self.host_memory_budget)})")
+        lines.append(f"checkpoint size: {gb(self.checkpoint_size)}")
+        lines.append(
+            f"recommended: batch_size={self.recommended_batch_size}, "
+            f"calibration_enable_gpu_cache={self.recommended_calibration_enable_gpu_cache}, "
+            f"QuantizeConfig.device={self.recommended_device}"
+        )
+        lines.extend(f"note: {note}" for note in self.notes)
+        return "\n".join(lines)
+
+
+def _module_shape(module: nn.Module) -> Tuple[int, int]:
+    # rows/columns of the weight as seen by GPTQ
+    weight = module.weight
+    if isinstance(module, transformers.pytorch_utils.Conv1D):
+        return weight.shape[1], weight.shape[0]
+    return weight.shape[0], math.prod(weight.shape[1:])
+
+
+def _tensor_bytes(t: torch.Tensor) -> int:
+    return t.numel() * t.element_size()
+
+
+def _module_bytes(module: nn.Module) -> int:
+    return sum(_tensor_bytes(p) for p in module.parameters()) + sum(_tensor_bytes(b) for b in module.buffers())
+
+
+def _batch_shapes(lengths: List[int], batch_size: int) -> List[Tuple[int, int]]:
+    # (batch, padded seq len) of each batch, prepare_dataset() pads every batch to its longest sample
+    return [(len(lengths[i:i + batch_size]), max(lengths[i:i + batch_size])) for i in range(0, len(lengths), batch_size)]
+
+
+def _scaled_bytes(tensors: List[Tuple[int, int]], probe_shape: Tuple[int, int], shape: Tuple[int, int]) -> float:
+    # captured tensors scale with batch and with seq len to the power of the number of seq len dims (4d masks)
+    return sum(nbytes * (shape[0] / probe_shape[0]) * (shape[1] / probe_shape[1]) ** seq_dims for nbytes, seq_dims in tensors)
+
+
+def _device_free_memory(device: torch.device) -> Optional[int]:
+    if device.type == "cuda" and HAS_CUDA:
+        return torch.cuda.mem_get_info(device)[0]
+    if device.type == "xpu" and HAS_XPU and hasattr(torch.xpu, "mem_get_info"):
+        return torch.xpu.mem_get_info(device)[0]
+    return None
+
+
+def _host_free_memory() -> Optional[int]:
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _reset_peak(device: torch.device) -> Optional[int]:
+    if device.type == "cuda" and HAS_CUDA:
+        torch.cuda.reset_peak_memory_stats(device)
+        return torch.cuda.memory_allocated(device)
+    return None
+
+
+def _peak_delta(device: torch.device, start: Optional[int]) -> Optional[int]:
+    if start is None:
+        return None
+    return torch.cuda.max_memory_allocated(device) - start
+
+
+def _timed(device: torch.device, fn):
+    torch_sync(device)
+    start = time.perf_counter()
+    result = fn()
+    torch_sync(device)
+    return time.perf_counter() - start, result
+
+
+def _hessian_bytes(cfg, columns: int) -> Tuple[int, int]:
+    # bytes of one module hessian while collecting and of the fp32 hessian the solver works on
+    if cfg.hessian_mode == HESSIAN_MODE.BLOCK_DIAGONAL:
+        block = cfg.hessian_block_size or (cfg.group_size if cfg.group_size > 0 else 128)
+        elements = solve_elements = math.ceil(columns / block) * block * block
+    elif cfg.hessian_mode == HESSIAN_MODE.LOW_RANK:
+        elements = 2 * columns * min(cfg.hessian_rank, columns) + columns
+        solve_elements = columns * columns
+    else:
+        elements = solve_elements = columns * columns
+    element_size = 8 if cfg.hessian_accumulation == HESSIAN_ACCUMULATION.FP64 else 4
+    if cfg.hessian_accumulation == HESSIAN_ACCUMULATION.COMPENSATED:
+        element_size *= 2
+    return elements * element_size, solve_elements * 4
+
+
+def plan_quantization(model, calibration_dataset, batch_size: int = 1, calibration_enable_gpu_cache: bool = True,
+                      probe: bool = True) -> QuantizationPlan:
+    """
+    Estimate wall time, peak device/host memory and checkpoint size of `model.quantize()` without running it.
+
+    Sizes come from the model definition (`layers_node`, `layer_modules`, `dynamic_expert_index`) and the quantize
+    config. With `probe=True` the first layer is run once on the first calibration batch to time the layer forward,
+    hessian accumulation, GPTQ solve and packing and to measure the captured layer inputs. All other layers are
+    assumed to match the first layer.
+    """
+    cfg = model.quantize_config
+    device = torch.device(cfg.device if cfg.device is not None else CPU)
+    config = model.model.config
+
+    samples = model.prepare_dataset(calibration_dataset, batch_size=1)
+    lengths = [int(s["attention_mask"].sum()) for s in samples]
+    num_tokens = sum(lengths)
+
+    layers = get_module_by_name_prefix(model.model, model.layers_node)
+    layer_modules = model.get_layer_modules()
+    num_subsets = len(layer_modules)
+
+    # quantized modules, their shapes and per module bits/group_size
+    modules = []
+    layer_bytes = 0
+    for i, layer in enumerate(layers):
+        layer_bytes = max(layer_bytes, _module_bytes(layer))
+        full = find_layers(layer)
+        for names in layer_modules:
+            for name in names:
+                if name not in full:
+                    continue
+                bits, group_size = cfg.bits, cfg.group_size
+                if cfg.dynamic is not None:
+                    layer_name = f"{model.layers_node}.{i}.{name}"
+                    if cfg.dynamic_get(layer_name=layer_name) == False:  # noqa: E712
+                        continue
+                    bits = cfg.dynamic_get(layer_name, "bits", bits)
+                    group_size = cfg.dynamic_get(layer_name, "group_size", group_size)
+                rows, columns = _module_shape(full[name])
+                modules.append((i, name, rows, columns, bits, group_size, full[name].bias is not None,
+                                full[name].weight.element_size()))
+
+    # subset hessians (fp32 columns² with the default hessian_mode) live together on device during a subset forward
+    subset_bytes = 0
+    solve_bytes = 0
+    full0 = find_layers(layers[0])
+    for names in layer_modules:
+        shapes = [_module_shape(full0[n]) for n in names if n in full0]
+        subset_bytes = max(subset_bytes, sum(_hessian_bytes(cfg, c)[0] for r, c in shapes))
+        # cholesky temporaries + the fp32 W of the module being solved, quantized in place
+        solve_bytes = max([solve_bytes] + [2 * _hessian_bytes(cfg, c)[1] + 4 * r * c for r, c in shapes])
+
+    # checkpoint: packed weights, qzeros, fp16 scales, g_idx and every non quantized tensor
+    quantized_fp_bytes = 0
+    checkpoint_size = 0
+    for _, _, rows, columns, bits, group_size, bias, element_size in modules:
+        groups = math.ceil(columns / (group_size if group_size != -1 else columns))
+        if cfg.format == FORMAT.GPTQ_SPARSE:
+            # half of the weights packed plus a 4 bit index pair per 4 input features
+            checkpoint_size += rows * columns // 2 * bits // 8 + rows * columns // 8
+        else:
+            checkpoint_size += rows * columns * bits // 8
+        checkpoint_size += groups * rows * bits // 8 + groups * rows * 2 + columns * 4
+        # csr outliers: fp16 value + int32 column per outlier, int32 row pointers
+        checkpoint_size += int(rows * columns * cfg.outlier_ratio) * 6 + (rows + 1) * 4 if cfg.outlier_ratio > 0 else 0
+        # fp16 low rank adapter `A·B`
+        checkpoint_size += (rows + columns) * cfg.adapter_rank * 2
+        checkpoint_size += rows * 2 if bias else 0
+        quantized_fp_bytes += rows * columns * element_size
+    model_bytes = _module_bytes(model.model)
+    checkpoint_size += model_bytes - quantized_fp_bytes
+
+    hidden_size = getattr(config, "hidden_size", None) or getattr(config, "d_model", 0)
+    intermediate_size = getattr(config, "intermediate_size", None) or 4 * hidden_size
+    dtype_size = next(model.model.parameters()).element_size()
+
+    notes = []
+    # analytic defaults, replaced by measurements when probing
+    probe_shape = (1, 1)
+    input_tensors = [(hidden_size * dtype_size, 1), (8, 1)]
+    output_bytes_per_token = hidden_size * dtype_size
+    fwd_bytes_per_token = (3 * intermediate_size + 4 * hidden_size) * dtype_size
+    fwd_seconds_per_token = None
+    add_batch_seconds_per_token = None
+    capture_seconds_per_token = None
+    solve_seconds = {}
+    pack_seconds_per_weight = None
+
+    if probe:
+        (probe_shape, input_tensors, output_bytes_per_token, fwd_bytes_per_token, fwd_seconds_per_token,
+         add_batch_seconds_per_token, capture_seconds_per_token, solve_seconds, pack_seconds_per_weight) = _probe(
+            model, calibration_dataset, batch_size, device, layers, layer_modules, fwd_bytes_per_token)
+
+    # time estimates
+    t = {}
+    if capture_seconds_per_token is not None:
+        t["capture"] = capture_seconds_per_token * num_tokens
+        # every subset forward plus the output forward, for every layer
+        t["forward"] = fwd_seconds_per_token * num_tokens * len(layers) * (num_subsets + 1)
+        t["add_batch"] = add_batch_seconds_per_token * num_tokens * len(layers)
+        t["quantize"] = sum(solve_seconds.get((rows, columns), 0.0) for _, _, rows, columns, *_ in modules)
+        t["pack"] = pack_seconds_per_weight * sum(rows * columns for _, _, rows, columns, *_ in modules) / (
+            2 if cfg.parallel_packing else 1)
+        if model.dynamic_expert_index is not None:
+            notes.append("expert hessian time assumes every expert sees every token and is an upper bound")
+    else:
+        notes.append("no probe run, only memory and checkpoint size are estimated")
+    t["save"] = checkpoint_size / PLAN_SAVE_BYTES_PER_SECOND
+
+    # memory estimate for a batch size / gpu cache combination
+    def estimate(bs: int, gpu_cache: bool):
+        shapes = _batch_shapes(lengths, bs)
+        inputs = [_scaled_bytes(input_tensors, probe_shape, s) for s in shapes]
+        outputs = [output_bytes_per_token * s[0] * s[1] for s in shapes]
+        activations = sum(inputs) + sum(outputs)
+        largest = max(shapes, key=lambda s: s[0] * s[1])
+        in_flight = max(inputs) + max(outputs)
+        fwd_temp = fwd_bytes_per_token * largest[0] * largest[1]
+
+        device_peak = layer_bytes + subset_bytes + max(fwd_temp, solve_bytes)
+        host_peak = model_bytes + checkpoint_size
+        if gpu_cache and device.type != "cpu":
+            device_peak += activations
+        else:
+            device_peak += in_flight
+            host_peak += activations
+        if cfg.layer_error_retries > 0:
+            host_peak += layer_bytes
+        if device.type == "cpu":
+            host_peak += device_peak
+            device_peak = 0
+        padded = sum(s[0] * s[1] for s in shapes)
+        return int(device_peak), int(host_peak), padded
+
+    device_budget = _device_free_memory(device) if device.type != "cpu" else None
+    device_budget = int(device_budget * PLAN_MEMORY_HEADROOM) if device_budget is not None else None
+    host_budget = _host_free_memory()
+    if host_budget is not None:
+        # the loaded model is already resident
+        host_budget = int(host_budget * PLAN_MEMORY_HEADROOM) + model_bytes
+
+    def fits(device_peak, host_peak):
+        return (device_budget is None or device_peak <= device_budget) and (host_budget is None or host_peak <= host_budget)
+
+    device_peak, host_peak, padded = estimate(batch_size, calibration_enable_gpu_cache)
+    if padded > num_tokens and "forward" in t:
+        # padded tokens are computed as well
+        for phase in ["capture", "forward", "add_batch"]:
+            t[phase] *= padded / num_tokens
+
+    recommended = None
+    for gpu_cache in ([True, False] if device.type != "cpu" else [False]):
+        for bs in reversed([b for b in PLAN_BATCH_SIZES if b <= len(lengths)]):
+            d, h, p = estimate(bs, gpu_cache)
+            if p <= num_tokens * (1 + PLAN_MAX_PADDING) and fits(d, h):
+                recommended = (bs, gpu_cache, cfg.device)
+                break
+        if recommended is not None:
+            break
+
+    if recommended is None:
+        # not even a single layer fits on the device, quantize on cpu
+        recommended = (1, False, CPU)
+        notes.append("estimated peak exceeds the device memory budget with batch_size=1, quantization device set to cpu")
+        if host_budget is not None and estimate(1, False)[1] > host_budget:
+            notes.append("estimated peak host memory exceeds available host memory")
+
+    return QuantizationPlan(
+        num_layers=len(layers),
+        num_modules=len(modules),
+        num_samples=len(lengths),
+        num_tokens=num_tokens,
+        batch_size=batch_size,
+        calibration_enable_gpu_cache=calibration_enable_gpu_cache,
+        device=str(cfg.device),
+        time=t,
+        peak_device_memory=device_peak,
+        peak_host_memory=host_peak,
+        checkpoint_size=int(checkpoint_size),
+        device_memory_budget=device_budget,
+        host_memory_budget=host_budget,
+        recommended_batch_size=recommended[0],
+        recommended_calibration_enable_gpu_cache=recommended[1],
+        recommended_device=str(recommended[2]),
+        notes=notes,
+    )
+
+
+@torch.no_grad()
+def _probe(model, calibration_dataset, batch_size, device, layers, layer_modules, fwd_bytes_per_token):
+    cfg = model.quantize_config
+    example = model.prepare_dataset(calibration_dataset[:batch_size], batch_size=batch_size)[0]
+    example = {k: move_to(v, device) for k, v in example.items()}
+    probe_shape = tuple(example["input_ids"].shape)
+    probe_tokens = probe_shape[0] * probe_shape[1]
+
+    captured = {}
+
+    def store_input_hook(_, args, kwargs):
+        captured["args"] = list(args)
+        captured["kwargs"] = kwargs
+        raise ValueError
+
+    layer = layers[0]
+    layer_device = get_device(layer)
+    base_devices = {}
+    for module_name in model.base_modules:
+        module = get_module_by_name_prefix(model.model, module_name)
+        if module is not None:
+            base_devices[module_name] = get_device(module)
+            move_to(module, device)
+    move_to(layer, device)
+
+    use_cache = getattr(model.model.config, "use_cache", False)
+    model.model.config.use_cache = False
+
+    def capture():
+        handle = layer.register_forward_pre_hook(store_input_hook, with_kwargs=True)
+        try:
+            model.model(**example)
+        except ValueError:
+            pass
+        finally:
+            handle.remove()
+
+    gptq = {}
+    handles = []
+    try:
+        capture_seconds, _ = _timed(device, capture)
+
+        args = [move_to(a, device) for a in captured["args"]]
+        kwargs = {k: nested_move_to(v, device) for k, v in captured["kwargs"].items()}
+        if not args and kwargs.get("hidden_states") is not None:
+            args = [kwargs.pop("hidden_states")]
+
+        # captured tensors and how many of their dims scale with seq len
+        input_tensors = []
+        for v in args + list(kwargs.values()):
+            if isinstance(v, torch.Tensor):
+                input_tensors.append((_tensor_bytes(v), sum(1 for d in v.shape[1:] if d == probe_shape[1])))
+
+        start = _reset_peak(device)
+        fwd_seconds, out = _timed(device, lambda: layer(*args, **kwargs))
+        fwd_peak = _peak_delta(device, start)
+        output_bytes_per_token = _tensor_bytes(out[0]) / probe_tokens
+        del out
+
+        # hessian accumulation, one module per distinct shape, with the hessian settings of the real run
+        hessian_block_size = cfg.hessian_block_size
+        if hessian_block_size is None:
+            hessian_block_size = cfg.group_size if cfg.group_size > 0 else 128
+        full = find_layers(layer)
+        shape_count = {}
+        for names in layer_modules:
+            for name in names:
+                if name in full:
+                    shape = _module_shape(full[name])
+                    shape_count[shape] = shape_count.get(shape, 0) + 1
+                    if shape not in {_module_shape(full[n]) for n in gptq}:
+                        gptq[name] = GPTQ(
+                            full[name],
+                            hessian_accumulation=cfg.hessian_accumulation,
+                            hessian_mode=cfg.hessian_mode,
+                            hessian_block_size=hessian_block_size,
+                            hessian_rank=cfg.hessian_rank,
+                        )
+                        gptq[name].quantizer.configure(cfg.bits, perchannel=True, sym=cfg.sym, mse=cfg.mse)
+
+        def add_batch(name):
+            def tmp(_, inp, out):
+                gptq[name].add_batch(inp[0].data, out.data)
+            return tmp
+
+        for name in gptq:
+            handles.append(full[name].register_forward_hook(add_batch(name)))
+        hooked_seconds, _ = _timed(device, lambda: layer(*args, **kwargs))
+        for h in handles:
+            h.remove()
+        handles = []
+
+        # scale hessian overhead of the probed modules to all modules of the layer
+        probed = {_module_shape(full[n]): n for n in gptq}
+        add_batch_seconds = max(hooked_seconds - fwd_seconds, 0.0) * sum(shape_count.values()) / max(len(probed), 1)
+
+        # gptq solve and pack of each distinct shape, original weights are restored afterwards
+        solve_seconds = {}
+        pack_seconds = []
+        for shape, name in probed.items():
+            module = full[name]
+            weight = module.weight.data.to(CPU, copy=True)
+            # a None `solver_blocksize` is autotuned by quantize() like in the real run
+            scale, zero, g_idx, duration, _, _ = gptq[name].quantize(
+                blocksize=cfg.solver_blocksize,
+                percdamp=cfg.damp_percent,
+                damp_auto_increment=cfg.damp_auto_increment,
+                group_size=cfg.group_size,
+                actorder=cfg.desc_act,
+                static_groups=cfg.static_groups,
+                sparsity=cfg.sparsity,
+                prune_n=cfg.prune_n,
+                prune_m=cfg.prune_m,
+                outlier_ratio=cfg.outlier_ratio,
+                adapter_rank=cfg.adapter_rank,
+            )
+            solve_seconds[shape] = duration
+            pack_seconds.append(_probe_pack(cfg, module, scale, zero, g_idx))
+            module.weight.data = weight.to(module.weight.device)
+            gptq[name].free()
+
+        packed = [(shape, seconds) for shape, seconds in zip(probed, pack_seconds) if seconds is not None]
+        pack_seconds_per_weight = sum(seconds for _, seconds in packed) / max(sum(r * c for (r, c), _ in packed), 1)
+    finally:
+        for h in handles:
+            h.remove()
+        gptq.clear()
+        model.model.config.use_cache = use_cache
+        move_to(layer, layer_device)
+        for module_name, module_device in base_devices.items():
+            move_to(get_module_by_name_prefix(model.model, module_name), module_device)
+        torch_empty_cache()
+
+    if fwd_peak is not None:
+        fwd_bytes_per_token = fwd_peak / probe_tokens
+
+    return (probe_shape, input_tensors, output_bytes_per_token, fwd_bytes_per_token, fwd_seconds / probe_tokens,
+            add_batch_seconds / probe_tokens, capture_seconds / probe_tokens, solve_seconds, pack_seconds_per_weight)
+
+
+def _probe_pack(cfg, module, scale, zero, g_idx) -> Optional[float]:
+    rows, columns = _module_shape(module)
+    try:
+        QuantLinear = select_quant_linear(
+            bits=cfg.bits,
+            group_size=cfg.group_size,
+            desc_act=cfg.desc_act,
+            sym=cfg.sym,
+            backend=BACKEND.AUTO,
+            format=cfg.format,
+            pack=True,
+            dynamic=cfg.dynamic,
+        )
+        qlayer = QuantLinear(
+            bits=cfg.bits,
+            group_size=cfg.group_size,
+            desc_act=cfg.desc_act,
+            sym=cfg.sym,
+            infeatures=columns,
+            outfeatures=rows,
+            bias=module.bias is not None,
+            weight_dtype=module.weight.dtype,
+        )
+    except (NotImplementedError, ValueError) as e:
+        logger.warning(f"Plan: skipped pack probe: {e}")
+        return None
+
+    layer = copy.deepcopy(module).to(CPU)
+    seconds, _ = _timed(torch.device(CPU), lambda: qlayer.pack(layer, scale.to(CPU), zero.to(CPU),
+                                                               g_idx.to(CPU) if g_idx is not None else None))
+    return seconds
@@ -1,4 +1,5 @@
 import gc as py_gc
+from contextlib import nullcontext
 
 import torch
 
@@ -34,6 +35,14 @@ def torch_sync(device: torch.device = None):
     elif device.type == "mps":
         torch.mps.synchronize()
 
+
+def torch_autocast_disabled(device: torch.device):
+    # fp32 region inside an autocast region, devices without autocast support need nothing
+    if device.type in ["cpu", "cuda", "xpu"]:
+        return torch.autocast(device_type=device.type, enabled=False)
+    return nullcontext()
+
+
 def torch_empty_cache(device: torch.device = None, gc: bool = True):
     if gc:
         py_gc.collect()
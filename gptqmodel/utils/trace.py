@@ -0,0 +1,263 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+
+from .logger import setup_logger
+from .torch import HAS_CUDA, HAS_XPU, torch_sync
+
+logger = setup_logger()
+
+# tracer that receives spans from `trace_span()`, set by `with Tracer():`
+_active_tracer = None
+
+
+def _device_memory() -> Optional[int]:
+    if HAS_CUDA:
+        return torch.cuda.memory_allocated()
+    if HAS_XPU:
+        return torch.xpu.memory_allocated()
+    return None
+
+
+def _device_peak_memory() -> Optional[int]:
+    if HAS_CUDA:
+        return torch.cuda.max_memory_allocated()
+    if HAS_XPU:
+        return torch.xpu.max_memory_allocated()
+    return None
+
+
+def _reset_device_peak_memory():
+    if HAS_CUDA:
+        torch.cuda.reset_peak_memory_stats()
+    elif HAS_XPU:
+        torch.xpu.reset_peak_memory_stats()
+
+
+def _host_memory() -> Optional[int]:
+    # resident set size of this process in bytes
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+
+    try:
+        import resource
+
+        # ru_maxrss is the peak rss: KiB on linux, bytes on macos
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if os.uname().sysname == "Darwin" else rss * 1024
+    except (ImportError, AttributeError):
+        return None
+
+
+@dataclass
+class Span:
+    name: str
+    category: str
+    # seconds since the tracer was created
+    start: float
+    end: float = 0.0
+    thread_id: int = 0
+    args: Dict[str, Any] = field(default_factory=dict)
+    # bytes, None if the counter is not available
+    device_memory_start: Optional[int] = None
+    device_memory_end: Optional[int] = None
+    # max allocated device memory between start and end of this span
+    device_memory_peak: Optional[int] = None
+    host_memory_start: Optional[int] = None
+    host_memory_end: Optional[int] = None
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class Tracer:
+    """
+    Collects timing and memory spans of the quantization pipeline.
+
+    Usage:
+
+    ```py
+    tracer = Tracer()
+    with tracer:
+        model.quantize(calibration_dataset)
+        model.save(quant_path)
+    tracer.export_chrome_trace("trace.json")  # open with chrome://tracing or ui.perfetto.dev
+    print(tracer.summary_table())
+    ```
+
+    Device memory peaks reset the peak memory stats of the accelerator at every span start, the peak of the
+    enclosing span is carried over. Spans of concurrent threads share the same counter.
+
+    Args:
+        sync (`bool`, defaults to `True`):
+            Synchronize the accelerator at span boundaries so span durations include queued kernels.
+        callbacks (`List[Callable[[Span], None]]`, *optional*):
+            Called with every finished span, i.e. to forward spans to an external collector.
+    """
+
+    def __init__(self, sync: bool = True, callbacks: Optional[List[Callable[[Span], None]]] = None):
+        self.sync = sync
+        self.callbacks = list(callbacks) if callbacks else []
+        self.spans: List[Span] = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._previous = None
+        # open spans of each thread
+        self._local = threading.local()
+
+    def add_callback(self, callback: Callable[[Span], None]):
+        self.callbacks.append(callback)
+
+    def __enter__(self):
+        global _active_tracer
+        self._previous = _active_tracer
+        _active_tracer = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _active_tracer
+        _active_tracer = self._previous
+        self._previous = None
+
+    @contextmanager
+    def span(self, name: str, category: str = "quantize", **args):
+        if self.sync:
+            torch_sync()
+
+        s = Span(
+            name=name,
+            category=category,
+            start=time.perf_counter() - self._origin,
+            thread_id=threading.get_ident(),
+            args=args,
+            device_memory_start=_device_memory(),
+            host_memory_start=_host_memory(),
+        )
+
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        if s.device_memory_start is not None:
+            # the enclosing span keeps its peak so far, the counter restarts for this span
+            if stack:
+                stack[-1].device_memory_peak = max(stack[-1].device_memory_peak, _device_peak_memory())
+            _reset_device_peak_memory()
+            s.device_memory_peak = s.device_memory_start
+        stack.append(s)
+        try:
+            yield s
+        finally:
+            if self.sync:
+                torch_sync()
+
+            stack.pop()
+            s.end = time.perf_counter() - self._origin
+            s.device_memory_end = _device_memory()
+            if s.device_memory_peak is not None:
+                s.device_memory_peak = max(s.device_memory_peak, _device_peak_memory())
+            s.host_memory_end = _host_memory()
+
+            with self._lock:
+                self.spans.append(s)
+
+            for callback in self.callbacks:
+                try:
+                    callback(s)
+                except Exception as e:
+                    logger.warning(f"Tracer callback {callback} failed: {e}")
+
+    def export_chrome_trace(self, path: str):
+        """Write spans in Chrome trace event format, readable by chrome://tracing and Perfetto."""
+        pid = os.getpid()
+        events = []
+        for s in self.spans:
+            args = {k: v if isinstance(v, (int, float, bool, str)) or v is None else str(v) for k, v in s.args.items()}
+            for key in ["device_memory_start", "device_memory_end", "device_memory_peak", "host_memory_start", "host_memory_end"]:
+                value = getattr(s, key)
+                if value is not None:
+                    args[key] = value
+
+            events.append({
+                "name": s.name,
+                "cat": s.category,
+                "ph": "X",
+                "ts": s.start * 1e6,
+                "dur": s.duration * 1e6,
+                "pid": pid,
+                "tid": s.thread_id,
+                "args": args,
+            })
+
+            counters = {}
+            if s.device_memory_end is not None:
+                counters["device"] = s.device_memory_end
+            if s.host_memory_end is not None:
+                counters["host"] = s.host_memory_end
+            if counters:
+                events.append({"name": "memory", "ph": "C", "ts": s.end * 1e6, "pid": pid, "args": counters})
+
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """
+        Per span name: count, total/mean/max seconds, the max device memory peak and the max host memory (rss) at span
+        end, sorted by total time.
+        """
+        rows = {}
+        for s in self.spans:
+            row = rows.setdefault(s.name, {
+                "name": s.name,
+                "category": s.category,
+                "count": 0,
+                "total": 0.0,
+                "max": 0.0,
+                "device_memory_peak": None,
+                "host_memory_end": None,
+            })
+            row["count"] += 1
+            row["total"] += s.duration
+            row["max"] = max(row["max"], s.duration)
+            if s.device_memory_peak is not None:
+                row["device_memory_peak"] = max(row["device_memory_peak"] or 0, s.device_memory_peak)
+            if s.host_memory_end is not None:
+                row["host_memory_end"] = max(row["host_memory_end"] or 0, s.host_memory_end)
+
+        result = sorted(rows.values(), key=lambda r: r["total"], reverse=True)
+        for row in result:
+            row["mean"] = row["total"] / row["count"]
+        return result
+
+    def summary_table(self) -> str:
+        def gb(value):
+            return "-" if value is None else f"{value / 1024 / 1024 / 1024:.2f}"
+
+        header = f"{'phase':<24} {'count':>8} {'total(s)':>10} {'mean(s)':>10} {'max(s)':>10} {'device peak(GB)':>16} {'host end(GB)':>13}"
+        lines = [header, "-" * len(header)]
+        for row in self.summary():
+            lines.append(
+                f"{row['name']:<24} {row['count']:>8} {row['total']:>10.3f} {row['mean']:>10.4f} {row['max']:>10.3f} "
+                f"{gb(row['device_memory_peak']):>16} {gb(row['host_memory_end']):>13}"
+            )
+        return "\n".join(lines)
+
+
+def trace_span(name: str, category: str = "quantize", **args):
+    """Span on the active tracer, no-op when tracing is not enabled."""
+    tracer = _active_tracer
+    if tracer is None:
+        return nullcontext()
+    return tracer.span(name, category, **args)
+
+
+__all__ = ["Span", "Tracer", "trace_span"]
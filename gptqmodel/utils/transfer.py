@@ -0,0 +1,165 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import torch
+
+from ..models._const import CPU
+from .logger import setup_logger
+from .torch import HAS_CUDA
+
+logger = setup_logger()
+
+# layer inputs stay on device for all passes of a layer if they fit in this fraction of free device memory
+RESIDENT_MEMORY_FRACTION = 0.5
+
+
+def _nested(v, fn):
+    if isinstance(v, torch.Tensor):
+        return fn(v)
+    elif isinstance(v, (list, tuple)):
+        return type(v)([_nested(e, fn) for e in v])
+    return v
+
+
+def _nested_tensors(v) -> Iterator[torch.Tensor]:
+    if isinstance(v, torch.Tensor):
+        yield v
+    elif isinstance(v, (list, tuple)):
+        for e in v:
+            yield from _nested_tensors(e)
+    elif isinstance(v, dict):
+        for e in v.values():
+            yield from _nested_tensors(e)
+
+
+def _pin(t: torch.Tensor) -> torch.Tensor:
+    if t.device.type != "cpu" or t.is_pinned():
+        return t
+    return t.pin_memory()
+
+
+def to_host(t: torch.Tensor) -> torch.Tensor:
+    """Copy a tensor to cpu, into pinned memory when cuda is available so it can be sent back non-blocking."""
+    if t.device.type == "cpu":
+        return t
+    if not HAS_CUDA:
+        return t.to(CPU)
+    host = torch.empty(t.shape, dtype=t.dtype, device=CPU, pin_memory=True)
+    host.copy_(t)
+    return host
+
+
+class LayerInputTransfer:
+    """
+    Moves the captured calibration inputs of one layer (positional inputs, attention masks, position ids and
+    other kwargs) to the layer device for every forward pass over the batches of that layer.
+
+    For cuda devices and host side inputs, the host tensors are pinned and each batch is copied non-blocking on a
+    side stream one batch ahead of the forward. When all inputs of the layer fit in `RESIDENT_MEMORY_FRACTION` of
+    the free device memory, they are copied once and stay resident on the device for all subset passes and the
+    output pass of the layer until `release()`.
+    """
+
+    def __init__(
+        self,
+        layer_inputs: List[List[torch.Tensor]],
+        attention_masks: List[Optional[torch.Tensor]],
+        position_ids: List[torch.Tensor],
+        layer_input_kwargs: List[Dict],
+        device: torch.device,
+    ):
+        self.layer_inputs = layer_inputs
+        self.attention_masks = attention_masks
+        self.position_ids = position_ids
+        self.layer_input_kwargs = layer_input_kwargs
+        self.device = device
+        self.num_batches = len(layer_inputs)
+
+        tensors = list(_nested_tensors([layer_inputs, attention_masks, position_ids, layer_input_kwargs]))
+        on_host = any(t.device.type == "cpu" for t in tensors)
+        self.async_copy = on_host and HAS_CUDA and device.type == "cuda"
+        self._stream = None
+        self._resident = None
+
+        if not self.async_copy:
+            return
+
+        self._pin_inputs()
+        self._stream = torch.cuda.Stream(device)
+
+        nbytes = sum(t.numel() * t.element_size() for t in tensors)
+        free = torch.cuda.mem_get_info(device)[0]
+        if nbytes <= free * RESIDENT_MEMORY_FRACTION:
+            with torch.cuda.stream(self._stream):
+                self._resident = [self._batch(j) for j in range(self.num_batches)]
+            torch.cuda.current_stream(device).wait_stream(self._stream)
+            for batch in self._resident:
+                self._record_stream(batch)
+            logger.debug(f"Layer inputs resident on {device}: {nbytes / 1024 / 1024:.1f} MB")
+
+    def _pin_inputs(self):
+        # pin in place, so later layers and retries reuse the pinned buffers
+        for j in range(self.num_batches):
+            self.layer_inputs[j] = _nested(self.layer_inputs[j], _pin)
+            if self.attention_masks[j] is not None:
+                self.attention_masks[j] = _pin(self.attention_masks[j])
+            if self.position_ids:
+                self.position_ids[j] = _nested(self.position_ids[j], _pin)
+            self.layer_input_kwargs[j] = {k: _nested(v, _pin) for k, v in self.layer_input_kwargs[j].items()}
+
+    def _to_device(self, t: torch.Tensor) -> torch.Tensor:
+        if t.device == self.device:
+            return t
+        return t.to(self.device, non_blocking=self.async_copy)
+
+    def _batch(self, j: int) -> Tuple[List, Dict]:
+        layer_input = [_nested(inp, self._to_device) for inp in self.layer_inputs[j]]
+
+        mask = self.attention_masks[j]
+        additional_layer_inputs = {"attention_mask": mask if mask is None else self._to_device(mask)}
+        layer_position_ids = None if not self.position_ids else _nested(self.position_ids[j], self._to_device)
+        if layer_position_ids is not None:
+            additional_layer_inputs["position_ids"] = layer_position_ids
+        for k, v in self.layer_input_kwargs[j].items():
+            additional_layer_inputs[k] = _nested(v, self._to_device)
+
+        return layer_input, additional_layer_inputs
+
+    def _record_stream(self, batch: Tuple[List, Dict]):
+        # tensors allocated on the side stream are used on the compute stream
+        stream = torch.cuda.current_stream(self.device)
+        for t in _nested_tensors(list(batch)):
+            if t.device.type == "cuda":
+                t.record_stream(stream)
+
+    def batches(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Tuple[int, List, Dict]]:
+        """Yields `(index, layer_input, additional_layer_inputs)` of the batches `[start, stop)` on the layer device."""
+        stop = self.num_batches if stop is None else min(stop, self.num_batches)
+        if self._resident is not None:
+            for j in range(start, stop):
+                layer_input, additional_layer_inputs = self._resident[j]
+                yield j, list(layer_input), dict(additional_layer_inputs)
+            return
+
+        if not self.async_copy:
+            for j in range(start, stop):
+                yield j, *self._batch(j)
+            return
+
+        current = torch.cuda.current_stream(self.device)
+        with torch.cuda.stream(self._stream):
+            next_batch = self._batch(start) if start < stop else None
+        for j in range(start, stop):
+            current.wait_stream(self._stream)
+            batch = next_batch
+            self._record_stream(batch)
+            if j + 1 < stop:
+                with torch.cuda.stream(self._stream):
+                    next_batch = self._batch(j + 1)
+            yield j, *batch
+
+    def release(self):
+        self._resident = None
+        self._stream = None
+
+
+__all__ = ["LayerInputTransfer", "to_host"]
@@ -0,0 +1,53 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.quantization import GPTQ  # noqa: E402
+
+
+class SolverTest(unittest.TestCase):
+    """
+    Shared fixture of the single module solver feature tests (outliers, adapters, awq, sparsity): a `[64, 128]`
+    linear layer and one calibration batch of 512 tokens whose input channels have uneven scales.
+    """
+    # sub test can modify
+    BITS = 4
+    INFEATURES = 128
+    OUTFEATURES = 64
+
+    def input_scale(self) -> torch.Tensor:
+        # per input channel scale of the calibration inputs
+        return torch.linspace(0.2, 2, self.INFEATURES)
+
+    def setUp(self):
+        torch.manual_seed(0)
+        scale = self.input_scale()
+        self.inp = torch.randn(1, 512, self.INFEATURES) * scale
+        self.weight = torch.randn(self.OUTFEATURES, self.INFEATURES) * 0.1
+
+    def layer(self) -> torch.nn.Linear:
+        layer = torch.nn.Linear(self.INFEATURES, self.OUTFEATURES, bias=False)
+        layer.weight.data = self.weight.clone()
+        return layer
+
+    def collect(self, layer: torch.nn.Linear, inp: torch.Tensor = None, bits: int = None) -> GPTQ:
+        g = GPTQ(layer)
+        g.quantizer.configure(bits or self.BITS, perchannel=True, sym=False, mse=0.0)
+        g.add_batch(self.inp if inp is None else inp, None)
+        return g
+
+    def solve(self, layer: torch.nn.Linear, bits: int = None, **kwargs) -> GPTQ:
+        # the solve result `(scale, zero, g_idx, duration, avg_loss, damp_percent)` is kept in `g.result`
+        g = self.collect(layer, bits=bits)
+        g.result = g.quantize(blocksize=64, percdamp=0.01, **kwargs)
+        return g
+
+    def output_error(self, weight: torch.Tensor) -> float:
+        # mean squared output error of `weight` against the fp weight on the calibration inputs
+        x = self.inp.reshape(-1, self.INFEATURES)
+        return (x @ weight.t() - x @ self.weight.t()).pow(2).mean().item()
@@ -0,0 +1,86 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+from unittest import mock  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.nn_modules.qlinear.ipex import IPEXQuantLinear  # noqa: E402
+from gptqmodel.nn_modules.qlinear.torch import TorchQuantLinear  # noqa: E402
+from gptqmodel.quantization import QuantizeConfig, RTNQuantizeConfig  # noqa: E402
+from gptqmodel.quantization.gptq import low_rank_correction  # noqa: E402
+from gptqmodel.utils.model import dequantize_packed_weight, pack_layer  # noqa: E402
+from parameterized import parameterized  # noqa: E402
+from solver_test import SolverTest  # noqa: E402
+
+
+class TestAdapter(SolverTest):
+    BITS = 2
+
+    @parameterized.expand([
+        (32, False),
+        (32, True),
+        (-1, False),
+    ])
+    def test_adapter(self, group_size: int, actorder: bool):
+        quantized = self.layer()
+        self.solve(quantized, group_size=group_size, actorder=actorder)
+        layer = self.layer()
+        g = self.solve(layer, group_size=group_size, actorder=actorder, adapter_rank=8)
+
+        A, B = g.adapter
+        self.assertEqual(A.shape, (64, 8))
+        self.assertEqual(B.shape, (8, 128))
+        # the solved weight is the quantized weight plus the correction, not the plain quantized one
+        self.assertFalse(torch.allclose(layer.weight.data, quantized.weight.data))
+        self.assertLess(self.output_error(layer.weight.data), self.output_error(quantized.weight.data))
+
+    def test_exact_low_rank(self):
+        # an error of rank 4 is recovered exactly for any positive definite hessian
+        R = torch.randn(64, 4) @ torch.randn(4, 128)
+        X = torch.randn(512, 128)
+        A, B = low_rank_correction(R, X.t() @ X / 512, 4)
+        torch.testing.assert_close(A @ B, R, rtol=1e-3, atol=1e-3)
+
+    @parameterized.expand([
+        (TorchQuantLinear, 2),
+        (IPEXQuantLinear, 4),
+    ])
+    def test_save_load(self, QuantLinear, bits: int):
+        layer = self.layer()
+        g = self.solve(layer, bits=bits, group_size=32, adapter_rank=8)
+        scale, zero, g_idx = g.result[:3]
+        A, B = g.adapter
+        corrected = layer.weight.data.clone()
+
+        def quant_linear():
+            qlayer = QuantLinear(bits=bits, group_size=32, sym=False, desc_act=False, infeatures=128, outfeatures=64,
+                                 bias=False, weight_dtype=torch.float32)
+            qlayer.register_adapter(8, torch.float32)
+            return qlayer
+
+        qlayer = quant_linear()
+        qlayer.device = torch.device("cpu")
+        quantizers = {"m": (g.quantizer, scale, zero, g_idx, None, g.adapter)}
+        pack_layer("m", {"m": qlayer}, quantizers, {"m": layer}, QuantLinear, mock.MagicMock())
+        if QuantLinear is TorchQuantLinear:
+            # the correction is packed on the side, not in the quantized weight
+            torch.testing.assert_close(qlayer.dequantize_weight().t(), corrected - A @ B, rtol=1e-4, atol=1e-4)
+            # requantize() and previous_quantized reuse dequantize the checkpoint tensors with the correction
+            torch.testing.assert_close(dequantize_packed_weight(qlayer.state_dict(), bits, 32, False, False), corrected,
+                                       rtol=1e-4, atol=1e-4)
+
+        # the forward hook of the adapter survives loading and the kernel's post_init()
+        loaded = quant_linear()
+        loaded.load_state_dict(qlayer.state_dict())
+        loaded.post_init()
+        x = torch.randn(2, 5, 128)
+        torch.testing.assert_close(loaded(x), x @ corrected.t(), rtol=1e-4, atol=1e-4)
+
+    def test_config(self):
+        with self.assertRaises(ValueError):
+            QuantizeConfig(adapter_rank=-1)
+        with self.assertRaises(ValueError):
+            RTNQuantizeConfig(adapter_rank=8)
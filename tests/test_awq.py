@@ -0,0 +1,94 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import torch  # noqa: E402
+from gptqmodel.models.definitions.llama import LlamaGPTQ  # noqa: E402
+from gptqmodel.quantization import GPTQ, HESSIAN_MODE, QuantizeConfig, RTNQuantizeConfig  # noqa: E402
+from gptqmodel.quantization.awq import search_awq_scales  # noqa: E402
+from solver_test import SolverTest  # noqa: E402
+from transformers import LlamaConfig, LlamaForCausalLM  # noqa: E402
+
+
+class TestAWQ(SolverTest):
+    BITS = 3
+
+    def input_scale(self) -> torch.Tensor:
+        # a few salient input channels dominate the output
+        self.salient = torch.randperm(128)[:4]
+        scale = torch.ones(128)
+        scale[self.salient] = 30
+        return scale
+
+    def test_scale_inputs(self):
+        g = self.collect(self.layer())
+        s = torch.rand(128) + 0.5
+        g.scale_inputs(s)
+
+        expected = self.collect(self.layer(), self.inp / s)
+        torch.testing.assert_close(g.hessian(), expected.hessian(), rtol=1e-4, atol=1e-4)
+        x = self.inp.reshape(-1, 128)
+        torch.testing.assert_close(g.layer(x / s), x @ self.weight.t(), rtol=1e-4, atol=1e-4)
+
+    def test_search(self):
+        quantized = self.layer()
+        self.solve(quantized, group_size=32)
+
+        layer = self.layer()
+        g = self.collect(layer)
+        s, alpha = search_awq_scales([g], [32])
+        # salient channels are scaled up, the scales are normalized around 1
+        self.assertGreater(alpha, 0)
+        self.assertGreater(s[self.salient].min().item(), s.median().item())
+        g.scale_inputs(s)
+        g.quantize(blocksize=64, percdamp=0.01, group_size=32)
+
+        # the module reads x / s, its effective weight is W / s
+        self.assertLess(self.output_error(layer.weight.data / s), self.output_error(quantized.weight.data))
+
+    def test_single_subset(self):
+        # true_sequential=False quantizes all modules of a layer in one subset reading 4 producers
+        config = LlamaConfig(hidden_size=64, intermediate_size=96, num_hidden_layers=2, num_attention_heads=4,
+                             num_key_value_heads=4, vocab_size=128)
+        model = LlamaForCausalLM(config).eval()
+        layer = model.model.layers[0]
+        salient = torch.randperm(64)[:4]
+        layer.input_layernorm.weight.data[salient] = 30
+        layer.post_attention_layernorm.weight.data[salient] = 30
+        input_ids = torch.randint(0, 128, (4, 32))
+
+        gptq_model = LlamaGPTQ(model, quantized=False, quantize_config=QuantizeConfig(awq=True, true_sequential=False))
+        layer_modules = gptq_model.get_layer_modules()
+        self.assertEqual(len(layer_modules), 1)
+        names = layer_modules[0]
+        full = {n: layer.get_submodule(n) for n in names}
+
+        def forward():
+            gptq = {n: GPTQ(full[n]) for n in names}
+            for g in gptq.values():
+                g.quantizer.configure(3, perchannel=True, sym=False, mse=0.0)
+            handles = [full[n].register_forward_hook(lambda m, inp, out, n=n: gptq[n].add_batch(inp[0], out))
+                       for n in names]
+            with torch.no_grad():
+                logits = model(input_ids).logits
+            for h in handles:
+                h.remove()
+            return gptq, logits
+
+        gptq, expected = forward()
+        gptq_model._awq_scale_subset(layer, full, names, gptq, {n: {"group_size": 32} for n in names}, {}, 0)
+
+        scaled, logits = forward()
+        torch.testing.assert_close(logits, expected, rtol=1e-4, atol=1e-4)
+        # every consumer's hessian follows the scales of its own producer
+        for n in names:
+            torch.testing.assert_close(gptq[n].hessian(), scaled[n].hessian(), rtol=1e-3, atol=1e-3)
+        self.assertFalse(torch.allclose(layer.input_layernorm.weight.data[salient], torch.full((4,), 30.0)))
+
+    def test_config(self):
+        with self.assertRaises(ValueError):
+            QuantizeConfig(awq=True, hessian_mode=HESSIAN_MODE.LOW_RANK)
+        with self.assertRaises(ValueError):
+            RTNQuantizeConfig(awq=True)
@@ -0,0 +1,47 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.quantization import GPTQ  # noqa: E402
+from gptqmodel.quantization.gptq import quantize_batched  # noqa: E402
+from parameterized import parameterized  # noqa: E402
+
+
+class TestBatchedSolver(unittest.TestCase):
+    def _gptqs(self, count: int, seed: int = 0):
+        torch.manual_seed(seed)
+        gptqs = {}
+        for e in range(count):
+            g = GPTQ(torch.nn.Linear(256, 64, bias=False))
+            g.quantizer.configure(4, perchannel=True, sym=True, mse=0.0)
+            for _ in range(4):
+                g.add_batch(torch.randn(1, 128, 256), None)
+            gptqs[f"experts.{e}"] = g
+        return gptqs
+
+    @parameterized.expand([
+        (128, False),
+        (64, True),
+        (-1, False),
+    ])
+    def test_matches_per_module(self, group_size: int, actorder: bool):
+        kwargs = {"percdamp": 0.01, "group_size": group_size, "actorder": actorder, "static_groups": False}
+        reference = self._gptqs(4)
+        batched = self._gptqs(4)
+
+        expected = quantize_batched(reference, {n: kwargs for n in reference}, batch_size=1)
+        actual = quantize_batched(batched, {n: kwargs for n in batched}, batch_size=4)
+
+        for name in reference:
+            scale, zero, g_idx, _, loss, _ = expected[name]
+            b_scale, b_zero, b_g_idx, _, b_loss, _ = actual[name]
+            torch.testing.assert_close(b_scale, scale, rtol=1e-4, atol=1e-6)
+            torch.testing.assert_close(b_zero, zero)
+            self.assertTrue(torch.equal(b_g_idx, g_idx))
+            self.assertAlmostEqual(b_loss, loss, delta=abs(loss) * 1e-3)
+            torch.testing.assert_close(batched[name].layer.weight, reference[name].layer.weight, rtol=1e-3, atol=1e-4)
@@ -0,0 +1,57 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+import torch.nn as nn  # noqa: E402
+from gptqmodel.quantization import GPTQ  # noqa: E402
+from gptqmodel.utils.calibration import calibration_forward  # noqa: E402
+
+
+class Layer(nn.Module):
+    # decoder layer like: tuple output, records the autocast state and dtype of its linear output
+    def __init__(self):
+        super().__init__()
+        self.linear = nn.Linear(64, 64)
+        self.autocast = None
+        self.dtype = None
+
+    def forward(self, hidden_states, attention_mask=None):
+        self.autocast = torch.is_autocast_cpu_enabled()
+        out = self.linear(hidden_states)
+        self.dtype = out.dtype
+        return (out, attention_mask)
+
+
+class TestCalibrationForward(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.layer = Layer()
+        self.inp = torch.randn(2, 16, 64)
+
+    def test_autocast(self):
+        g = GPTQ(self.layer.linear)
+        handle = self.layer.linear.register_forward_hook(lambda m, inp, out: g.add_batch(inp[0].data, out.data))
+        out, mask = calibration_forward(self.layer, [self.inp], {"attention_mask": None}, torch.bfloat16)
+        handle.remove()
+
+        self.assertTrue(self.layer.autocast)
+        self.assertEqual(self.layer.dtype, torch.bfloat16)
+        # the next layer reads its inputs in the captured dtype
+        self.assertEqual(out.dtype, torch.float32)
+        self.assertIsNone(mask)
+
+        # add_batch() of the autocast forward accumulates the same fp32 hessian as a plain one
+        expected = GPTQ(self.layer.linear)
+        expected.add_batch(self.inp, None)
+        self.assertEqual(g.H.dtype, torch.float32)
+        torch.testing.assert_close(g.H, expected.H)
+
+    def test_no_autocast(self):
+        out, _ = calibration_forward(self.layer, [self.inp], {}, None)
+        self.assertFalse(self.layer.autocast)
+        torch.testing.assert_close(out, self.layer.linear(self.inp))
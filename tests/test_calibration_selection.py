@@ -0,0 +1,50 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from datasets import load_dataset  # noqa: E402
+from gptqmodel import GPTQModel  # noqa: E402
+from gptqmodel.quantization import QuantizeConfig  # noqa: E402
+from gptqmodel.utils.calibration import select_calibration_samples  # noqa: E402
+from transformers import AutoTokenizer  # noqa: E402
+
+
+class TestCalibrationSelection(unittest.TestCase):
+    NATIVE_MODEL_ID = "/monster/data/model/TinyLlama-1.1B-Chat-v1.0"
+
+    def test_select_samples(self):
+        embeddings = torch.nn.functional.normalize(torch.tensor([
+            [1.0, 0.0, 0.0],
+            [1.0, 0.01, 0.0],  # near duplicate of 0
+            [0.0, 1.0, 0.0],
+            [0.0, 0.0, 1.0],
+            [0.7, 0.7, 0.0],
+        ]), dim=1)
+        lengths = [10, 10, 10, 10, 50]
+
+        self.assertEqual(select_calibration_samples(embeddings, lengths), [0, 2, 3, 4])
+        # the 50 token sample does not fit the budget
+        self.assertEqual(select_calibration_samples(embeddings, lengths, max_tokens=40), [0, 2, 3])
+        self.assertEqual(len(select_calibration_samples(embeddings, lengths, max_samples=2)), 2)
+
+    def test_select_calibration_dataset(self):
+        tokenizer = AutoTokenizer.from_pretrained(self.NATIVE_MODEL_ID, use_fast=True)
+        traindata = load_dataset("wikitext", "wikitext-2-raw-v1", split="train").filter(lambda x: len(x['text']) >= 512)
+        texts = [example["text"] for example in traindata.select(range(128))]
+        # duplicated samples must never be selected twice
+        calibration_dataset = [tokenizer(text) for text in texts + texts[:32]]
+
+        model = GPTQModel.load(self.NATIVE_MODEL_ID, quantize_config=QuantizeConfig(bits=4, group_size=128))
+        selected = model.select_calibration_dataset(calibration_dataset, max_samples=32, max_tokens=32 * 512)
+
+        self.assertLessEqual(len(selected), 32)
+        self.assertLessEqual(sum(len(sample["input_ids"]) for sample in selected), 32 * 512)
+        self.assertEqual(len(set(tuple(sample["input_ids"]) for sample in selected)), len(selected))
+
+        quant_log = model.quantize(selected, batch_size=4)
+        self.assertTrue(len(quant_log) > 0)
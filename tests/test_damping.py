@@ -0,0 +1,67 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.quantization.gptq import damped_hessian_inverse  # noqa: E402
+
+
+def retry_loop_percdamp(H, percdamp, damp_auto_increment):
+    # one cholesky per damp_auto_increment step, like the original retry loop
+    factorizations = 0
+    while True:
+        factorizations += 1
+        _, info = torch.linalg.cholesky_ex(H + percdamp * torch.mean(torch.diag(H)) * torch.eye(H.shape[0]))
+        if info == 0:
+            return percdamp, factorizations
+        percdamp += damp_auto_increment
+
+
+def indefinite_hessian(columns=128, shift=0.3):
+    torch.manual_seed(0)
+    x = torch.randn(columns * 2, columns)
+    H = 2 / x.shape[0] * x.t() @ x
+    # negative eigenvalues like a hessian of too few samples accumulated with round off
+    return H - shift * torch.mean(torch.diag(H)) * torch.eye(columns)
+
+
+class TestDamping(unittest.TestCase):
+    def test_single_factorization(self):
+        torch.manual_seed(0)
+        x = torch.randn(512, 64)
+        H = 2 / 512 * x.t() @ x
+        damp = 0.01 * torch.mean(torch.diag(H))
+        expected = torch.linalg.cholesky(torch.cholesky_inverse(torch.linalg.cholesky(H + damp * torch.eye(64))), upper=True)
+
+        Hinv, percdamp, factorizations = damped_hessian_inverse(H.clone(), 0.01, 0.0015)
+        self.assertEqual(percdamp, 0.01)
+        self.assertEqual(factorizations, 1)
+        torch.testing.assert_close(Hinv, expected)
+
+    def test_indefinite_hessian(self):
+        H = indefinite_hessian()
+        loop_percdamp, loop_factorizations = retry_loop_percdamp(H, 0.01, 0.0015)
+
+        Hinv, percdamp, factorizations = damped_hessian_inverse(H.clone(), 0.01, 0.0015)
+        self.assertLessEqual(factorizations, 6)
+        self.assertLess(factorizations, loop_factorizations)
+        # fp64 may factorize one step earlier than the fp32 loop
+        self.assertGreaterEqual(percdamp, loop_percdamp - 0.0015 - 1e-9)
+        self.assertLess(percdamp, 1)
+        self.assertFalse(torch.isnan(Hinv).any())
+
+        # the chosen damp is an increment step of the original one
+        steps = (percdamp - 0.01) / 0.0015
+        self.assertAlmostEqual(steps, round(steps), places=6)
+
+    def test_no_auto_increment(self):
+        with self.assertRaises(torch.linalg.LinAlgError):
+            damped_hessian_inverse(indefinite_hessian(), 0.01, 0.0)
+
+    def test_invalid_damp(self):
+        with self.assertRaises(ValueError):
+            damped_hessian_inverse(torch.eye(8), 0.0, 0.0015)
@@ -0,0 +1,117 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import copy  # noqa: E402
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.quantization import GPTQ  # noqa: E402
+from gptqmodel.quantization.gptq import autotune_blocksize  # noqa: E402
+from parameterized import parameterized  # noqa: E402
+
+
+def reference_sweep(W, Hinv, quantizer, blocksize, group_size):
+    # per column find_params/quantize sweep of the original solver
+    W = W.clone()
+    Q = torch.zeros_like(W)
+    scale = []
+    for i1 in range(0, W.shape[1], blocksize):
+        i2 = min(i1 + blocksize, W.shape[1])
+        W1 = W[:, i1:i2].clone()
+        Err1 = torch.zeros_like(W1)
+        Hinv1 = Hinv[i1:i2, i1:i2]
+        for i in range(i2 - i1):
+            w = W1[:, i]
+            d = Hinv1[i, i]
+            if group_size != -1 and (i1 + i) % group_size == 0:
+                quantizer.find_params(W[:, (i1 + i):(i1 + i + group_size)], weight=True)
+                scale.append(quantizer.scale)
+            q = quantizer.quantize(w.unsqueeze(1)).flatten()
+            Q[:, i1 + i] = q
+            err1 = (w - q) / d
+            W1[:, i:] -= err1.unsqueeze(1).matmul(Hinv1[i, i:].unsqueeze(0))
+            Err1[:, i] = err1
+        W[:, i2:] -= Err1.matmul(Hinv[i1:i2, i2:])
+    return Q, torch.cat(scale, dim=1) if scale else quantizer.scale
+
+
+def reference_static_sweep(W, H, quantizer, group_size, actorder):
+    # static groups as one deep copied quantizer per group, looked up per column
+    groups = []
+    for i in range(0, W.shape[1], group_size):
+        group = copy.deepcopy(quantizer)
+        group.find_params(W[:, i:i + group_size], weight=True)
+        groups.append(group)
+
+    perm = torch.argsort(torch.diag(H), descending=True) if actorder else torch.arange(W.shape[1])
+    W = W[:, perm].clone()
+    H = H[perm][:, perm]
+    Hinv = torch.linalg.cholesky(torch.cholesky_inverse(torch.linalg.cholesky(H)), upper=True)
+    Q = torch.zeros_like(W)
+    for i in range(W.shape[1]):
+        w = W[:, i]
+        q = groups[perm[i] // group_size].quantize(w.unsqueeze(1)).flatten()
+        Q[:, i] = q
+        W[:, i:] -= ((w - q) / Hinv[i, i]).unsqueeze(1).matmul(Hinv[i, i:].unsqueeze(0))
+    g_idx = (perm // group_size).to(torch.int32)
+    invperm = torch.argsort(perm)
+    return Q[:, invperm], torch.cat([g.scale for g in groups], dim=1), g_idx[invperm]
+
+
+class TestGPTQSweep(unittest.TestCase):
+    @parameterized.expand([
+        (128, 128),
+        (64, 32),
+        (32, 128),
+        (-1, 128),
+    ])
+    def test_matches_reference(self, group_size: int, blocksize: int):
+        torch.manual_seed(0)
+        # 320 columns: the last group is partial for group_size 128
+        layer = torch.nn.Linear(320, 48, bias=False)
+        g = GPTQ(layer)
+        g.quantizer.configure(4, perchannel=True, sym=False, mse=0.0)
+        g.add_batch(torch.randn(1, 512, 320), None)
+
+        W = layer.weight.data.clone().float()
+        H = g.H.clone()
+        damp = 0.01 * torch.mean(torch.diag(H))
+        H += damp * torch.eye(H.shape[0])
+        Hinv = torch.linalg.cholesky(torch.cholesky_inverse(torch.linalg.cholesky(H)), upper=True)
+        quantizer = copy.deepcopy(g.quantizer)
+        quantizer.find_params(W, weight=True)
+        expected_q, expected_scale = reference_sweep(W, Hinv, quantizer, blocksize, group_size)
+
+        scale, _, _, _, _, _ = g.quantize(blocksize=blocksize, percdamp=0.01, group_size=group_size, actorder=False)
+
+        torch.testing.assert_close(layer.weight.data, expected_q, rtol=1e-4, atol=1e-4)
+        torch.testing.assert_close(scale, expected_scale)
+
+    @parameterized.expand([(False,), (True,)])
+    def test_static_groups(self, actorder: bool):
+        torch.manual_seed(0)
+        layer = torch.nn.Linear(320, 48, bias=False)
+        g = GPTQ(layer)
+        g.quantizer.configure(4, perchannel=True, sym=False, mse=0.0)
+        g.add_batch(torch.randn(1, 512, 320) * torch.linspace(0.1, 2, 320), None)
+
+        W = layer.weight.data.clone().float()
+        H = g.H.clone()
+        H += 0.01 * torch.mean(torch.diag(H)) * torch.eye(H.shape[0])
+        quantizer = copy.deepcopy(g.quantizer)
+        expected_q, expected_scale, expected_g_idx = reference_static_sweep(W, H, quantizer, 128, actorder)
+
+        scale, _, g_idx, _, _, _ = g.quantize(blocksize=64, percdamp=0.01, group_size=128, actorder=actorder,
+                                              static_groups=True)
+
+        torch.testing.assert_close(layer.weight.data, expected_q, rtol=1e-4, atol=1e-4)
+        torch.testing.assert_close(scale, expected_scale)
+        torch.testing.assert_close(g_idx, expected_g_idx)
+
+    def test_autotune_blocksize(self):
+        blocksize = autotune_blocksize(64, 256, torch.device("cpu"))
+        self.assertIn(blocksize, [32, 64, 128, 256])
+        self.assertEqual(autotune_blocksize(64, 256, torch.device("cpu")), blocksize)
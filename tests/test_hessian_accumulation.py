@@ -0,0 +1,75 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import unittest  # noqa: E402
+from unittest import mock  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.quantization import GPTQ, HESSIAN_ACCUMULATION  # noqa: E402
+from gptqmodel.quantization import gptq as gptq_module  # noqa: E402
+from parameterized import parameterized  # noqa: E402
+
+
+def reference_hessian(batches):
+    H = torch.zeros(batches[0].shape[-1], batches[0].shape[-1], dtype=torch.float64)
+    nsamples = 0
+    for inp in batches:
+        x = inp.reshape(-1, inp.shape[-1]).double()
+        H += x.t() @ x
+        nsamples += inp.shape[0]
+    return 2 / nsamples * H, nsamples
+
+
+class TestHessianAccumulation(unittest.TestCase):
+    @parameterized.expand([
+        (HESSIAN_ACCUMULATION.FP32,),
+        (HESSIAN_ACCUMULATION.FP64,),
+        (HESSIAN_ACCUMULATION.COMPENSATED,),
+    ])
+    def test_matches_reference(self, accumulation: str):
+        torch.manual_seed(0)
+        batches = [torch.randn(2, 96, 64) for _ in range(5)]
+        expected, nsamples = reference_hessian(batches)
+
+        g = GPTQ(torch.nn.Linear(64, 32, bias=False), hessian_accumulation=accumulation)
+        # 40 token chunks, batches are split unevenly
+        with mock.patch.object(gptq_module, "HESSIAN_CHUNK_BYTES", 40 * 64 * g.H.element_size()):
+            for inp in batches:
+                g.add_batch(inp, None)
+
+        self.assertEqual(g.nsamples, nsamples)
+        self.assertEqual(g.hessian().dtype, torch.float32)
+        torch.testing.assert_close(g.hessian().double(), expected, rtol=1e-5, atol=1e-5)
+
+    def test_add_hessian(self):
+        torch.manual_seed(0)
+        inp = torch.randn(3, 50, 64)
+        g = GPTQ(torch.nn.Linear(64, 32, bias=False), hessian_accumulation=HESSIAN_ACCUMULATION.COMPENSATED)
+        g.add_batch(torch.randn(1, 20, 64), None)
+        reference = GPTQ(torch.nn.Linear(64, 32, bias=False))
+        reference.H = g.hessian().clone()
+        reference.nsamples = g.nsamples
+
+        x = inp.reshape(-1, 64)
+        g.add_hessian(x.t() @ x, 3)
+        reference.add_batch(inp, None)
+        torch.testing.assert_close(g.hessian(), reference.hessian(), rtol=1e-5, atol=1e-5)
+
+    def test_precision_many_samples(self):
+        torch.manual_seed(0)
+        # many small batches of offset activations, plain fp32 accumulation drifts
+        batches = [torch.randn(1, 4, 16) + 20 for _ in range(2000)]
+        expected, _ = reference_hessian(batches)
+
+        errors = {}
+        for accumulation in [HESSIAN_ACCUMULATION.FP32, HESSIAN_ACCUMULATION.FP64, HESSIAN_ACCUMULATION.COMPENSATED]:
+            g = GPTQ(torch.nn.Linear(16, 8, bias=False), hessian_accumulation=accumulation)
+            for inp in batches:
+                g.add_batch(inp, None)
+            errors[accumulation] = (g.hessian().double() - expected).abs().max().item()
+
+        self.assertLessEqual(errors[HESSIAN_ACCUMULATION.FP64], errors[HESSIAN_ACCUMULATION.FP32])
+        self.assertLessEqual(errors[HESSIAN_ACCUMULATION.COMPENSATED], errors[HESSIAN_ACCUMULATION.FP32])
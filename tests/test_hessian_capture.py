@@ -0,0 +1,40 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import tempfile  # noqa: E402
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from datasets import load_dataset  # noqa: E402
+from gptqmodel import GPTQModel  # noqa: E402
+from gptqmodel.quantization import HessianCollector, QuantizeConfig  # noqa: E402
+
+
+class TestHessianCapture(unittest.TestCase):
+    NATIVE_MODEL_ID = "/monster/data/model/TinyLlama-1.1B-Chat-v1.0"
+
+    def test_quantize_with_captured_hessians(self):
+        quantize_config = QuantizeConfig(bits=4, group_size=128)
+        model = GPTQModel.load(self.NATIVE_MODEL_ID, quantize_config=quantize_config)
+        traindata = load_dataset("wikitext", "wikitext-2-raw-v1", split="train").filter(lambda x: len(x['text']) >= 512)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "hessians.pt")
+
+            # simulated inference traffic
+            collector = HessianCollector(model, max_tokens=256, overhead_budget=1.0, snapshot_path=path)
+            with collector, torch.no_grad():
+                for example in traindata.select(range(16)):
+                    model(**model.tokenizer(example["text"], return_tensors="pt"))
+
+            self.assertEqual(len(collector.hessians), 22 * 7)
+            self.assertTrue(all(0 < n <= 16 for n in collector.nsamples.values()))
+
+            model = GPTQModel.load(self.NATIVE_MODEL_ID, quantize_config=quantize_config)
+            quant_log = model.quantize(None, hessians=path)
+
+            self.assertEqual(len(quant_log), 22 * 7)
+            self.assertTrue(model.quantized)
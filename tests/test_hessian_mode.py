@@ -0,0 +1,82 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.quantization import GPTQ, HESSIAN_MODE  # noqa: E402
+from parameterized import parameterized  # noqa: E402
+
+
+def configure(g: GPTQ) -> GPTQ:
+    g.quantizer.configure(4, perchannel=True, sym=False, mse=0.0)
+    return g
+
+
+class TestHessianMode(unittest.TestCase):
+    def test_block_diagonal_accumulation(self):
+        torch.manual_seed(0)
+        # 160 columns: the last 64 block is half padding
+        layer = torch.nn.Linear(160, 32, bias=False)
+        full = GPTQ(layer)
+        block = GPTQ(layer, hessian_mode=HESSIAN_MODE.BLOCK_DIAGONAL, hessian_block_size=64)
+        precomputed = GPTQ(layer, hessian_mode=HESSIAN_MODE.BLOCK_DIAGONAL, hessian_block_size=64)
+        for _ in range(3):
+            inp = torch.randn(2, 50, 160)
+            full.add_batch(inp, None)
+            block.add_batch(inp, None)
+            x = inp.reshape(-1, 160)
+            precomputed.add_hessian(x.t() @ x, 2)
+
+        self.assertEqual(block.H.shape, (3, 64, 64))
+        for k, start in enumerate(range(0, 160, 64)):
+            end = min(start + 64, 160)
+            torch.testing.assert_close(block.H[k, :end - start, :end - start], full.H[start:end, start:end])
+        self.assertEqual(block.H[2, 32:].abs().sum().item(), 0)
+        torch.testing.assert_close(precomputed.H, block.H)
+
+    @parameterized.expand([(False,), (True,)])
+    def test_block_diagonal_solve(self, actorder: bool):
+        torch.manual_seed(0)
+        layer = torch.nn.Linear(160, 32, bias=False)
+        reference_layers = [torch.nn.Linear(end - start, 32, bias=False) for start, end in [(0, 64), (64, 128), (128, 160)]]
+        for ref, start in zip(reference_layers, range(0, 160, 64)):
+            ref.weight.data = layer.weight.data[:, start:start + ref.in_features].clone()
+
+        g = configure(GPTQ(layer, hessian_mode=HESSIAN_MODE.BLOCK_DIAGONAL, hessian_block_size=64))
+        references = [configure(GPTQ(ref)) for ref in reference_layers]
+        inp = torch.randn(1, 400, 160) * torch.linspace(0.2, 2, 160)
+        g.add_batch(inp, None)
+        for k, ref in enumerate(references):
+            ref.H = g.H[k, :ref.columns, :ref.columns].clone()
+            ref.nsamples = g.nsamples
+
+        # every hessian block is solved like a module of its own
+        g.quantize(blocksize=None, percdamp=0.01, group_size=32, actorder=actorder)
+        for ref in references:
+            ref.quantize(blocksize=64, percdamp=0.01, group_size=32, actorder=actorder)
+        expected = torch.cat([ref.weight.data for ref in reference_layers], dim=1)
+        torch.testing.assert_close(layer.weight.data, expected)
+
+    def test_low_rank(self):
+        torch.manual_seed(0)
+        layer = torch.nn.Linear(96, 32, bias=False)
+        full = GPTQ(layer)
+        exact = GPTQ(layer, hessian_mode=HESSIAN_MODE.LOW_RANK, hessian_rank=96)
+        low = GPTQ(layer, hessian_mode=HESSIAN_MODE.LOW_RANK, hessian_rank=16)
+        for _ in range(2):
+            inp = torch.randn(1, 300, 96) @ torch.randn(96, 96)
+            for g in [full, exact, low]:
+                g.add_batch(inp, None)
+
+        self.assertEqual(low.H.shape, (96, 16))
+        H = full.hessian()
+        # full rank sketch reproduces the hessian
+        torch.testing.assert_close(exact.hessian(), H, rtol=1e-3, atol=1e-3 * H.abs().max().item())
+
+        approx = low.hessian()
+        torch.testing.assert_close(torch.diagonal(approx), torch.diagonal(H), rtol=1e-4, atol=1e-4)
+        self.assertGreater(torch.linalg.eigvalsh(approx.double()).min().item(), -1e-3 * H.abs().max().item())
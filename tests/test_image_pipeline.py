@@ -0,0 +1,59 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import tempfile  # noqa: E402
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.models.definitions.qwen2_vl import Qwen2VLGPTQ  # noqa: E402
+from gptqmodel.utils.image import ProcessedBatchCache, fetch_images, image_fingerprint  # noqa: E402
+from PIL import Image  # noqa: E402
+from transformers import BatchFeature  # noqa: E402
+
+
+class TestImagePipeline(unittest.TestCase):
+    def test_fetch_images_keeps_order(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            infos = []
+            for i in range(6):
+                path = os.path.join(tmp_dir, f"{i}.png")
+                Image.new("RGB", (8 + i, 8), color=(i * 40, 0, 0)).save(path)
+                infos.append({"type": "image", "image": f"file://{path}"})
+
+            images = fetch_images(infos, num_workers=4)
+            self.assertEqual([image.size[0] for image in images], [8 + i for i in range(6)])
+
+            # same content, different path: same fingerprint
+            copy_path = os.path.join(tmp_dir, "copy.png")
+            with open(os.path.join(tmp_dir, "0.png"), "rb") as src, open(copy_path, "wb") as dst:
+                dst.write(src.read())
+            self.assertEqual(image_fingerprint(infos[0]), image_fingerprint({"image": copy_path}))
+            self.assertNotEqual(image_fingerprint(infos[0]), image_fingerprint(infos[1]))
+
+    def test_unsupported_vision_info(self):
+        # rejected before any image is fingerprinted or fetched
+        for ele in [{"type": "video", "video": "file:///video.mp4"}, {"type": "image"}]:
+            conversation = [{"role": "user", "content": [ele, {"type": "text", "text": "describe"}]}]
+            with self.assertRaises(ValueError):
+                Qwen2VLGPTQ.image_infos(conversation)
+
+        conversation = [{"role": "user", "content": [{"type": "image", "image": "file:///0.png"}]}]
+        self.assertEqual(Qwen2VLGPTQ.image_infos(conversation), [{"type": "image", "image": "file:///0.png"}])
+
+    def test_processed_batch_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = ProcessedBatchCache(tmp_dir, namespace="test")
+            key = cache.key("config", ["text"], ["image-hash"])
+            self.assertIsNone(cache.get(key))
+
+            inputs = BatchFeature(data={"input_ids": torch.arange(4).unsqueeze(0), "pixel_values": torch.randn(2, 3)})
+            cache.put(key, inputs)
+
+            cached = ProcessedBatchCache(tmp_dir, namespace="test").get(key)
+            self.assertIsInstance(cached, BatchFeature)
+            for k in inputs:
+                self.assertTrue(torch.equal(cached[k], inputs[k]))
+            self.assertNotEqual(key, cache.key("config", ["text"], ["other-image-hash"]))
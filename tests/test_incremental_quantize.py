@@ -0,0 +1,59 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import tempfile  # noqa: E402
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from datasets import load_dataset  # noqa: E402
+from gptqmodel import GPTQModel  # noqa: E402
+from gptqmodel.models.writer import QUANT_FINGERPRINT_FILENAME  # noqa: E402
+from gptqmodel.quantization import QuantizeConfig  # noqa: E402
+from gptqmodel.utils.model import checkpoint_tensor_files, load_checkpoint_tensors  # noqa: E402
+from transformers import AutoTokenizer  # noqa: E402
+
+
+class TestIncrementalQuantize(unittest.TestCase):
+    NATIVE_MODEL_ID = "/monster/data/model/TinyLlama-1.1B-Chat-v1.0"
+    CHANGED_MODULE = "model.layers.3.mlp.down_proj"
+
+    @classmethod
+    def setUpClass(self):
+        self.tokenizer = AutoTokenizer.from_pretrained(self.NATIVE_MODEL_ID, use_fast=True)
+        traindata = load_dataset("wikitext", "wikitext-2-raw-v1", split="train").filter(lambda x: len(x['text']) >= 512)
+        self.calibration_dataset = [self.tokenizer(example["text"]) for example in traindata.select(range(32))]
+
+    def test_reuse_unchanged_modules(self):
+        quantize_config = QuantizeConfig(bits=4, group_size=128)
+
+        with tempfile.TemporaryDirectory() as previous_dir, tempfile.TemporaryDirectory() as tmp_dir:
+            model = GPTQModel.load(self.NATIVE_MODEL_ID, quantize_config=quantize_config)
+            model.quantize(self.calibration_dataset, batch_size=4)
+            model.save(previous_dir)
+            del model
+
+            self.assertTrue(os.path.isfile(os.path.join(previous_dir, QUANT_FINGERPRINT_FILENAME)))
+
+            model = GPTQModel.load(self.NATIVE_MODEL_ID, quantize_config=quantize_config)
+            changed = model.model.get_submodule(self.CHANGED_MODULE)
+            changed.weight.data *= 1.01
+
+            quant_log = model.quantize(self.calibration_dataset, batch_size=4, previous_quantized=previous_dir)
+            model.save(tmp_dir)
+
+            # only the changed module is quantized again
+            self.assertEqual([f"model.layers.{stat['layer']}.{stat['module']}" for stat in quant_log], [self.CHANGED_MODULE])
+
+            previous_map = checkpoint_tensor_files(previous_dir)
+            current_map = checkpoint_tensor_files(tmp_dir)
+            reused = load_checkpoint_tensors(current_map, "model.layers.0.self_attn.q_proj")
+            expected = load_checkpoint_tensors(previous_map, "model.layers.0.self_attn.q_proj")
+            for key in ["qweight", "qzeros", "scales", "g_idx"]:
+                self.assertTrue(torch.equal(reused[key], expected[key]), key)
+
+            requantized = load_checkpoint_tensors(current_map, self.CHANGED_MODULE)
+            previous = load_checkpoint_tensors(previous_map, self.CHANGED_MODULE)
+            self.assertFalse(torch.equal(requantized["scales"], previous["scales"]))
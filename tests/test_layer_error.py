@@ -0,0 +1,81 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import unittest  # noqa: E402
+
+from datasets import load_dataset  # noqa: E402
+from gptqmodel import GPTQModel  # noqa: E402
+from gptqmodel.models.definitions.llama import LlamaGPTQ  # noqa: E402
+from gptqmodel.models.writer import QUANT_LOG_OUT_COS, QUANT_LOG_OUT_MSE  # noqa: E402
+from gptqmodel.quantization import QuantizeConfig  # noqa: E402
+from transformers import AutoTokenizer, LlamaConfig, LlamaForCausalLM  # noqa: E402
+
+
+class TestLayerError(unittest.TestCase):
+    NATIVE_MODEL_ID = "/monster/data/model/TinyLlama-1.1B-Chat-v1.0"
+
+    @classmethod
+    def setUpClass(self):
+        self.tokenizer = AutoTokenizer.from_pretrained(self.NATIVE_MODEL_ID, use_fast=True)
+        traindata = load_dataset("wikitext", "wikitext-2-raw-v1", split="train").filter(lambda x: len(x['text']) >= 512)
+        self.calibration_dataset = [self.tokenizer(example["text"]) for example in traindata.select(range(32))]
+
+    def test_layer_error_logged(self):
+        quantize_config = QuantizeConfig(bits=4, group_size=128, layer_error_batches=2)
+        model = GPTQModel.load(self.NATIVE_MODEL_ID, quantize_config=quantize_config)
+
+        quant_log = model.quantize(self.calibration_dataset, batch_size=4)
+
+        for stat in quant_log:
+            self.assertIn(QUANT_LOG_OUT_MSE, stat)
+            self.assertIn(QUANT_LOG_OUT_COS, stat)
+            self.assertGreater(float(stat[QUANT_LOG_OUT_COS]), 0.9)
+
+    def test_layer_error_abort(self):
+        # no 2bit layer can reach a cosine of 1.0
+        quantize_config = QuantizeConfig(bits=2, group_size=128, layer_error_batches=2, layer_error_min_cosine=1.0,
+                                         layer_error_retries=1)
+        model = GPTQModel.load(self.NATIVE_MODEL_ID, quantize_config=quantize_config)
+
+        with self.assertRaises(RuntimeError):
+            model.quantize(self.calibration_dataset, batch_size=4)
+
+
+class TestLayerErrorConfig(unittest.TestCase):
+    def model(self, **kwargs) -> LlamaGPTQ:
+        config = LlamaConfig(hidden_size=64, intermediate_size=96, num_hidden_layers=2, num_attention_heads=4,
+                             num_key_value_heads=4, vocab_size=128)
+        return LlamaGPTQ(LlamaForCausalLM(config), quantized=False, quantize_config=QuantizeConfig(**kwargs))
+
+    def test_held_out_batches(self):
+        # by default every calibration batch feeds the hessians
+        for num_batches in [1, 4, 256]:
+            self.assertEqual(self.model()._layer_error_batches(num_batches), 0)
+
+        model = self.model(layer_error_batches=4)
+        self.assertEqual(model._layer_error_batches(256), 4)
+        # at least one batch is left for the hessians
+        self.assertEqual(model._layer_error_batches(4), 3)
+        self.assertEqual(model._layer_error_batches(1), 0)
+
+    def test_override_layer_bits(self):
+        dynamic = {
+            r"-:.*\.o_proj": {},
+            r"+:.*\.mlp\..*": {"bits": 8, "group_size": 32},
+        }
+        model = self.model(bits=4, dynamic=dynamic, layer_error_retry_bits=8)
+
+        # a second retry of the same layer does not stack rules
+        for _ in range(2):
+            model._override_layer_bits(1, 3)
+        config = model.quantize_config
+
+        self.assertFalse(config.dynamic_get("model.layers.1.self_attn.o_proj"))
+        self.assertEqual(config.dynamic_get("model.layers.1.mlp.up_proj"), {"bits": 3, "group_size": 32})
+        self.assertEqual(config.dynamic_get("model.layers.1.self_attn.q_proj"), {"bits": 3})
+        self.assertEqual(config.dynamic_get("model.layers.0.mlp.up_proj"), {"bits": 8, "group_size": 32})
+        self.assertIsNone(config.dynamic_get("model.layers.0.self_attn.q_proj"))
+        self.assertEqual(len(config.dynamic), 4)
@@ -0,0 +1,98 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import unittest  # noqa: E402
+from unittest import mock  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.utils.model import nested_move_to  # noqa: E402
+from gptqmodel.utils.transfer import LayerInputTransfer  # noqa: E402
+from parameterized import parameterized  # noqa: E402
+
+CUDA = torch.device("cuda:0")
+
+
+class TestLayerInputTransfer(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.layer_inputs = [[torch.randn(1, 8, 16)] for _ in range(3)]
+        self.attention_masks = [torch.ones(1, 1, 8, 8), None, torch.zeros(1, 1, 8, 8)]
+        self.position_ids = [torch.arange(8).unsqueeze(0) + j for j in range(3)]
+        self.layer_input_kwargs = [
+            {"cache_position": torch.arange(8), "rotary": (torch.randn(8, 4), torch.randn(8, 4)), "use_cache": False}
+            for _ in range(3)
+        ]
+
+    def transfer(self, device: torch.device, position_ids: bool = True) -> LayerInputTransfer:
+        return LayerInputTransfer(self.layer_inputs, self.attention_masks, self.position_ids if position_ids else [],
+                                  self.layer_input_kwargs, device)
+
+    def expected(self, j: int, device: torch.device, position_ids: bool = True):
+        # inputs of batch j moved like the layer loop did before the transfer
+        layer_input = [nested_move_to(inp, device) for inp in self.layer_inputs[j]]
+        mask = self.attention_masks[j]
+        kwargs = {"attention_mask": None if mask is None else mask.to(device)}
+        if position_ids:
+            kwargs["position_ids"] = self.position_ids[j].to(device)
+        for k, v in self.layer_input_kwargs[j].items():
+            kwargs[k] = nested_move_to(v, device)
+        return layer_input, kwargs
+
+    def assertNestedEqual(self, actual, expected):
+        if isinstance(expected, torch.Tensor):
+            self.assertEqual(actual.device, expected.device)
+            self.assertTrue(torch.equal(actual, expected))
+        elif isinstance(expected, (list, tuple)):
+            self.assertEqual(type(actual), type(expected))
+            self.assertEqual(len(actual), len(expected))
+            for a, e in zip(actual, expected):
+                self.assertNestedEqual(a, e)
+        elif isinstance(expected, dict):
+            self.assertEqual(list(actual), list(expected))
+            for k in expected:
+                self.assertNestedEqual(actual[k], expected[k])
+        else:
+            self.assertEqual(actual, expected)
+
+    def check_batches(self, transfer: LayerInputTransfer, device: torch.device, position_ids: bool = True):
+        # every pass yields all batches in order, a pass can be repeated (subset passes + output pass)
+        for _ in range(2):
+            indices = []
+            for j, layer_input, kwargs in transfer.batches():
+                indices.append(j)
+                self.assertNestedEqual((layer_input, kwargs), self.expected(j, device, position_ids))
+            self.assertEqual(indices, [0, 1, 2])
+
+        self.assertEqual([j for j, _, _ in transfer.batches(start=1)], [1, 2])
+        self.assertEqual([j for j, _, _ in transfer.batches(stop=2)], [0, 1])
+        self.assertEqual([j for j, _, _ in transfer.batches(stop=0)], [])
+
+    @parameterized.expand([(True,), (False,)])
+    def test_cpu(self, position_ids: bool):
+        transfer = self.transfer(torch.device("cpu"), position_ids)
+        self.assertFalse(transfer.async_copy)
+        self.check_batches(transfer, torch.device("cpu"), position_ids)
+
+    @unittest.skipUnless(torch.cuda.is_available(), "requires cuda")
+    def test_resident(self):
+        transfer = self.transfer(CUDA)
+        self.assertTrue(transfer.async_copy)
+        self.assertIsNotNone(transfer._resident)
+        self.check_batches(transfer, CUDA)
+
+        transfer.release()
+        self.assertIsNone(transfer._resident)
+
+    @unittest.skipUnless(torch.cuda.is_available(), "requires cuda")
+    def test_prefetch(self):
+        # nothing fits: every batch is copied one batch ahead of its forward on the side stream
+        with mock.patch("gptqmodel.utils.transfer.RESIDENT_MEMORY_FRACTION", 0):
+            transfer = self.transfer(CUDA)
+        self.assertTrue(transfer.async_copy)
+        self.assertIsNone(transfer._resident)
+        # host inputs are pinned in place for non-blocking copies
+        self.assertTrue(all(inp[0].is_pinned() for inp in self.layer_inputs))
+        self.check_batches(transfer, CUDA)
@@ -0,0 +1,44 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.quantization import GPTQ  # noqa: E402
+from gptqmodel.quantization.moe import ExpertHessianAccumulator, expert_module_pattern  # noqa: E402
+
+
+class TestMoeHessian(unittest.TestCase):
+    def test_expert_pattern(self):
+        pattern = expert_module_pattern([["self_attn.q_proj"], ["mlp.experts.{expert_index}.down_proj"]])
+        self.assertTrue(pattern.match("mlp.experts.12.down_proj"))
+        self.assertFalse(pattern.match("self_attn.q_proj"))
+        self.assertFalse(expert_module_pattern([["self_attn.q_proj"]]).match("mlp.experts.0.down_proj"))
+
+    def test_matches_sequential_add_batch(self):
+        torch.manual_seed(0)
+        experts = [torch.nn.Linear(64, 32, bias=False) for _ in range(4)]
+        reference = {f"experts.{e}": GPTQ(m) for e, m in enumerate(experts)}
+        batched = {f"experts.{e}": GPTQ(m) for e, m in enumerate(experts)}
+        accumulator = ExpertHessianAccumulator(batched)
+
+        for _ in range(3):
+            for e in range(len(experts)):
+                # uneven routing, expert 3 gets no tokens at all
+                tokens = [40, 7, 1, 0][e]
+                if tokens == 0:
+                    continue
+                inp = torch.randn(tokens, 64)
+                reference[f"experts.{e}"].add_batch(inp, None)
+                accumulator.add(f"experts.{e}", inp)
+            accumulator.flush()
+
+        for name in reference:
+            self.assertEqual(reference[name].nsamples, batched[name].nsamples)
+            torch.testing.assert_close(reference[name].H, batched[name].H, rtol=1e-4, atol=1e-5)
+
+        self.assertEqual(accumulator.tokens["experts.0"], 120)
+        self.assertEqual(accumulator.starved(), ["experts.1", "experts.2", "experts.3"])
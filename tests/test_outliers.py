@@ -0,0 +1,80 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+from unittest import mock  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.nn_modules.qlinear.ipex import IPEXQuantLinear  # noqa: E402
+from gptqmodel.nn_modules.qlinear.torch import TorchQuantLinear  # noqa: E402
+from gptqmodel.quantization import QuantizeConfig  # noqa: E402
+from gptqmodel.utils.model import dequantize_packed_weight, pack_layer  # noqa: E402
+from parameterized import parameterized  # noqa: E402
+from solver_test import SolverTest  # noqa: E402
+
+
+class TestOutliers(SolverTest):
+    BITS = 3
+
+    def setUp(self):
+        super().setUp()
+        # a few large weights stretch the ranges of their groups
+        self.large = torch.randperm(64 * 128)[:40]
+        self.weight.view(-1)[self.large] *= 20
+
+    @parameterized.expand([
+        (32, False, False),
+        (32, True, False),
+        (32, True, True),
+        (-1, False, False),
+    ])
+    def test_outliers(self, group_size: int, actorder: bool, static_groups: bool):
+        layer = self.layer()
+        g = self.solve(layer, group_size=group_size, actorder=actorder, static_groups=static_groups, outlier_ratio=0.01)
+
+        self.assertEqual(g.outliers._nnz(), int(64 * 128 * 0.01))
+        # outliers keep their fp value in the solved weight
+        outliers = g.outliers.to_dense() != 0
+        torch.testing.assert_close(g.outliers.to_dense()[outliers], layer.weight.data[outliers])
+        # the large weights cost the most to round
+        self.assertGreater(outliers.view(-1)[self.large].float().mean().item(), 0.5)
+
+    @parameterized.expand([
+        (TorchQuantLinear, 3),
+        (IPEXQuantLinear, 4),
+    ])
+    def test_save_load(self, QuantLinear, bits: int):
+        layer = self.layer()
+        g = self.solve(layer, bits=bits, group_size=32, outlier_ratio=0.01)
+        scale, zero, g_idx = g.result[:3]
+        quantized = layer.weight.data.clone()
+
+        def quant_linear():
+            return QuantLinear(bits=bits, group_size=32, sym=False, desc_act=False, infeatures=128, outfeatures=64,
+                               bias=False, weight_dtype=torch.float32, outlier_ratio=0.01)
+
+        qlayer = quant_linear()
+        qlayer.device = torch.device("cpu")
+        quantizers = {"m": (g.quantizer, scale, zero, g_idx, g.outliers)}
+        pack_layer("m", {"m": qlayer}, quantizers, {"m": layer}, QuantLinear, mock.MagicMock())
+
+        # the outlier buffers are part of the checkpoint, loaded modules add them back
+        loaded = quant_linear()
+        loaded.load_state_dict(qlayer.state_dict())
+        loaded.post_init()
+        self.assertEqual(loaded.outlier_values.shape, (int(64 * 128 * 0.01),))
+
+        x = torch.randn(2, 5, 128)
+        torch.testing.assert_close(loaded(x), x @ quantized.t(), rtol=1e-4, atol=1e-4)
+        if QuantLinear is TorchQuantLinear:
+            torch.testing.assert_close(loaded.dequantize_weight().t(), quantized)
+            # requantize() and previous_quantized reuse dequantize the checkpoint tensors with the outliers
+            torch.testing.assert_close(dequantize_packed_weight(qlayer.state_dict(), bits, 32, False, False), quantized)
+
+    def test_config(self):
+        with self.assertRaises(ValueError):
+            QuantizeConfig(outlier_ratio=1.0)
+        with self.assertRaises(ValueError):
+            QuantizeConfig(outlier_ratio=0.01, sparsity=0.5)
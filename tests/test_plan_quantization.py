@@ -0,0 +1,37 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from datasets import load_dataset  # noqa: E402
+from gptqmodel import GPTQModel  # noqa: E402
+from gptqmodel.quantization import QuantizeConfig  # noqa: E402
+from gptqmodel.utils.planner import PLAN_BATCH_SIZES  # noqa: E402
+
+
+class TestPlanQuantization(unittest.TestCase):
+    NATIVE_MODEL_ID = "/monster/data/model/TinyLlama-1.1B-Chat-v1.0"
+
+    def test_plan(self):
+        model = GPTQModel.load(self.NATIVE_MODEL_ID, quantize_config=QuantizeConfig(bits=4, group_size=128))
+        traindata = load_dataset("wikitext", "wikitext-2-raw-v1", split="train").filter(lambda x: len(x['text']) >= 512)
+        calibration_dataset = [model.tokenizer(example["text"]) for example in traindata.select(range(32))]
+
+        weight = model.model.model.layers[0].self_attn.q_proj.weight.data.clone()
+        plan = model.plan_quantization(calibration_dataset, batch_size=4)
+
+        # probe must not leave quantized weights behind
+        self.assertTrue(torch.equal(weight, model.model.model.layers[0].self_attn.q_proj.weight.data))
+
+        self.assertEqual(plan.num_layers, 22)
+        self.assertEqual(plan.num_modules, 22 * 7)
+        for phase in ["capture", "forward", "add_batch", "quantize", "pack", "save"]:
+            self.assertGreater(plan.time[phase], 0)
+        self.assertGreater(plan.peak_host_memory, 0)
+        # embed_tokens + lm_head in fp16 and 4bit layers
+        self.assertTrue(0.5 * 1024 ** 3 < plan.checkpoint_size < 1.0 * 1024 ** 3)
+        self.assertIn(plan.recommended_batch_size, PLAN_BATCH_SIZES)
@@ -0,0 +1,85 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import unittest  # noqa: E402
+from unittest import mock  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.quantization import quantizer as quantizer_module  # noqa: E402
+from gptqmodel.quantization.quantizer import Quantizer, quantize  # noqa: E402
+from parameterized import parameterized  # noqa: E402
+
+
+def loop_find_params(q: Quantizer, x: torch.Tensor):
+    # per shrink factor python loop the vectorized search replaced
+    tmp = torch.zeros(x.shape[0])
+    xmin = torch.minimum(x.min(1)[0], tmp)
+    xmax = torch.maximum(x.max(1)[0], tmp)
+    if q.sym:
+        xmax = torch.maximum(torch.abs(xmin), xmax)
+        tmp = xmin < 0
+        xmin[tmp] = -xmax[tmp]
+    scale = (xmax - xmin) / q.maxq
+    zero = torch.full_like(scale, (q.maxq + 1) / 2) if q.sym else torch.round(-xmin / scale)
+
+    best = torch.full([x.shape[0]], float("inf"))
+    for i in range(int(q.maxshrink * q.grid)):
+        p = 1 - i / q.grid
+        xmin1 = p * xmin
+        xmax1 = p * xmax
+        scale1 = (xmax1 - xmin1) / q.maxq
+        zero1 = torch.round(-xmin1 / scale1) if not q.sym else zero
+        err = (quantize(x, scale1.unsqueeze(1), zero1.unsqueeze(1), q.maxq) - x).abs_().pow_(q.mse).sum(1)
+        tmp = err < best
+        best[tmp] = err[tmp]
+        scale[tmp] = scale1[tmp]
+        zero[tmp] = zero1[tmp]
+    return scale.unsqueeze(1), zero.unsqueeze(1)
+
+
+def mse_error(q: Quantizer, x: torch.Tensor):
+    return (quantize(x, q.scale, q.zero, q.maxq) - x).abs().pow(q.mse).sum(1)
+
+
+class TestQuantizerMse(unittest.TestCase):
+    @parameterized.expand([(True,), (False,)])
+    def test_matches_loop(self, sym: bool):
+        torch.manual_seed(0)
+        x = torch.randn(48, 128)
+        x[:, 0] *= 8  # outliers make clipping worthwhile
+
+        q = Quantizer()
+        q.configure(4, perchannel=True, sym=sym, mse=2.4)
+        q.find_params(x, weight=True)
+        scale, zero = loop_find_params(q, x)
+        torch.testing.assert_close(q.scale, scale)
+        torch.testing.assert_close(q.zero, zero)
+
+        # candidates split over several chunks pick the same shrink factors
+        with mock.patch.object(quantizer_module, "MSE_SEARCH_CHUNK_BYTES", 7 * x.numel() * x.element_size()):
+            chunked = Quantizer()
+            chunked.configure(4, perchannel=True, sym=sym, mse=2.4)
+            chunked.find_params(x, weight=True)
+        torch.testing.assert_close(chunked.scale, scale)
+        torch.testing.assert_close(chunked.zero, zero)
+
+    def test_coarse_to_fine(self):
+        torch.manual_seed(0)
+        x = torch.randn(64, 128)
+        x[:, :2] *= 6
+
+        full = Quantizer()
+        full.configure(4, perchannel=True, sym=False, mse=2.4)
+        full.find_params(x, weight=True)
+
+        coarse = Quantizer()
+        coarse.configure(4, perchannel=True, sym=False, mse=2.4, mse_search_step=4)
+        coarse.find_params(x, weight=True)
+
+        full_err = mse_error(full, x)
+        coarse_err = mse_error(coarse, x)
+        self.assertTrue(torch.all(coarse_err >= full_err * (1 - 1e-5)))
+        self.assertLess(coarse_err.sum().item(), full_err.sum().item() * 1.02)
@@ -0,0 +1,65 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import tempfile  # noqa: E402
+import unittest  # noqa: E402
+
+from datasets import load_dataset  # noqa: E402
+from gptqmodel import BACKEND, GPTQModel  # noqa: E402
+from gptqmodel.quantization import FORMAT, QuantizeConfig  # noqa: E402
+from transformers import AutoTokenizer  # noqa: E402
+
+
+class TestRequantize(unittest.TestCase):
+    NATIVE_MODEL_ID = "/monster/data/model/TinyLlama-1.1B-Chat-v1.0"
+
+    @classmethod
+    def setUpClass(self):
+        self.tokenizer = AutoTokenizer.from_pretrained(self.NATIVE_MODEL_ID, use_fast=True)
+        traindata = load_dataset("wikitext", "wikitext-2-raw-v1", split="train").filter(lambda x: len(x['text']) >= 512)
+        self.calibration_dataset = [self.tokenizer(example["text"]) for example in traindata.select(range(32))]
+
+    def test_requantize(self):
+        with tempfile.TemporaryDirectory() as source_dir, tempfile.TemporaryDirectory() as tmp_dir:
+            model = GPTQModel.load(self.NATIVE_MODEL_ID, quantize_config=QuantizeConfig(bits=4, group_size=128, format=FORMAT.GPTQ))
+            model.quantize(self.calibration_dataset, batch_size=4)
+            model.save(source_dir)
+            del model
+
+            model = GPTQModel.load(source_dir, backend=BACKEND.TORCH)
+            quant_log = model.requantize(QuantizeConfig(bits=3, group_size=64), self.calibration_dataset, batch_size=4)
+            self.assertTrue(len(quant_log) > 0)
+            model.save(tmp_dir)
+            del model
+
+            model = GPTQModel.load(tmp_dir)
+            self.assertEqual(model.quantize_config.bits, 3)
+            self.assertEqual(model.quantize_config.group_size, 64)
+
+            inp = self.tokenizer("The capital of France is", return_tensors="pt").to(model.device)
+            result = self.tokenizer.decode(model.generate(**inp, max_new_tokens=8)[0])
+            self.assertIn("paris", result.lower())
+
+    def test_requantize_adapter(self):
+        # the `adapter_a·adapter_b` correction of the source is part of the dequantized weights
+        with tempfile.TemporaryDirectory() as source_dir, tempfile.TemporaryDirectory() as tmp_dir:
+            model = GPTQModel.load(self.NATIVE_MODEL_ID, quantize_config=QuantizeConfig(bits=4, group_size=128, adapter_rank=8))
+            model.quantize(self.calibration_dataset, batch_size=4)
+            model.save(source_dir)
+            del model
+
+            model = GPTQModel.load(source_dir, backend=BACKEND.TORCH)
+            self.assertEqual(model.quantize_config.adapter_rank, 8)
+            model.requantize(QuantizeConfig(bits=4, group_size=128), self.calibration_dataset, batch_size=4)
+            model.save(tmp_dir)
+            del model
+
+            model = GPTQModel.load(tmp_dir)
+            self.assertEqual(model.quantize_config.adapter_rank, 0)
+
+            inp = self.tokenizer("The capital of France is", return_tensors="pt").to(model.device)
+            result = self.tokenizer.decode(model.generate(**inp, max_new_tokens=8)[0])
+            self.assertIn("paris", result.lower())
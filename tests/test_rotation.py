@@ -0,0 +1,58 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel.models.definitions.llama import LlamaGPTQ  # noqa: E402
+from gptqmodel.quantization import ROTATION, QuantizeConfig  # noqa: E402
+from gptqmodel.quantization.rotation import (hadamard_factor, hadamard_transform,  # noqa: E402
+                                             register_online_rotation, rotate_model, rotation_matrix)
+from parameterized import parameterized  # noqa: E402
+from transformers import LlamaConfig, LlamaForCausalLM  # noqa: E402
+
+
+class TestRotation(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        # 96 = 3 * 32 intermediate features need a kronecker factored hadamard
+        config = LlamaConfig(hidden_size=64, intermediate_size=96, num_hidden_layers=2, num_attention_heads=4,
+                             num_key_value_heads=2, vocab_size=128, tie_word_embeddings=True)
+        self.model = LlamaForCausalLM(config).eval()
+        for name, param in self.model.named_parameters():
+            if "norm" in name:
+                param.data.uniform_(0.5, 1.5)
+        self.input_ids = torch.randint(0, 128, (2, 16))
+
+    @parameterized.expand([(ROTATION.HADAMARD,), (ROTATION.RANDOM,)])
+    def test_outputs_unchanged(self, rotation: str):
+        with torch.no_grad():
+            expected = self.model(self.input_ids).logits
+            rotate_model(self.model, LlamaGPTQ, rotation, seed=1)
+            register_online_rotation(self.model, LlamaGPTQ, seed=1)
+            logits = self.model(self.input_ids).logits
+
+        torch.testing.assert_close(logits, expected, rtol=1e-4, atol=1e-4)
+        self.assertFalse(self.model.config.tie_word_embeddings)
+        self.assertTrue((self.model.model.layers[0].input_layernorm.weight == 1).all())
+
+    @parameterized.expand([(64,), (96,), (40,)])
+    def test_orthogonal(self, n: int):
+        Q = rotation_matrix(n, ROTATION.HADAMARD, seed=0)
+        torch.testing.assert_close(Q @ Q.t(), torch.eye(n, dtype=torch.float64))
+
+        x = torch.randn(3, n, dtype=torch.float64)
+        H = hadamard_transform(torch.eye(n, dtype=torch.float64), hadamard_factor(n, 0))
+        torch.testing.assert_close(hadamard_transform(x, hadamard_factor(n, 0)), x @ H)
+        torch.testing.assert_close(H @ H.t(), torch.eye(n, dtype=torch.float64))
+
+    def test_config(self):
+        with self.assertRaises(ValueError):
+            QuantizeConfig(rotation="unknown")
+        config = QuantizeConfig(rotation=ROTATION.HADAMARD, rotation_seed=3)
+        self.assertEqual(config.to_dict()["rotation"], ROTATION.HADAMARD)
+        self.assertEqual(QuantizeConfig.from_quant_config(config.to_dict()).rotation_seed, 3)
+        self.assertNotIn("rotation", QuantizeConfig().to_dict())
@@ -0,0 +1,68 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import json  # noqa: E402
+import tempfile  # noqa: E402
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+from gptqmodel import BACKEND, GPTQModel  # noqa: E402
+from gptqmodel.quantization import QUANT_METHOD, RTN_METHOD, Quantizer, RTNQuantizeConfig  # noqa: E402
+from gptqmodel.quantization.rtn import rtn_quantize  # noqa: E402
+from parameterized import parameterized  # noqa: E402
+from transformers import AutoTokenizer  # noqa: E402
+
+
+class TestRTN(unittest.TestCase):
+    NATIVE_MODEL_ID = "/monster/data/model/TinyLlama-1.1B-Chat-v1.0"
+
+    @parameterized.expand([(128, True), (32, False), (-1, False)])
+    def test_matches_find_params(self, group_size: int, sym: bool):
+        torch.manual_seed(0)
+        # 320 columns: the last group is partial for group_size 128
+        W = torch.randn(48, 320)
+        Q, scale, zero, g_idx = rtn_quantize(W, 4, group_size, sym)
+
+        width = group_size if group_size != -1 else 320
+        quantizer = Quantizer()
+        quantizer.configure(4, perchannel=True, sym=sym)
+        for g, start in enumerate(range(0, 320, width)):
+            quantizer.find_params(W[:, start:start + width], weight=True)
+            torch.testing.assert_close(scale[:, g:g + 1], quantizer.scale)
+            torch.testing.assert_close(zero[:, g:g + 1], quantizer.zero)
+            torch.testing.assert_close(Q[:, start:start + width], quantizer.quantize(W[:, start:start + width]))
+        self.assertEqual(g_idx.tolist(), [i // width for i in range(320)])
+
+    def test_hqq(self):
+        torch.manual_seed(0)
+        W = torch.randn(64, 256)
+        W[:, ::17] *= 5
+        Q, _, _, _ = rtn_quantize(W, 3, 64, sym=False)
+        Q_hqq, _, zero, _ = rtn_quantize(W, 3, 64, sym=False, method=RTN_METHOD.HQQ)
+
+        self.assertTrue(torch.equal(zero, zero.round()))
+        self.assertLessEqual((Q_hqq - W).abs().sum().item(), (Q - W).abs().sum().item())
+
+    def test_hqq_requires_asym(self):
+        with self.assertRaises(ValueError):
+            RTNQuantizeConfig(bits=4, sym=True, method=RTN_METHOD.HQQ)
+
+    def test_quantize_model(self):
+        quantize_config = RTNQuantizeConfig(bits=4, group_size=128)
+        model = GPTQModel.load(self.NATIVE_MODEL_ID, quantize_config=quantize_config)
+        quant_log = model.quantize(None)
+        self.assertTrue(len(quant_log) > 0)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model.save(tmp_dir)
+            del model
+            with open(os.path.join(tmp_dir, "quantize_config.json")) as f:
+                self.assertEqual(json.load(f)["quant_method"], QUANT_METHOD.GPTQ)
+
+            model = GPTQModel.load(tmp_dir, backend=BACKEND.TORCH)
+            tokenizer = AutoTokenizer.from_pretrained(self.NATIVE_MODEL_ID)
+            inp = tokenizer("The capital of France is", return_tensors="pt").to(model.device)
+            self.assertGreater(model.generate(**inp, max_new_tokens=8)[0].shape[0], inp["input_ids"].shape[1])
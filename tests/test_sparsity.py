@@ -0,0 +1,83 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import torch  # noqa: E402
+from gptqmodel.nn_modules.qlinear.torch_sparse import TorchSparseQuantLinear  # noqa: E402
+from gptqmodel.quantization import FORMAT, QuantizeConfig  # noqa: E402
+from parameterized import parameterized  # noqa: E402
+from solver_test import SolverTest  # noqa: E402
+
+
+class TestSparsity(SolverTest):
+    def test_n_m(self):
+        layer = self.layer()
+        self.solve(layer, group_size=32, prune_n=2, prune_m=4)
+        zeros = (layer.weight.data == 0).reshape(64, 32, 4).sum(dim=2)
+        self.assertTrue((zeros >= 2).all())
+
+    @parameterized.expand([(0.25,), (0.5,)])
+    def test_unstructured(self, sparsity: float):
+        layer = self.layer()
+        self.solve(layer, group_size=32, sparsity=sparsity)
+        self.assertGreaterEqual((layer.weight.data == 0).float().mean().item(), sparsity)
+
+    def test_better_than_magnitude(self):
+        layer = self.layer()
+        self.solve(layer, group_size=32, prune_n=2, prune_m=4)
+
+        # magnitude 2:4 pruning, then gptq on the pruned weight
+        magnitude = self.layer()
+        pruned = self.weight.reshape(64, 32, 4).clone()
+        pruned.scatter_(2, pruned.abs().topk(2, dim=2, largest=False).indices, 0)
+        magnitude.weight.data = pruned.reshape(64, 128)
+        self.solve(magnitude, group_size=32)
+        magnitude.weight.data[pruned.reshape(64, 128) == 0] = 0
+
+        self.assertLess(self.output_error(layer.weight.data), self.output_error(magnitude.weight.data))
+
+    def test_actorder_n_m(self):
+        with self.assertRaises(ValueError):
+            self.solve(self.layer(), group_size=32, prune_n=2, prune_m=4, actorder=True)
+
+    @parameterized.expand([(2,), (4,), (8,)])
+    def test_pack(self, bits: int):
+        layer = self.layer()
+        g = self.solve(layer, bits=bits, group_size=32, prune_n=2, prune_m=4)
+        scale, zero, g_idx = g.result[:3]
+
+        qlayer = TorchSparseQuantLinear(bits=bits, group_size=32, sym=False, desc_act=False, infeatures=128,
+                                        outfeatures=64, bias=False, weight_dtype=torch.float32)
+        qlayer.pack(layer, scale, zero, g_idx)
+        qlayer.post_init()
+
+        # half of the weights are packed
+        self.assertEqual(qlayer.qweight.shape, (128 // 2 // 32 * bits, 64))
+        self.assertEqual(qlayer.sparse_meta.shape, (128 // 32, 64))
+        torch.testing.assert_close(qlayer.dequantize_weight().t(), layer.weight.data)
+
+        x = torch.randn(2, 5, 128)
+        torch.testing.assert_close(qlayer(x), layer(x), rtol=1e-4, atol=1e-4)
+
+    def test_pack_dense(self):
+        layer = self.layer()
+        g = self.solve(layer, group_size=32)
+        scale, zero, g_idx = g.result[:3]
+
+        qlayer = TorchSparseQuantLinear(bits=4, group_size=32, sym=False, desc_act=False, infeatures=128,
+                                        outfeatures=64, bias=False, weight_dtype=torch.float32)
+        with self.assertRaises(ValueError):
+            qlayer.pack(layer, scale, zero, g_idx)
+
+    def test_config(self):
+        with self.assertRaises(ValueError):
+            QuantizeConfig(prune_n=2, prune_m=4, desc_act=True)
+        with self.assertRaises(ValueError):
+            QuantizeConfig(prune_n=4, prune_m=2, desc_act=False)
+        with self.assertRaises(ValueError):
+            QuantizeConfig(sparsity=0.5, prune_n=2, prune_m=4, desc_act=False)
+        with self.assertRaises(ValueError):
+            QuantizeConfig(prune_n=1, prune_m=4, desc_act=False, format=FORMAT.GPTQ_SPARSE)
+        QuantizeConfig(prune_n=2, prune_m=4, desc_act=False, format=FORMAT.GPTQ_SPARSE)
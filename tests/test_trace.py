@@ -0,0 +1,74 @@
+# -- do not touch
+import os
+
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+# -- end do not touch
+
+import json  # noqa: E402
+import tempfile  # noqa: E402
+import unittest  # noqa: E402
+
+import torch  # noqa: E402
+import torch.nn as nn  # noqa: E402
+from gptqmodel.quantization import GPTQ  # noqa: E402
+from gptqmodel.utils import Tracer  # noqa: E402
+from gptqmodel.utils.trace import trace_span  # noqa: E402
+
+
+class TestTrace(unittest.TestCase):
+    def quantize_linear(self):
+        layer = nn.Linear(256, 128, bias=False)
+        gptq = GPTQ(layer)
+        gptq.quantizer.configure(4, perchannel=True, sym=True)
+        for _ in range(4):
+            gptq.add_batch(torch.randn(2, 16, 256), None)
+        gptq.quantize(group_size=128)
+
+    def test_spans(self):
+        spans = []
+        tracer = Tracer(callbacks=[spans.append])
+        with tracer:
+            self.quantize_linear()
+
+        names = [s.name for s in tracer.spans]
+        self.assertEqual(names.count("add_batch"), 4)
+        self.assertIn("damp_cholesky", names)
+        self.assertIn("column_sweep", names)
+        self.assertEqual(len(spans), len(tracer.spans))
+
+        summary = {row["name"]: row for row in tracer.summary()}
+        self.assertEqual(summary["add_batch"]["count"], 4)
+        self.assertIn("column_sweep", tracer.summary_table())
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "trace.json")
+            tracer.export_chrome_trace(path)
+            with open(path) as f:
+                events = json.load(f)["traceEvents"]
+            self.assertTrue(any(e["ph"] == "X" and e["name"] == "column_sweep" for e in events))
+
+    @unittest.skipUnless(torch.cuda.is_available(), "requires cuda")
+    def test_device_memory_peak(self):
+        mb = 1024 * 1024
+        with Tracer() as tracer:
+            with trace_span("large"):
+                x = torch.empty(64 * mb, dtype=torch.uint8, device="cuda")
+                del x
+            with trace_span("outer"):
+                x = torch.empty(16 * mb, dtype=torch.uint8, device="cuda")
+                del x
+                with trace_span("inner"):
+                    x = torch.empty(mb, dtype=torch.uint8, device="cuda")
+                    del x
+
+        spans = {s.name: s for s in tracer.spans}
+        # the peak of an earlier span does not leak into later ones, the inner peak is kept by the enclosing span
+        self.assertGreaterEqual(spans["large"].device_memory_peak - spans["large"].device_memory_start, 64 * mb)
+        self.assertLess(spans["outer"].device_memory_peak - spans["outer"].device_memory_start, 64 * mb)
+        self.assertGreaterEqual(spans["outer"].device_memory_peak - spans["outer"].device_memory_start, 16 * mb)
+        self.assertLess(spans["inner"].device_memory_peak - spans["inner"].device_memory_start, 16 * mb)
+
+    def test_inactive(self):
+        tracer = Tracer()
+        self.quantize_linear()
+        self.assertEqual(len(tracer.spans), 0)